@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+from array import array
+from bisect import bisect_left
+
+from .pygenelib import Family, Person, NameIndex, male, female, neuter, _beyond_generation
+
+"""
+Columnar storage for large families. Rather than one Person object per family member, a ColumnStore keeps each
+person's names, gender and generation in arrays indexed by row, and the parent, child and spouse links as
+compressed sparse row (CSR) adjacency arrays: the relatives of the person in row r are the rows
+links[offsets[r]:offsets[r+1]]. Person objects are only created on demand, as PersonView instances that read their
+attributes from the store, and are not kept once a query is done with them.
+"""
+
+
+class ColumnStore(object):
+    """
+    The arrays holding a group of people in columnar form. Rows are ordered by person id, so a person can be found by
+    binary search on the ids column. Any of the columns may be an array.array or a memoryview of the same type, so
+    a store can also be backed by a memory-mapped file.
+    """
+    relations = ("parent", "child", "spouse")
+
+    def __init__(self, ids, gender_codes, genders, generations, strings, names, links, name_postings=None,
+                 folded_order=None, generation_order=None):
+        """
+        Create a store from its columns. Use ColumnStore.from_people to build one from instances of Person.
+        :param ids: the id of the person in each row, in increasing order
+        :param gender_codes: for each row, the position in genders of that person's gender
+        :param genders: a list of instances of Gender
+        :param generations: the generation of the person in each row
+        :param strings: the table of distinct names, any sequence of strings
+        :param names: a dictionary mapping each of NameIndex.fields to a column giving, for each row, the position of
+        that name in strings
+        :param links: a dictionary mapping each of ColumnStore.relations to an (offsets, rows) tuple of CSR arrays
+        :param name_postings: optional, a dictionary mapping each of NameIndex.fields to an (offsets, rows) tuple of
+        CSR arrays giving, for each position in strings, the rows that have that name in that field
+        :param folded_order: optional, the positions in strings, sorted by the case-folded string
+        :param generation_order: optional, the rows sorted by generation (and then by row)
+        The last three are lookup tables computed from the other columns; they are built if not given.
+        :return: none
+        """
+        self.ids = ids
+        self.gender_codes = gender_codes
+        self.genders = genders
+        self.generations = generations
+        self.strings = strings
+        self.names = names
+        self.links = links
+
+        if name_postings is None:
+            name_postings = dict()
+            for field in NameIndex.fields:
+                rows = sorted(range(len(ids)), key=names[field].__getitem__)
+                offsets = array("q", [0]) * (len(strings) + 1)
+                for r in rows:
+                    offsets[names[field][r] + 1] += 1
+                for i in range(len(strings)):
+                    offsets[i + 1] += offsets[i]
+                name_postings[field] = (offsets, array("i", rows))
+        if folded_order is None:
+            folded_order = array("i", sorted(range(len(strings)), key=lambda i: strings[i].casefold()))
+        if generation_order is None:
+            generation_order = array("i", sorted(range(len(ids)), key=generations.__getitem__))
+
+        self.name_postings = name_postings
+        self.folded_order = folded_order
+        self.generation_order = generation_order
+
+    @classmethod
+    def from_people(cls, people):
+        """
+        Build a store holding copies of the given people. Relations to people who are not in the group are left out.
+        :param people: an iterable of instances of Person
+        :return: a ColumnStore
+        """
+        people = sorted(people, key=lambda p: p.id)
+        row_of = dict((p.id, r) for r, p in enumerate(people))
+
+        genders = [male, female, neuter]
+        gender_pos = dict((id(g), i) for i, g in enumerate(genders))
+        string_pos = dict()
+        strings = []
+        names = dict((f, array("i")) for f in NameIndex.fields)
+        gender_codes = array("H")
+        for p in people:
+            if id(p.gender) not in gender_pos:
+                gender_pos[id(p.gender)] = len(genders)
+                genders.append(p.gender)
+            gender_codes.append(gender_pos[id(p.gender)])
+
+            for field in NameIndex.fields:
+                value = getattr(p, field)
+                if value not in string_pos:
+                    string_pos[value] = len(strings)
+                    strings.append(value)
+                names[field].append(string_pos[value])
+
+        links = dict()
+        for relation, attr in zip(cls.relations, ("parents", "children", "spouses")):
+            offsets = array("q", [0])
+            rows = array("i")
+            for p in people:
+                rows.extend(row_of[q.id] for q in getattr(p, attr) if q.id in row_of)
+                offsets.append(len(rows))
+            links[relation] = (offsets, rows)
+
+        ids = array("q", (p.id for p in people))
+        generations = array("i", (p.generation for p in people))
+        return cls(ids, gender_codes, genders, generations, strings, names, links)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row_of(self, person_id):
+        """
+        Find the row of a person by their id
+        :param person_id: the id of the person, as an integer
+        :return: the row as an integer, or None if the person is not in the store
+        """
+        row = bisect_left(self.ids, person_id)
+        if row < len(self.ids) and self.ids[row] == person_id:
+            return row
+        return None
+
+    def name(self, row, field):
+        """
+        Get one of the names of a person
+        :param row: the row of the person
+        :param field: which name, one of NameIndex.fields
+        :return: a string
+        """
+        return self.strings[self.names[field][row]]
+
+    def relatives(self, row, relation):
+        """
+        Get the rows of the relatives of a person
+        :param row: the row of the person
+        :param relation: one of ColumnStore.relations
+        :return: a sequence of rows
+        """
+        offsets, rows = self.links[relation]
+        return rows[offsets[row]:offsets[row + 1]]
+
+    def rows_with_name(self, field, value, mode="exact"):
+        """
+        Find the rows whose name in a field matches a value. Exact and prefix matches are found by binary search of the
+        string table in case-folded order, substring matches by checking each distinct name once; the rows of each
+        matching name then come straight from the name postings.
+        :param field: which name to search, one of NameIndex.fields
+        :param value: the name to search for, as a string. Matching is case-insensitive.
+        :param mode: optional, one of NameIndex.modes, see NameIndex.lookup
+        :return: a list of rows
+        """
+        key = value.casefold()
+        if mode == "substring":
+            positions = [i for i in range(len(self.strings)) if key in self.strings[i].casefold()]
+        elif mode in ("exact", "prefix"):
+            matches = (lambda v: v == key) if mode == "exact" else (lambda v: v.startswith(key))
+            positions = []
+            k = self._folded_bisect(key)
+            while k < len(self.folded_order) and matches(self.strings[self.folded_order[k]].casefold()):
+                positions.append(self.folded_order[k])
+                k += 1
+        else:
+            raise ValueError("mode must be one of {0}".format(", ".join(NameIndex.modes)))
+
+        offsets, rows = self.name_postings[field]
+        result = []
+        for i in positions:
+            result.extend(rows[offsets[i]:offsets[i + 1]])
+        return result
+
+    def _folded_bisect(self, key):
+        """
+        Internal method that finds the first position in folded_order whose case-folded string is not less than key
+        :param key: a case-folded string
+        :return: an integer
+        """
+        lo, hi = 0, len(self.folded_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.strings[self.folded_order[mid]].casefold() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _generation_bisect(self, generation):
+        """
+        Internal method that finds the first position in generation_order whose generation is not less than the one
+        given
+        :param generation: the generation, as an integer
+        :return: an integer
+        """
+        lo, hi = 0, len(self.generation_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.generations[self.generation_order[mid]] < generation:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows_in_generation(self, generation):
+        """
+        Get the rows of the people in a generation
+        :param generation: the generation, as an integer
+        :return: a sequence of rows
+        """
+        return self.generation_order[self._generation_bisect(generation):self._generation_bisect(generation + 1)]
+
+    def generation_numbers(self):
+        """
+        Get the generations that have at least one person in them
+        :return: a sorted list of integers
+        """
+        result = []
+        k = 0
+        while k < len(self.generation_order):
+            gen = self.generations[self.generation_order[k]]
+            result.append(gen)
+            k = self._generation_bisect(gen + 1)
+        return result
+
+    def view(self, row):
+        """
+        Get a PersonView of the person in a row
+        :param row: the row of the person
+        :return: an instance of PersonView
+        """
+        return PersonView(self, row)
+
+
+class PersonView(Person):
+    """
+    A read-only Person whose attributes are read from a ColumnStore. It behaves like a Person in every query, but its
+    names and relations cannot be changed.
+    """
+    # A view is as large as a Person, since it inherits Person's slots (which stay empty, as every attribute of Person
+    # is a property reading from the store); the saving comes from views only existing while a query uses them.
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        """
+        Create a view of one row of a ColumnStore. Use ColumnStore.view rather than calling this directly.
+        :param store: the ColumnStore
+        :param row: the row of the person
+        :return: none
+        """
+        self._store = store
+        self._row = row
+
+    @property
+    def id(self):
+        return self._store.ids[self._row]
+
+    @property
+    def gender(self):
+        return self._store.genders[self._store.gender_codes[self._row]]
+
+    @property
+    def generation(self):
+        return self._store.generations[self._row]
+
+    @property
+    def first_name(self):
+        return self._store.name(self._row, "first_name")
+
+    @property
+    def middle_name(self):
+        return self._store.name(self._row, "middle_name")
+
+    @property
+    def last_name(self):
+        return self._store.name(self._row, "last_name")
+
+    @property
+    def unmarried_name(self):
+        return self._store.name(self._row, "unmarried_name")
+
+    @property
+    def suffix(self):
+        return self._store.name(self._row, "suffix")
+
+    @property
+    def parents(self):
+        return [self._store.view(r) for r in self._store.relatives(self._row, "parent")]
+
+    @property
+    def children(self):
+        return [self._store.view(r) for r in self._store.relatives(self._row, "child")]
+
+    @property
+    def spouses(self):
+        return [self._store.view(r) for r in self._store.relatives(self._row, "spouse")]
+
+    @property
+    def _families(self):
+        # Views cannot change, so there is never a family to notify
+        return ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("{0} is a read-only view of a columnar family and cannot be modified".format(self))
+
+    add_parent = _read_only
+    add_child = _read_only
+    add_spouse = _read_only
+    remove_relation = _read_only
+    delete_me = _read_only
+
+
+class ColumnNameIndex(NameIndex):
+    """
+    A NameIndex that answers lookups from the name postings and case-folded string order of a ColumnStore, so no
+    per-person index has to be built in memory.
+    """
+    def __init__(self, store):
+        """
+        Create a name index for a store
+        :param store: a ColumnStore
+        :return: none
+        """
+        self._store = store
+
+    def add(self, person):
+        raise TypeError("The name index of a ColumnStore cannot be changed")
+
+    remove = add
+    update = add
+
+    def lookup(self, field, value, mode="exact"):
+        store = self._store
+        return set(store.ids[r] for r in store.rows_with_name(field, value, mode=mode))
+
+
+class ColumnarFamily(Family):
+    """
+    A read-only Family whose members are held in a ColumnStore instead of as individual Person objects. All the query
+    methods of Family work on it; members are returned as PersonView instances, ordered by id.
+    """
+    def __init__(self, store, cache_size=1024):
+        """
+        Create a family from a ColumnStore. Use ColumnarFamily.from_family to convert an existing Family.
+        :param store: the ColumnStore holding the members
+        :param cache_size: optional, see Family
+        :return: none
+        """
+        Family.__init__(self, cache_size=cache_size)
+        self._store = store
+        self._name_index = ColumnNameIndex(store)
+        self.oldest_generation = store.generations[store.generation_order[0]] if len(store) > 0 else None
+
+    @classmethod
+    def from_family(cls, family, cache_size=1024):
+        """
+        Convert a family to columnar form. Relations to people who are not members of the family are left out.
+        :param family: an instance of Family
+        :param cache_size: optional, see Family
+        :return: a ColumnarFamily
+        """
+        return cls(ColumnStore.from_people(family), cache_size=cache_size)
+
+    @property
+    def members(self):
+        return [self._store.view(r) for r in range(len(self._store))]
+
+    def __contains__(self, person):
+        return isinstance(person, Person) and self._store.row_of(person.id) is not None
+
+    def __iter__(self):
+        store = self._store
+        return (store.view(r) for r in range(len(store)))
+
+    def __len__(self):
+        return len(self._store)
+
+    def get_member(self, person_id):
+        row = self._store.row_of(person_id)
+        return None if row is None else self._store.view(row)
+
+    def add_member(self, person):
+        raise TypeError("A ColumnarFamily is read-only; add members to a Family and convert it instead")
+
+    def remove_member(self, person):
+        raise TypeError("A ColumnarFamily is read-only; remove members from a Family and convert it instead")
+
+    def _members_by_ids(self, ids):
+        store = self._store
+        return [store.view(store.row_of(i)) for i in sorted(ids)]
+
+    def find_members_in_generation(self, generation):
+        return [self._store.view(r) for r in self._store.rows_in_generation(generation)]
+
+    def generation_size(self, generation):
+        return len(self._store.rows_in_generation(generation))
+
+    @property
+    def generations(self):
+        return self._store.generation_numbers()
+
+    def _iter_lineage(self, person, attr, count_paths, stop_generation=None):
+        """
+        Internal method that does the work of iter_ancestors and iter_descendants; see Family._iter_lineage. This walks
+        the parent or child adjacency arrays directly and only creates a PersonView for each person as it is yielded.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+
+        store = self._store
+        row = store.row_of(person.id)
+        if row is None:
+            for result in Family._iter_lineage(self, person, attr, count_paths, stop_generation):
+                yield result
+            return
+
+        offsets, linked_rows = store.links["parent" if attr == "parents" else "child"]
+        seen = set([row])
+        curr_gen_rows = [(row, 1)]
+        distance = 0
+        while len(curr_gen_rows) > 0:
+            distance += 1
+            next_gen_rows = dict()
+            for r, n_paths in curr_gen_rows:
+                if _beyond_generation(store.generations[r], stop_generation, attr):
+                    continue
+                for k in range(offsets[r], offsets[r + 1]):
+                    rel = linked_rows[k]
+                    if rel in next_gen_rows:
+                        next_gen_rows[rel][1] += n_paths
+                    elif rel not in seen:
+                        seen.add(rel)
+                        next_gen_rows[rel] = [rel, n_paths]
+
+            curr_gen_rows = next_gen_rows.values()
+            for rel, n_paths in curr_gen_rows:
+                if count_paths:
+                    yield store.view(rel), distance, n_paths
+                else:
+                    yield store.view(rel), distance
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from .pygenelib import Person
+
+"""
+Finding people who may have been entered into a family more than once, under spelling variants of their names.
+Instead of comparing every pair of people, each person is given a few blocking keys built from phonetic codes
+(Soundex and Metaphone) of their names, together with their generation, and only people who share a key are compared.
+Each candidate pair is then scored on how similar their names are and how many parents and spouses they share.
+"""
+
+_soundex_codes = dict((c, str(d)) for d, letters in enumerate(["AEIOUYHW", "BFPV", "CGJKQSXZ", "DT", "L", "MN", "R"])
+                      for c in letters)
+_vowels = set("AEIOU")
+
+
+@lru_cache(maxsize=65536)
+def soundex(name):
+    """
+    Compute the American Soundex code of a name
+    :param name: a string; characters other than the letters A to Z are ignored
+    :return: a four-character string such as "R163", or an empty string if the name has no letters
+    """
+    letters = [c for c in name.upper() if "A" <= c <= "Z"]
+    if len(letters) == 0:
+        return ""
+
+    code = letters[0]
+    last = _soundex_codes[letters[0]]
+    for c in letters[1:]:
+        digit = _soundex_codes[c]
+        if digit != "0" and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        # H and W do not separate letters with the same code, but vowels do
+        if c not in "HW":
+            last = digit
+    return (code + "000")[:4]
+
+
+@lru_cache(maxsize=65536)
+def metaphone(name, max_length=6):
+    """
+    Compute the (original) Metaphone code of a name
+    :param name: a string; characters other than the letters A to Z are ignored
+    :param max_length: optional, the maximum length of the code
+    :return: a string such as "WSL" for "Weasley"
+    """
+    word = "".join(c for c in name.upper() if "A" <= c <= "Z")
+    if len(word) == 0:
+        return ""
+
+    # Initial letter exceptions
+    if word[:2] in ("AE", "GN", "KN", "PN", "WR"):
+        word = word[1:]
+    elif word[0] == "X":
+        word = "S" + word[1:]
+    elif word[:2] == "WH":
+        word = "W" + word[2:]
+
+    def at(i):
+        return word[i] if 0 <= i < len(word) else ""
+
+    code = []
+    for i, c in enumerate(word):
+        if c == at(i - 1) and c != "C":
+            continue
+        nxt = at(i + 1)
+        if c in _vowels:
+            if i == 0:
+                code.append(c)
+        elif c == "B":
+            if not (i == len(word) - 1 and at(i - 1) == "M"):
+                code.append("B")
+        elif c == "C":
+            if nxt == "I" and at(i + 2) == "A" or nxt == "H":
+                code.append("K" if at(i - 1) == "S" else "X")
+            elif nxt in ("I", "E", "Y"):
+                if at(i - 1) != "S":
+                    code.append("S")
+            else:
+                code.append("K")
+        elif c == "D":
+            code.append("J" if nxt == "G" and at(i + 2) in ("E", "I", "Y") else "T")
+        elif c == "G":
+            if nxt == "H" and not (i + 2 >= len(word) or at(i + 2) in _vowels):
+                continue
+            if nxt == "N" and (i + 2 == len(word) or word[i + 2:] == "ED"):
+                continue
+            if at(i - 1) == "D" and nxt in ("E", "I", "Y"):
+                continue
+            code.append("J" if nxt in ("E", "I", "Y") and at(i - 1) != "G" else "K")
+        elif c == "H":
+            if at(i - 1) in ("C", "S", "P", "T", "G"):
+                continue
+            if at(i - 1) in _vowels and nxt not in _vowels:
+                continue
+            code.append("H")
+        elif c == "K":
+            if at(i - 1) != "C":
+                code.append("K")
+        elif c == "P":
+            code.append("F" if nxt == "H" else "P")
+        elif c == "Q":
+            code.append("K")
+        elif c == "S":
+            if nxt == "H" or (nxt == "I" and at(i + 2) in ("O", "A")):
+                code.append("X")
+            else:
+                code.append("S")
+        elif c == "T":
+            if nxt == "I" and at(i + 2) in ("O", "A"):
+                code.append("X")
+            elif nxt == "H":
+                code.append("0")
+            elif not (nxt == "C" and at(i + 2) == "H"):
+                code.append("T")
+        elif c == "V":
+            code.append("F")
+        elif c in ("W", "Y"):
+            if nxt in _vowels:
+                code.append(c)
+        elif c == "X":
+            code.append("KS")
+        elif c == "Z":
+            code.append("S")
+        else:
+            code.append(c)
+    return "".join(code)[:max_length]
+
+
+def blocking_keys(person):
+    """
+    Compute the blocking keys of a person. People who share at least one key are compared as possible duplicates.
+    :param person: an instance of Person
+    :return: a set of tuples
+    """
+    keys = set()
+    first = person.first_name
+    surnames = [n for n in (person.last_name, person.unmarried_name) if len(n) > 0]
+    for surname in surnames:
+        keys.add(("soundex", soundex(first), soundex(surname), person.generation))
+        keys.add(("metaphone", metaphone(first), metaphone(surname), person.generation))
+    if len(surnames) == 0:
+        keys.add(("soundex", soundex(first), "", person.generation))
+    # Someone recorded under a different surname may still be found through their parents. The parents are keyed on
+    # the sound of their first names rather than on who they are, so that children of parents who were themselves
+    # entered twice (or under other surnames) are still compared.
+    if len(person.parents) > 0:
+        parent_names = tuple(sorted(soundex(p.first_name) for p in person.parents))
+        keys.add(("parents", parent_names, soundex(first), person.generation))
+    return keys
+
+
+@lru_cache(maxsize=65536)
+def _name_similarity(a, b):
+    if a == b:
+        return 1.0
+    a, b = a.casefold(), b.casefold()
+    if a == b:
+        return 1.0
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+    ratio = SequenceMatcher(None, a, b).ratio()
+    if soundex(a) == soundex(b) or metaphone(a) == metaphone(b):
+        ratio = max(ratio, 0.8)
+    return ratio
+
+
+def _surname_similarity(person, other):
+    names = [n for n in (person.last_name, person.unmarried_name) if len(n) > 0]
+    other_names = [n for n in (other.last_name, other.unmarried_name) if len(n) > 0]
+    return max([_name_similarity(a, b) for a in names for b in other_names], default=0.0)
+
+
+def _overlap(people_a, people_b):
+    ids_a = set(p.id for p in people_a)
+    ids_b = set(p.id for p in people_b)
+    if len(ids_a) == 0 or len(ids_b) == 0:
+        return None
+    return len(ids_a & ids_b) / len(ids_a | ids_b)
+
+
+def duplicate_score(person, other):
+    """
+    Score how likely two people are to be the same person
+    :param person: an instance of Person
+    :param other: an instance of Person
+    :return: a float between 0 and 1. People in different generations, or of different genders, always score 0.
+    """
+    if not isinstance(person, Person) or not isinstance(other, Person):
+        raise TypeError("person and other must be instances of Person")
+    if person.generation != other.generation or person.gender is not other.gender:
+        return 0.0
+
+    # Each part of the score has a weight; parts that cannot be compared (e.g. neither has a middle name) are left out.
+    # Having different parents weighs heavily, since namesake cousins are common in real families.
+    parts = [(0.35, _name_similarity(person.first_name, other.first_name)), (0.3, _surname_similarity(person, other))]
+    if len(person.middle_name) > 0 and len(other.middle_name) > 0:
+        parts.append((0.1, _name_similarity(person.middle_name, other.middle_name)))
+    if len(person.suffix) > 0 or len(other.suffix) > 0:
+        parts.append((0.05, 1.0 if person.suffix.casefold() == other.suffix.casefold() else 0.0))
+    for weight, people in ((0.3, (person.parents, other.parents)), (0.15, (person.spouses, other.spouses))):
+        overlap = _overlap(*people)
+        if overlap is not None:
+            parts.append((weight, overlap))
+    return sum(w * s for w, s in parts) / sum(w for w, _ in parts)
+
+
+class DuplicateFinder(object):
+    """
+    Finds possible duplicate people in a family by blocking on phonetic keys; see the module documentation. After
+    find() has run, the stats attribute holds a dictionary with the number of "people", "blocks", "oversized_blocks"
+    (blocks skipped for having more than max_block_size people), "pairs_compared" and "candidates".
+    """
+    def __init__(self, family, threshold=0.75, max_block_size=500):
+        """
+        Create a duplicate finder
+        :param family: an instance of Family
+        :param threshold: optional, the smallest score (see duplicate_score) a pair must have to be reported
+        :param max_block_size: optional, blocks with more people than this are skipped, since comparing everyone in
+        them would cost as much as not blocking at all. Very common names in one generation can produce such blocks;
+        their people are usually still compared through their other keys.
+        :return: none
+        """
+        self.family = family
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.stats = None
+
+    def blocks(self):
+        """
+        Group the members of the family by blocking key
+        :return: a dictionary mapping each key to the list of people that have it
+        """
+        blocks = dict()
+        for person in self.family:
+            for key in blocking_keys(person):
+                blocks.setdefault(key, []).append(person)
+        return blocks
+
+    def iter_candidate_pairs(self):
+        """
+        Generate each pair of people that share a blocking key, once. A pair is only generated from the block of the
+        lowest key the two people share (leaving out oversized blocks), so no record of the pairs already generated
+        has to be kept.
+        :return: a generator of (person, other) tuples
+        """
+        blocks = self.blocks()
+        used = dict((key, block) for key, block in blocks.items() if len(block) <= self.max_block_size)
+        keys_of = dict()
+        for key, block in used.items():
+            for person in block:
+                keys_of.setdefault(person.id, set()).add(key)
+
+        n_pairs = 0
+        for key, block in used.items():
+            for i in range(len(block)):
+                keys_a = keys_of[block[i].id]
+                for j in range(i + 1, len(block)):
+                    if any(k < key for k in keys_a & keys_of[block[j].id]):
+                        continue
+                    n_pairs += 1
+                    yield block[i], block[j]
+        self.stats = {"people": len(self.family), "blocks": len(blocks), "oversized_blocks": len(blocks) - len(used),
+                      "pairs_compared": n_pairs, "candidates": None}
+
+    def find(self):
+        """
+        Find the pairs of people that are possible duplicates
+        :return: a list of (person, other, score) tuples, highest score first
+        """
+        candidates = []
+        for person, other in self.iter_candidate_pairs():
+            score = duplicate_score(person, other)
+            if score >= self.threshold:
+                candidates.append((person, other, score))
+        candidates.sort(key=lambda c: (-c[2], c[0].id, c[1].id))
+        self.stats["candidates"] = len(candidates)
+        return candidates
+
+
+def find_duplicates(family, threshold=0.75, max_block_size=500):
+    """
+    Find possible duplicate people in a family; see DuplicateFinder
+    :param family: an instance of Family
+    :param threshold: optional, see DuplicateFinder
+    :param max_block_size: optional, see DuplicateFinder
+    :return: a list of (person, other, score) tuples, highest score first
+    """
+    return DuplicateFinder(family, threshold=threshold, max_block_size=max_block_size).find()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+import re
+import time
+
+from .pygenelib import Family, male, female, neuter
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory just isn't reported there
+    resource = None
+
+"""
+Reading and writing of GEDCOM 5.5 files for Family objects. Files are read one line at a time and only a compact
+summary of each INDI and FAM record is kept, so even very large files can be imported without loading them into memory;
+likewise files are written one record at a time from a generator.
+"""
+
+_sex_genders = {"M": male, "F": female}
+_gender_sexes = {id(male): "M", id(female): "F"}
+_name_re = re.compile(r"^(?P<given>[^/]*)(?:/(?P<surname>[^/]*)/?)?(?P<suffix>.*)$")
+
+
+def parse_line(line):
+    """
+    Split one line of a GEDCOM file into its parts
+    :param line: the line, as a string
+    :return: a tuple (level, xref, tag, value); xref is None if the line does not define a cross-reference id, and value
+    is an empty string if the line has none. Returns None for blank lines. Raises a ValueError if the line does not
+    start with a level number.
+    """
+    parts = line.strip().split(" ", 2)
+    if len(parts[0]) == 0:
+        return None
+
+    if not parts[0].isdigit():
+        raise ValueError("{0} is not a valid GEDCOM level".format(parts[0]))
+    level = int(parts[0])
+    if len(parts) > 1 and parts[1].startswith("@"):
+        xref = parts[1]
+        tag, _, value = parts[2].partition(" ") if len(parts) > 2 else ("", "", "")
+    else:
+        xref = None
+        tag = parts[1] if len(parts) > 1 else ""
+        value = parts[2] if len(parts) > 2 else ""
+    return level, xref, tag.upper(), value
+
+
+def split_name(value):
+    """
+    Split a GEDCOM personal name, which has the form "Given Names /Surname/ Suffix", into its parts
+    :param value: the value of a NAME line
+    :return: a tuple of (first, middle, surname, suffix) strings
+    """
+    match = _name_re.match(value.strip())
+    given = match.group("given").split()
+    first = given[0] if len(given) > 0 else ""
+    middle = " ".join(given[1:])
+    surname = (match.group("surname") or "").strip()
+    suffix = match.group("suffix").strip()
+    return first, middle, surname, suffix
+
+
+class GedcomReader(object):
+    """
+    Reads a GEDCOM file into a Family. The file is read in a single streaming pass that keeps a compact summary of each
+    individual (INDI) and family (FAM) record; a second pass over those summaries resolves the cross-references between
+    them into relations and infers each person's generation from the resulting family tree. The partners (HUSB and
+    WIFE) of a FAM record become the parents of its children, but are only linked as spouses if the record has a MARR
+    event.
+    """
+    def __init__(self, source, encoding="utf-8-sig"):
+        """
+        Create a reader for a GEDCOM file
+        :param source: the path to the file, or an open text file object
+        :param encoding: optional, the encoding to use when opening a path. The default handles UTF-8 with or without a
+        byte order mark.
+        :return: none
+        """
+        self.source = source
+        self.encoding = encoding
+        self.stats = None
+        self._n_lines = 0
+        self._n_malformed = 0
+
+    def _lines(self):
+        """
+        Internal method that iterates over the lines of the source
+        :return: a generator of strings
+        """
+        if hasattr(self.source, "read"):
+            for line in self.source:
+                yield line
+        else:
+            with open(self.source, encoding=self.encoding) as f:
+                for line in f:
+                    yield line
+
+    def iter_records(self):
+        """
+        Parse the file into summaries of its INDI and FAM records, one record at a time
+        :return: a generator of tuples. INDI records give ("INDI", xref, details) where details is a dictionary that may
+        have the keys "gender", "first", "middle", "last", "unmarried_name", "suffix" and "generation". FAM records
+        give ("FAM", xref, (spouse_xrefs, child_xrefs, married)), where married is True if the record has a MARR event.
+        Lines without a level number, and _GEN lines whose value is
+        not a whole number, are skipped and counted as malformed lines (see read).
+        """
+        record = None
+        name = None
+        level1_tag = None
+        n_lines = 0
+        n_malformed = 0
+        for line in self._lines():
+            n_lines += 1
+            try:
+                parsed = parse_line(line)
+            except ValueError:
+                n_malformed += 1
+                continue
+            if parsed is None:
+                continue
+            level, xref, tag, value = parsed
+
+            if level == 0:
+                if record is not None:
+                    yield self._finish_record(record)
+                record = {"type": tag, "xref": xref, "names": [], "spouses": [], "children": []} \
+                    if tag in ("INDI", "FAM") and xref is not None else None
+                name = None
+                continue
+            elif record is None:
+                continue
+
+            if level == 1:
+                level1_tag = tag
+                if tag == "NAME":
+                    name = {"value": value}
+                    record["names"].append(name)
+                elif tag == "SEX":
+                    record["sex"] = value.strip().upper()[:1]
+                elif tag == "_GEN":
+                    try:
+                        record["generation"] = int(value)
+                    except ValueError:
+                        n_malformed += 1
+                elif tag == "_MARNM":
+                    record["married_surname"] = value.strip()
+                elif tag in ("HUSB", "WIFE"):
+                    record["spouses"].append(value.strip())
+                elif tag == "CHIL":
+                    record["children"].append(value.strip())
+                elif tag == "MARR":
+                    record["married"] = True
+            elif level == 2 and level1_tag == "NAME" and name is not None:
+                if tag in ("GIVN", "SURN", "NSFX", "TYPE"):
+                    name[tag] = value.strip()
+                elif tag == "_MARNM":
+                    record["married_surname"] = value.strip()
+
+        if record is not None:
+            yield self._finish_record(record)
+        self._n_lines = n_lines
+        self._n_malformed = n_malformed
+
+    def _finish_record(self, record):
+        """
+        Internal method that turns the raw lines collected for a record into its compact summary
+        :param record: a dictionary of the values collected from the record's lines
+        :return: a tuple, see iter_records
+        """
+        if record["type"] == "FAM":
+            return "FAM", record["xref"], (tuple(record["spouses"]), tuple(record["children"]),
+                                           record.get("married", False))
+
+        details = {"gender": _sex_genders.get(record.get("sex"), neuter)}
+        birth_name = None
+        married_surname = record.get("married_surname")
+        for name in record["names"]:
+            first, middle, surname, suffix = split_name(name["value"])
+            if "GIVN" in name:
+                given = name["GIVN"].split()
+                first, middle = (given[0] if len(given) > 0 else ""), " ".join(given[1:])
+            surname = name.get("SURN", surname)
+            suffix = name.get("NSFX", suffix)
+
+            if name.get("TYPE", "").lower() == "married":
+                married_surname = surname
+            elif birth_name is None:
+                birth_name = (first, middle, surname, suffix)
+
+        if birth_name is not None:
+            details["first"], details["middle"], details["last"], details["suffix"] = birth_name
+        if married_surname and married_surname != details.get("last", ""):
+            details["unmarried_name"] = details.get("last", "")
+            details["last"] = married_surname
+        if "generation" in record:
+            details["generation"] = record["generation"]
+        return "INDI", record["xref"], details
+
+    def read(self, family=None):
+        """
+        Read the whole file into a family. Afterwards the stats attribute holds a dictionary with the number of "lines",
+        "individuals", "families" and "records" read, "malformed_lines" (lines that were skipped, see iter_records),
+        "unresolved_references" (cross-references to records that are not in the file), "seconds",
+        "records_per_second" and "peak_memory_kb" (the peak resident memory of the process as reported by the operating
+        system, or None where that is not available).
+        :param family: optional, an instance of Family to add the people to. If not given, a new one is created.
+        :return: the instance of Family
+        """
+        start = time.time()
+        family = Family() if family is None else family
+
+        people = []
+        edges = []
+        n_families = 0
+        fam_links = []
+        for rec_type, xref, details in self.iter_records():
+            if rec_type == "INDI":
+                details["key"] = xref
+                people.append(details)
+            else:
+                n_families += 1
+                fam_links.append(details)
+
+        # Second pass: resolve the cross-references in the FAM records to relations between the individuals
+        known = set(p["key"] for p in people)
+        unresolved = 0
+        for spouses, children, married in fam_links:
+            resolved_spouses = [s for s in spouses if s in known]
+            resolved_children = [c for c in children if c in known]
+            unresolved += len(spouses) + len(children) - len(resolved_spouses) - len(resolved_children)
+            for i, s in enumerate(resolved_spouses):
+                if married:
+                    for other in resolved_spouses[i+1:]:
+                        edges.append((s, "spouse", other))
+                for c in resolved_children:
+                    edges.append((c, "parent", s))
+        del fam_links
+
+        family.bulk_load(people, edges, validate=False)
+
+        seconds = time.time() - start
+        n_records = len(people) + n_families
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+        self.stats = {"lines": self._n_lines, "individuals": len(people), "families": n_families,
+                      "records": n_records, "malformed_lines": self._n_malformed, "unresolved_references": unresolved,
+                      "seconds": seconds, "records_per_second": n_records / seconds if seconds > 0 else None,
+                      "peak_memory_kb": peak}
+        return family
+
+
+def read_gedcom(source, family=None, encoding="utf-8-sig"):
+    """
+    Read a GEDCOM file into a family; see GedcomReader
+    :param source: the path to the file, or an open text file object
+    :param family: optional, an instance of Family to add the people to. If not given, a new one is created.
+    :param encoding: optional, the encoding to use when opening a path
+    :return: the instance of Family
+    """
+    return GedcomReader(source, encoding=encoding).read(family=family)
+
+
+def _family_units(family, person):
+    """
+    Internal function that works out which GEDCOM family (FAM) records a person is a parent or spouse in. A FAM record
+    is identified by the ids of the parents or spouses in it, so it can be derived from any one of them without a table
+    of all couples: each spouse of the person forms one with them, and the children of the person are grouped by their
+    full set of parents. Parents who are not spouses of each other share a FAM record too, since that is the only way
+    GEDCOM links children to their parents, but it is not marked as a marriage (see _is_marriage).
+    :param family: the instance of Family being written
+    :param person: a member of the family
+    :return: a dictionary mapping each FAM record's tuple of parent/spouse ids (sorted) to the list of its children
+    """
+    units = OrderedDict()
+    for spouse in person.spouses:
+        if spouse in family:
+            units[tuple(sorted((person.id, spouse.id)))] = []
+    for child in person.children:
+        if child in family:
+            parent_ids = _parent_ids(family, child)
+            if parent_ids not in units:
+                units[parent_ids] = []
+            units[parent_ids].append(child)
+    return units
+
+
+def _parent_ids(family, person):
+    """
+    Internal function that gets the sorted ids of those parents of a person who are members of the family
+    :param family: the instance of Family being written
+    :param person: a member of the family
+    :return: a tuple of integers
+    """
+    return tuple(sorted(q.id for q in person.parents if q in family))
+
+
+def _fam_xref(ids):
+    return "@F{0}@".format("_".join(str(i) for i in ids))
+
+
+def _indi_xref(person):
+    return "@I{0}@".format(person.id)
+
+
+def _is_marriage(partners):
+    """
+    Internal function that checks whether the partners in a FAM record are married, i.e. are two people who are spouses
+    of each other. Only such records get a MARR event, which is what read_gedcom links spouses by.
+    :param partners: the partners in the FAM record, a list of instances of Person
+    :return: boolean
+    """
+    return len(partners) == 2 and (partners[1] in partners[0].spouses or partners[0] in partners[1].spouses)
+
+
+def _partner_tags(partners):
+    """
+    Internal function that chooses the tag (HUSB or WIFE) for each partner in a FAM record. GEDCOM expects one of each,
+    so if exactly one of two partners is female she is the WIFE and the other the HUSB; any other couple (two men, two
+    women, or partners of neuter or custom genders) is tagged by position, the first HUSB and the second WIFE. A lone
+    partner is the WIFE if female and the HUSB otherwise.
+    :param partners: the partners in the FAM record, a list of instances of Person ordered by id
+    :return: a list of strings, one for each partner
+    """
+    n_female = sum(1 for p in partners if p.gender is female)
+    if len(partners) == 1 or (len(partners) == 2 and n_female == 1):
+        return ["WIFE" if p.gender is female else "HUSB" for p in partners]
+    return ["HUSB" if i % 2 == 0 else "WIFE" for i in range(len(partners))]
+
+
+def iter_gedcom_lines(family):
+    """
+    Generate the lines of a GEDCOM 5.5 file describing a family. Each member's INDI record is followed by the FAM
+    records of which they are the member with the lowest id, so each FAM record is written exactly once and only the
+    relatives of one person need to be looked at at a time. Relations to people who are not members of the family are
+    left out. The generation of each person is written in a custom _GEN tag, which read_gedcom uses if present. See
+    _partner_tags for how partners are tagged HUSB and WIFE; FAM records of spouses have a MARR event, and those of
+    parents who are not married to each other do not.
+    :param family: an instance of Family
+    :return: a generator of strings, without line endings
+    """
+    yield "0 HEAD"
+    yield "1 SOUR PyGeneology"
+    yield "1 GEDC"
+    yield "2 VERS 5.5"
+    yield "2 FORM LINEAGE-LINKED"
+    yield "1 CHAR UTF-8"
+
+    for person in family:
+        units = _family_units(family, person)
+        surname = person.unmarried_name if len(person.unmarried_name) > 0 else person.last_name
+        given = " ".join(n for n in (person.first_name, person.middle_name) if len(n) > 0)
+
+        yield "0 {0} INDI".format(_indi_xref(person))
+        yield "1 NAME {0} /{1}/ {2}".format(given, surname, person.suffix).strip()
+        if len(given) > 0:
+            yield "2 GIVN {0}".format(given)
+        if len(surname) > 0:
+            yield "2 SURN {0}".format(surname)
+        if len(person.suffix) > 0:
+            yield "2 NSFX {0}".format(person.suffix)
+        if len(person.unmarried_name) > 0:
+            yield "1 NAME {0} /{1}/ {2}".format(given, person.last_name, person.suffix).strip()
+            yield "2 TYPE married"
+        yield "1 SEX {0}".format(_gender_sexes.get(id(person.gender), "U"))
+        yield "1 _GEN {0}".format(person.generation)
+
+        parent_ids = _parent_ids(family, person)
+        if len(parent_ids) > 0:
+            yield "1 FAMC {0}".format(_fam_xref(parent_ids))
+        for ids in units:
+            yield "1 FAMS {0}".format(_fam_xref(ids))
+
+        for ids, children in units.items():
+            if ids[0] != person.id:
+                continue
+            yield "0 {0} FAM".format(_fam_xref(ids))
+            partners = [family.get_member(i) for i in ids]
+            for tag, partner in zip(_partner_tags(partners), partners):
+                yield "1 {0} {1}".format(tag, _indi_xref(partner))
+            if _is_marriage(partners):
+                yield "1 MARR"
+            for child in children:
+                yield "1 CHIL {0}".format(_indi_xref(child))
+
+    yield "0 TRLR"
+
+
+def write_gedcom(family, dest, encoding="utf-8"):
+    """
+    Write a family to a GEDCOM 5.5 file, one line at a time; see iter_gedcom_lines
+    :param family: an instance of Family
+    :param dest: the path to write to, or an open text file object
+    :param encoding: optional, the encoding to use when opening a path
+    :return: the number of lines written
+    """
+    if hasattr(dest, "write"):
+        return _write_lines(family, dest)
+    with open(dest, "w", encoding=encoding) as f:
+        return _write_lines(family, f)
+
+
+def _write_lines(family, f):
+    n_lines = 0
+    for line in iter_gedcom_lines(family):
+        f.write(line)
+        f.write("\n")
+        n_lines += 1
+    return n_lines
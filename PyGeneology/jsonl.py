@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import json
+import time
+
+from .pygenelib import Family, GenError, Person, gender_from_titles, male, female, neuter
+
+"""
+Reading and writing of families as JSON Lines: one JSON object per person, one person per line. Both directions stream
+through generators, so a file can be split into chunks, appended to, or piped between processes, and relations to people
+whose lines come later in the input are resolved as those lines arrive rather than by reading everything up front.
+"""
+
+_genders = {"male": male, "female": female, "neuter": neuter}
+_gender_keys = dict((id(g), k) for k, g in _genders.items())
+_name_keys = (("first", "first_name"), ("middle", "middle_name"), ("last", "last_name"),
+              ("unmarried_name", "unmarried_name"), ("suffix", "suffix"))
+_relation_keys = (("parents", "parent"), ("spouses", "spouse"), ("children", "child"))
+
+
+def person_record(family, person):
+    """
+    Describe one member of a family as a dictionary that can be written as JSON
+    :param family: the instance of Family the person belongs to. Relations to people who are not members are left out.
+    :param person: an instance of Person
+    :return: a dictionary with the keys "id", "gender" (one of "male", "female" or "neuter", or for any other gender a
+    list of its seven titles in the order Gender takes them), "first", "middle", "last", "unmarried_name", "suffix",
+    "generation", "parents", "spouses" and "children" (lists of ids)
+    """
+    gender = _gender_keys.get(id(person.gender))
+    if gender is None:
+        gender = list(person.gender.titles())
+    record = {"id": person.id, "gender": gender}
+    for key, attr in _name_keys:
+        record[key] = getattr(person, attr)
+    record["generation"] = person.generation
+    for key, _ in _relation_keys:
+        record[key] = [p.id for p in getattr(person, key) if p in family]
+    return record
+
+
+def iter_records(family):
+    """
+    Generate one record per member of a family, in the family's order; see person_record
+    :param family: an instance of Family
+    :return: a generator of dictionaries
+    """
+    for person in family:
+        yield person_record(family, person)
+
+
+def iter_lines(family):
+    """
+    Generate the lines of a JSON Lines file describing a family
+    :param family: an instance of Family
+    :return: a generator of strings, without line endings
+    """
+    for record in iter_records(family):
+        yield json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def write_jsonl(family, dest, append=False, encoding="utf-8"):
+    """
+    Write a family to a JSON Lines file, one line at a time
+    :param family: an instance of Family
+    :param dest: the path to write to, or an open text file object
+    :param append: optional, default False. If True and dest is a path, add the lines to the end of the file instead
+    of replacing it. The people in each family written to one file must have different ids.
+    :param encoding: optional, the encoding to use when opening a path
+    :return: the number of lines written
+    """
+    if hasattr(dest, "write"):
+        return _write_lines(iter_lines(family), dest)
+    with open(dest, "a" if append else "w", encoding=encoding) as f:
+        return _write_lines(iter_lines(family), f)
+
+
+def write_jsonl_chunks(family, path_template, chunk_size, encoding="utf-8"):
+    """
+    Write a family to a series of JSON Lines files of at most chunk_size lines each. Together the chunks can be read
+    back by passing their paths, in order, to read_jsonl.
+    :param family: an instance of Family
+    :param path_template: a format string for the path of each chunk, given the chunk number (starting from 0), e.g.
+    "people-{0:04d}.jsonl"
+    :param chunk_size: the maximum number of people in each chunk, a positive integer
+    :param encoding: optional, the encoding to use for the files
+    :return: a list of the paths written
+    """
+    if type(chunk_size) is not int or chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+
+    paths = []
+    f = None
+    try:
+        for i, line in enumerate(iter_lines(family)):
+            if i % chunk_size == 0:
+                if f is not None:
+                    f.close()
+                paths.append(path_template.format(len(paths)))
+                f = open(paths[-1], "w", encoding=encoding)
+            f.write(line)
+            f.write("\n")
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def _write_lines(lines, f):
+    n_lines = 0
+    for line in lines:
+        f.write(line)
+        f.write("\n")
+        n_lines += 1
+    return n_lines
+
+
+class JsonLinesReader(object):
+    """
+    Reads JSON Lines files written by write_jsonl into a Family. Each line is turned into a Person as soon as it is
+    read, and linked straight away to any relatives already read. A relation to an id that has not been seen yet is
+    parked under that id and linked when its line arrives, so only the unresolved references are held rather than the
+    lines themselves.
+    """
+    def __init__(self, sources, encoding="utf-8"):
+        """
+        Create a reader for one or more JSON Lines files
+        :param sources: a path or an open text file object, or a list of them to read one after another as if they were
+        a single file (for example the chunks written by write_jsonl_chunks)
+        :param encoding: optional, the encoding to use when opening paths
+        :return: none
+        """
+        self.sources = sources if isinstance(sources, (list, tuple)) else [sources]
+        self.encoding = encoding
+        self.stats = None
+        self._n_lines = 0
+
+    def _lines(self):
+        """
+        Internal method that iterates over the lines of all the sources
+        :return: a generator of strings
+        """
+        for source in self.sources:
+            if hasattr(source, "read"):
+                for line in source:
+                    yield line
+            else:
+                with open(source, encoding=self.encoding) as f:
+                    for line in f:
+                        yield line
+
+    def iter_records(self):
+        """
+        Parse the sources one line at a time
+        :return: a generator of dictionaries, as described in person_record. Blank lines are skipped.
+        """
+        n_lines = 0
+        for line in self._lines():
+            n_lines += 1
+            if len(line.strip()) == 0:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as err:
+                raise ValueError("Line {0} is not valid JSON: {1}".format(n_lines, err))
+        self._n_lines = n_lines
+
+    def read(self, family=None, validate=True):
+        """
+        Read all the sources into a family. Afterwards the stats attribute holds a dictionary with the number of
+        "lines" and "records" read, "unresolved_references" (relations to ids that no line describes), "seconds" and
+        "records_per_second".
+        :param family: optional, an instance of Family to add the people to. If not given, a new one is created.
+        :param validate: optional, default True. If True, raise a GenError if any parent is not exactly one generation
+        before their child or any spouses are in different generations, as Person.add_parent etc. would.
+        :return: the instance of Family
+        """
+        start = time.time()
+        family = Family() if family is None else family
+
+        people = dict()
+        order = []
+        pending = dict()
+        custom_genders = dict()
+        for record in self.iter_records():
+            person = self._make_person(record, custom_genders)
+            file_id = record["id"]
+            if file_id in people:
+                raise ValueError("Duplicate id {0}".format(file_id))
+            people[file_id] = person
+            order.append(person)
+
+            for other, relation in pending.pop(file_id, ()):
+                _link(other, relation, person, validate)
+            for key, relation in _relation_keys:
+                for other_id in record.get(key, ()):
+                    if other_id in people:
+                        _link(person, relation, people[other_id], validate)
+                    else:
+                        pending.setdefault(other_id, []).append((person, relation))
+
+        # People are only added once all their relations are linked, so the family's indices are built in one go
+        for person in order:
+            family.add_member(person)
+
+        seconds = time.time() - start
+        self.stats = {"lines": self._n_lines, "records": len(order),
+                      "unresolved_references": sum(len(refs) for refs in pending.values()), "seconds": seconds,
+                      "records_per_second": len(order) / seconds if seconds > 0 else None}
+        return family
+
+    @staticmethod
+    def _make_person(record, custom_genders):
+        """
+        Internal method that creates the Person described by a record, without any relations
+        :param record: a dictionary, see person_record
+        :param custom_genders: a dictionary of the genders given as lists of titles so far, by their titles, so that
+        everyone with the same titles shares one Gender
+        :return: a new instance of Person
+        """
+        if "id" not in record:
+            raise ValueError("Record has no id")
+        if record.get("generation") is None:
+            raise ValueError("Record {0} has no generation".format(record["id"]))
+
+        gender = record.get("gender", "neuter")
+        if isinstance(gender, list):
+            gender = gender_from_titles(gender, custom_genders)
+        elif gender in _genders:
+            gender = _genders[gender]
+        else:
+            raise ValueError("Gender {0} of record {1} not recognized".format(gender, record["id"]))
+
+        names = tuple(record.get(key, "") for key, _ in _name_keys)
+        for (key, _), name in zip(_name_keys, names):
+            if type(name) is not str:
+                raise TypeError("{0} must be str, if given".format(key))
+        return Person._from_details(gender, names, record["generation"])
+
+
+def _link(person, relation, other, validate):
+    """
+    Internal function that links two people read from a file in both directions, unless they already are
+    :param person: an instance of Person
+    :param relation: "parent", "spouse" or "child": what other is to person
+    :param other: an instance of Person
+    :param validate: if True, raise a GenError if the generations of the two people do not fit the relation
+    :return: none
+    """
+    if relation == "child":
+        person, other, relation = other, person, "parent"
+
+    if relation == "parent":
+        if other in person.parents:
+            return
+        if validate and person.generation != other.generation + 1:
+            raise GenError("Generation of parent {0} is not one less than child {1}".format(other, person))
+        person.parents.append(other)
+        other.children.append(person)
+    else:
+        if other in person.spouses:
+            return
+        if validate and person.generation != other.generation:
+            raise GenError("Generation of spouse {0} is not equal to {1}".format(other, person))
+        person.spouses.append(other)
+        other.spouses.append(person)
+
+
+def read_jsonl(sources, family=None, encoding="utf-8", validate=True):
+    """
+    Read one or more JSON Lines files into a family; see JsonLinesReader
+    :param sources: a path or an open text file object, or a list of them
+    :param family: optional, an instance of Family to add the people to. If not given, a new one is created.
+    :param encoding: optional, the encoding to use when opening paths
+    :param validate: optional, see JsonLinesReader.read
+    :return: the instance of Family
+    """
+    return JsonLinesReader(sources, encoding=encoding).read(family=family, validate=validate)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import heapq
+
+from .pygenelib import Person, GenError
+
+"""
+Kinship and inbreeding coefficients. The kinship coefficient of two people is the probability that an allele picked
+at random from each of them is identical by descent; the inbreeding coefficient of a person is the kinship of their
+parents. Unlike the relationship labels, these count every line of descent, so they reflect pedigree collapse.
+
+Coefficients are computed with the usual recurrence, sweeping through the family parents first: for a person i with
+parents f and m (a parent missing from the family counts as unrelated to everyone),
+
+    kinship(i, i) = (1 + kinship(f, m)) / 2
+    kinship(i, j) = (kinship(f, j) + kinship(m, j)) / 2    for anyone j already swept
+
+Each person's kinships are kept as a sparse row holding only their non-zero entries, and a row is dropped as soon as
+all of that person's children have been swept. Rows only keep entries for people whose rows are still held or who
+were asked about, so the memory used depends on how many people are "open" at once (roughly the width of a
+generation) and on the number of people asked about, rather than on the square of the family's size. This is done in
+pure Python with dictionaries rather than dense matrices, since the rows of a real family are very sparse.
+"""
+
+
+def _sweep_order(family):
+    """
+    Internal function that orders the members of a family so that everyone comes after their parents: by generation,
+    but with a topological sort so that a family whose generations are inconsistent is still swept correctly
+    :param family: an instance of Family
+    :return: a generator of (person, member_parents, n_member_children) tuples. Raises a GenError if anyone has more
+    than two parents in the family, or if the parent relations form a loop.
+    """
+    members = list(family)
+    position = dict((p.id, k) for k, p in enumerate(members))
+    # Children are found from the children's own parents rather than from Person.children, so that the two always
+    # agree even if a link has only been removed from one side (see Person.remove_relation)
+    member_parents = []
+    member_children = dict()
+    heap = []
+    for k, p in enumerate(members):
+        parents = [q for q in p.parents if q.id in position]
+        if len(parents) > 2:
+            raise GenError("{0} ({1}) has more than two parents".format(p.fullname(), p))
+        member_parents.append(parents)
+        for q in parents:
+            member_children.setdefault(q.id, []).append(p)
+        if len(parents) == 0:
+            heapq.heappush(heap, (p.generation, k))
+    waiting = dict((p.id, len(member_parents[k])) for k, p in enumerate(members) if len(member_parents[k]) > 0)
+
+    n_swept = 0
+    while len(heap) > 0:
+        _, k = heapq.heappop(heap)
+        p = members[k]
+        n_swept += 1
+        children = member_children.get(p.id, ())
+        for c in children:
+            waiting[c.id] -= 1
+            if waiting[c.id] == 0:
+                del waiting[c.id]
+                heapq.heappush(heap, (c.generation, position[c.id]))
+        yield p, member_parents[k], len(children)
+
+    if n_swept < len(members):
+        raise GenError("The family contains a loop of parent relations")
+
+
+def _sweep_kinship(family, targets):
+    """
+    Internal function that sweeps a family computing kinship rows; see the module documentation
+    :param family: an instance of Family
+    :param targets: a set of the ids of the people whose kinships with each other are wanted, or None for everyone
+    :return: a generator of (person, self_kinship, row) tuples, one per member in sweep order. row maps the ids of
+    people swept earlier that are open or in targets to their non-zero kinship with person.
+    """
+    # The rows of the people still open, i.e. with children yet to be swept. Rows are kept symmetric between open
+    # people, since a child needs its parents' kinship with everyone swept before it, including people swept after
+    # the parents themselves.
+    rows = dict()
+    remaining_children = dict()
+
+    for person, parents, n_children in _sweep_order(family):
+        pid = person.id
+        row = dict()
+        for parent in parents:
+            for j, coefficient in rows[parent.id].items():
+                if j in rows or targets is None or j in targets:
+                    row[j] = row.get(j, 0.0) + coefficient / 2
+        self_kinship = (1 + rows[parents[0].id].get(parents[1].id, 0.0)) / 2 if len(parents) == 2 else 0.5
+        yield person, self_kinship, row
+
+        for parent in parents:
+            remaining_children[parent.id] -= 1
+            if remaining_children[parent.id] == 0:
+                _close(parent.id, rows, remaining_children, targets)
+        if n_children > 0 or targets is None or pid in targets:
+            for j, coefficient in row.items():
+                if j in rows:
+                    rows[j][pid] = coefficient
+        if n_children > 0:
+            row[pid] = self_kinship
+            rows[pid] = row
+            remaining_children[pid] = n_children
+
+
+def iter_kinship(family, people=None):
+    """
+    Compute the kinship coefficients among a group of members of a family
+    :param family: an instance of Family
+    :param people: optional, an iterable of members of the family. By default, every member.
+    :return: a generator of (person, other, coefficient) tuples covering every pair of the given people with a
+    non-zero coefficient once (in either order), including each person paired with themself. People are produced in an
+    order in which everyone comes after their parents.
+    """
+    targets = None if people is None else set(p.id for p in people)
+    swept = dict()
+    for person, self_kinship, row in _sweep_kinship(family, targets):
+        if targets is None or person.id in targets:
+            swept[person.id] = person
+            yield person, person, self_kinship
+            for j, coefficient in row.items():
+                if j in swept:
+                    yield person, swept[j], coefficient
+
+
+def _close(pid, rows, remaining_children, targets):
+    """
+    Internal function that drops the row of a person whose children have all been swept. Unless the person was asked
+    about, their entries in the rows of other open people are no longer needed either.
+    """
+    row = rows.pop(pid)
+    del remaining_children[pid]
+    if targets is not None and pid not in targets:
+        for j in row:
+            if j in rows:
+                rows[j].pop(pid, None)
+
+
+def kinship_coefficients(family, people=None):
+    """
+    Compute the kinship coefficients among a group of members of a family; see iter_kinship
+    :param family: an instance of Family
+    :param people: optional, an iterable of members of the family. By default, every member.
+    :return: a dictionary mapping (id, other_id) tuples to coefficients, with id <= other_id. Pairs that are missing
+    have a coefficient of zero.
+    """
+    coefficients = dict()
+    for person, other, coefficient in iter_kinship(family, people):
+        key = (person.id, other.id) if person.id <= other.id else (other.id, person.id)
+        coefficients[key] = coefficient
+    return coefficients
+
+
+def kinship(family, person, other):
+    """
+    Compute the kinship coefficient of two members of a family
+    :param family: an instance of Family
+    :param person: an instance of Person
+    :param other: an instance of Person
+    :return: the coefficient, a float between 0 and 1
+    """
+    if not isinstance(person, Person) or not isinstance(other, Person):
+        raise TypeError("person and other must be instances of Person")
+    key = (person.id, other.id) if person.id <= other.id else (other.id, person.id)
+    return kinship_coefficients(family, [person, other]).get(key, 0.0)
+
+
+def inbreeding_coefficients(family, people=None):
+    """
+    Compute the inbreeding coefficients of members of a family, i.e. the kinship of each person's parents
+    :param family: an instance of Family
+    :param people: optional, an iterable of members of the family. By default, every member.
+    :return: a dictionary mapping each person's id to their coefficient
+    """
+    wanted = None if people is None else set(p.id for p in people)
+    coefficients = dict()
+    # Only each person's own kinship is needed, so no rows need to be kept beyond the open people
+    for person, self_kinship, row in _sweep_kinship(family, set()):
+        if wanted is None or person.id in wanted:
+            coefficients[person.id] = 2 * self_kinship - 1
+    return coefficients
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+from itertools import islice
+import multiprocessing
+import os
+import tempfile
+
+from .pygenelib import Person
+from .snapshot import open_snapshot, write_snapshot
+
+"""
+Computing relationships for large batches of pairs of people across a pool of processes. Rather than pickling Person
+objects and their relatives for every task, the family is written once to a snapshot file (see snapshot.py), which
+each worker memory-maps when it starts; the operating system shares the mapped pages between the workers. Tasks are
+then just chunks of pairs of ids, and come back as lists of labels.
+"""
+
+# The family each worker process answers queries from, opened by _init_worker
+_worker_family = None
+
+
+def _init_worker(path, cache_size, build_index):
+    global _worker_family
+    _worker_family = open_snapshot(path, cache_size=cache_size)
+    if build_index:
+        _worker_family.build_ancestry_index()
+
+
+def _member(person_id):
+    person = _worker_family.get_member(person_id)
+    if person is None:
+        raise KeyError("Person id {0} is not a member of the family".format(person_id))
+    return person
+
+
+def _relationship_chunk(chunk):
+    """
+    Internal function run in the workers to find the relationships of one chunk of pairs
+    :param chunk: a list of (base_id, other_id) tuples
+    :return: a list of strings, one per pair
+    """
+    return [_worker_family.get_relationship(_member(b), _member(o)) for b, o in chunk]
+
+
+def _id_chunks(pairs, chunk_size):
+    """
+    Internal function that splits pairs of people (or ids) into lists of pairs of ids
+    :param pairs: an iterable of (base, other) tuples of instances of Person or ids
+    :param chunk_size: the number of pairs in each chunk
+    :return: a generator of lists
+    """
+    pairs = iter(pairs)
+    while True:
+        chunk = [(b.id if isinstance(b, Person) else b, o.id if isinstance(o, Person) else o)
+                 for b, o in islice(pairs, chunk_size)]
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def iter_batch_relationships(family, pairs, processes=None, chunk_size=1000, progress=None, cache_size=1024,
+                             build_index=False):
+    """
+    Find the relationship of other to base (as get_relationship would) for every (base, other) pair, using a pool of
+    worker processes. Pairs are read and handed out in chunks as the workers need them, and results are produced in
+    the same order as the pairs as soon as each chunk is done, so neither has to fit in memory at once.
+    :param family: the instance of Family the people belong to, or the path to a snapshot of it (see write_snapshot).
+    A family is written to a temporary snapshot, which is removed when the iteration finishes.
+    :param pairs: an iterable of (base, other) tuples; each may be an instance of Person or a person id
+    :param processes: optional, the number of worker processes; by default one per CPU
+    :param chunk_size: optional, the number of pairs in each task
+    :param progress: optional, a function called after each chunk with the number of pairs done so far and the total
+    number of pairs (or None if pairs has no length)
+    :param cache_size: optional, the size of each worker's relationship cache, see Family
+    :param build_index: optional, default False. If True, each worker builds an ancestry index when it starts (see
+    Family.build_ancestry_index), which pays off for very large batches.
+    :return: a generator of strings
+    """
+    if type(chunk_size) is not int or chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+    total = len(pairs) if hasattr(pairs, "__len__") else None
+
+    temp_path = None
+    if isinstance(family, str):
+        path = family
+    else:
+        fd, temp_path = tempfile.mkstemp(suffix=".snap")
+        os.close(fd)
+        path = temp_path
+
+    try:
+        if temp_path is not None:
+            write_snapshot(family, temp_path)
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(path, cache_size, build_index)) \
+                as pool:
+            done = 0
+            for labels in pool.imap(_relationship_chunk, _id_chunks(pairs, chunk_size)):
+                done += len(labels)
+                for label in labels:
+                    yield label
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+
+def batch_relationships(family, pairs, processes=None, chunk_size=1000, progress=None, cache_size=1024,
+                        build_index=False):
+    """
+    Find the relationships for every (base, other) pair using a pool of worker processes; see
+    iter_batch_relationships for the parameters
+    :return: a list of strings, in the same order as pairs
+    """
+    return list(iter_batch_relationships(family, pairs, processes=processes, chunk_size=chunk_size, progress=progress,
+                                         cache_size=cache_size, build_index=build_index))
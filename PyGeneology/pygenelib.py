@@ -1,37 +1,635 @@
 #!/usr/bin/env python3
 from jllutils import numtostr
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+import heapq
+import sys
+import time
 import pdb
 
 """
 TODO:
 -- get relationship names
--- handle in-law relations
 -- add nicknames
--- more flexible search (substring or any name)
 -- figure out how to handle adoption
 -- figure out how to deal with multiple spouses (due to divorce or death)
 -- include lifespans?
 """
 
 
+# The links followed by Family.iter_neighborhood and relationship_path: the name of each relation and the Person
+# attribute holding it, and the relation that is the other way round
+_neighbor_links = (("parent", "parents"), ("spouse", "spouses"), ("child", "children"))
+_inverse_relations = {"parent": "child", "spouse": "spouse", "child": "parent"}
+
+
 class GenError(Exception):
     pass
 
 
+class NameIndex(object):
+    """
+    A case-insensitive inverted index over the name fields of a collection of Person instances. Each field maps the
+    case-folded value of that field to the ids of the people who have it, and the distinct values of each field are in
+    turn indexed by their character n-grams so that prefix and substring searches only need to check the values that
+    contain every n-gram of the query.
+    """
+    fields = ("first_name", "middle_name", "last_name", "unmarried_name", "suffix")
+    modes = ("exact", "prefix", "substring")
+    gram_size = 3
+
+    # Marks the start and end of a value when splitting it into n-grams, so that prefixes get their own n-grams
+    _start = "\x02"
+    _end = "\x03"
+
+    def __init__(self):
+        """
+        Create an empty name index
+        :return: none
+        """
+        self._postings = dict((f, dict()) for f in self.fields)
+        self._grams = dict((f, dict()) for f in self.fields)
+
+    def add(self, person):
+        """
+        Add all the names of the given person to the index
+        :param person: an instance of Person
+        :return: none
+        """
+        for field in self.fields:
+            self._add_value(field, getattr(person, field), person.id)
+
+    def remove(self, person):
+        """
+        Remove all the names of the given person from the index
+        :param person: an instance of Person
+        :return: none
+        """
+        for field in self.fields:
+            self._remove_value(field, getattr(person, field), person.id)
+
+    def update(self, person, field, old_value, new_value):
+        """
+        Update the index after one of the given person's names changed
+        :param person: the instance of Person that was renamed
+        :param field: which name changed, one of NameIndex.fields
+        :param old_value: the previous value of that name, as a string
+        :param new_value: the new value of that name, as a string
+        :return: none
+        """
+        self._remove_value(field, old_value, person.id)
+        self._add_value(field, new_value, person.id)
+
+    def lookup(self, field, value, mode="exact"):
+        """
+        Find the ids of the people whose name in the given field matches the value. The returned set may be shared with
+        the index, so it must not be modified.
+        :param field: which name to search, one of NameIndex.fields
+        :param value: the name to search for, as a string. Matching is case-insensitive.
+        :param mode: optional, one of "exact" (the default; the whole name must match), "prefix" (the name must start
+        with value) or "substring" (the name must contain value)
+        :return: a set of person ids
+        """
+        key = value.casefold()
+        postings = self._postings[field]
+        if mode == "exact":
+            return postings.get(key, frozenset())
+        elif mode == "prefix":
+            query = self._start + key
+            matches = lambda v: v.startswith(key)
+        elif mode == "substring":
+            query = key
+            matches = lambda v: key in v
+        else:
+            raise ValueError("mode must be one of {0}".format(", ".join(self.modes)))
+
+        candidates = self._candidate_values(field, query)
+        ids = set()
+        for v in candidates:
+            if matches(v):
+                ids.update(postings[v])
+        return ids
+
+    def search(self, criteria, mode="exact"):
+        """
+        Find the ids of the people matching every one of the given names. The per-field matches are intersected
+        smallest first, so the cost depends on the size of the smallest match rather than on the size of the index.
+        :param criteria: a dictionary mapping fields (from NameIndex.fields) to the value to search for in that field
+        :param mode: optional, one of NameIndex.modes, see lookup()
+        :return: a set of person ids
+        """
+        matches = sorted((self.lookup(f, v, mode=mode) for f, v in criteria.items()), key=len)
+        if len(matches) == 0:
+            return set()
+
+        result = set(matches[0])
+        for m in matches[1:]:
+            if len(result) == 0:
+                break
+            result.intersection_update(m)
+        return result
+
+    def _grams_of(self, text):
+        """
+        Internal method that splits a string into its (overlapping) n-grams
+        :param text: the string to split
+        :return: a set of strings
+        """
+        n = self.gram_size
+        return set(text[i:i+n] for i in range(len(text) - n + 1))
+
+    def _candidate_values(self, field, query):
+        """
+        Internal method that finds the distinct values of a field that contain every n-gram of the query. If the query
+        is too short to have any n-grams, all values of the field are candidates.
+        :param field: one of NameIndex.fields
+        :param query: the query string, already case-folded
+        :return: an iterable of case-folded values
+        """
+        grams = self._grams[field]
+        postings = [grams.get(g, frozenset()) for g in self._grams_of(query)]
+        if len(postings) == 0:
+            return self._postings[field].keys()
+
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+        return candidates
+
+    def _add_value(self, field, value, person_id):
+        key = value.casefold()
+        postings = self._postings[field]
+        if key not in postings:
+            postings[key] = set()
+            grams = self._grams[field]
+            for g in self._grams_of(self._start + key + self._end):
+                if g not in grams:
+                    grams[g] = set()
+                grams[g].add(key)
+        postings[key].add(person_id)
+
+    def _remove_value(self, field, value, person_id):
+        key = value.casefold()
+        postings = self._postings[field]
+        postings[key].discard(person_id)
+        if len(postings[key]) > 0:
+            return
+
+        del postings[key]
+        grams = self._grams[field]
+        for g in self._grams_of(self._start + key + self._end):
+            grams[g].discard(key)
+            if len(grams[g]) == 0:
+                del grams[g]
+
+
+class AncestryIndex(object):
+    """
+    Precomputed ancestor sets for a group of people. Every person (and every one of their ancestors) is given a dense
+    integer index, ordered by generation, and the set of each person's ancestors is stored as a bitset in a Python
+    integer, where bit i is set if the person with index i is an ancestor. Checking whether one person is an ancestor of
+    another is then a single bit test, and the common ancestors of two people are the intersection of their bitsets.
+
+    The index is a snapshot: it does not follow later changes to the relations of the people in it. Family takes care
+    of discarding its index when relations or members change.
+    """
+    def __init__(self, people):
+        """
+        Build the index for the given people and all of their ancestors
+        :param people: an iterable of instances of Person
+        :return: none
+        """
+        everyone = dict()
+        to_visit = list(people)
+        while len(to_visit) > 0:
+            p = to_visit.pop()
+            if p.id not in everyone:
+                everyone[p.id] = p
+                to_visit.extend(p.parents)
+
+        self.people = sorted(everyone.values(), key=lambda p: (p.generation, p.id))
+        self.index_of = dict((p.id, i) for i, p in enumerate(self.people))
+
+        # Since people are ordered by generation, each generation occupies a contiguous range of indices
+        self._gen_start = dict()
+        for i, p in enumerate(self.people):
+            if p.generation not in self._gen_start:
+                self._gen_start[p.generation] = i
+
+        self._ancestors = [None] * len(self.people)
+        for i in range(len(self.people)):
+            self._compute_ancestors(i)
+
+    def _compute_ancestors(self, i):
+        """
+        Internal method that computes the ancestor bitset of the person with index i, after first computing those of
+        any of their ancestors that have not been done yet. Normally parents come before their children in generation
+        order and have already been done; this only needs to go further when generations are mixed.
+        :param i: the index of the person
+        :return: none
+        """
+        ancestors = self._ancestors
+        in_progress = set()
+        to_do = [(i, False)]
+        while len(to_do) > 0:
+            j, parents_done = to_do.pop()
+            if ancestors[j] is not None:
+                continue
+
+            parent_indices = [self.index_of[q.id] for q in self.people[j].parents]
+            if parents_done:
+                bits = 0
+                for k in parent_indices:
+                    bits |= ancestors[k] | (1 << k)
+                ancestors[j] = bits
+                in_progress.discard(j)
+            else:
+                in_progress.add(j)
+                to_do.append((j, True))
+                for k in parent_indices:
+                    if ancestors[k] is None:
+                        if k in in_progress:
+                            raise GenError("{0} is their own ancestor".format(self.people[k]))
+                        to_do.append((k, False))
+
+    def __contains__(self, person):
+        """
+        Check if the given person is in the index
+        :param person: an instance of Person
+        :return: boolean
+        """
+        return person.id in self.index_of
+
+    def ancestor_bits(self, person):
+        """
+        Get the ancestor bitset of the given person
+        :param person: an instance of Person in the index
+        :return: an integer whose bit i is set if self.people[i] is an ancestor of person
+        """
+        return self._ancestors[self.index_of[person.id]]
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Check if one person is an ancestor of another
+        :param ancestor: an instance of Person in the index
+        :param descendant: an instance of Person in the index
+        :return: boolean
+        """
+        return (self.ancestor_bits(descendant) >> self.index_of[ancestor.id]) & 1 == 1
+
+    def people_in_bits(self, bits):
+        """
+        List the people whose bits are set in a bitset
+        :param bits: a bitset, as an integer
+        :return: a list of instances of Person, in index order
+        """
+        result = []
+        while bits:
+            lowest = bits & -bits
+            result.append(self.people[lowest.bit_length() - 1])
+            bits ^= lowest
+        return result
+
+    def nearest_in_bits(self, bits):
+        """
+        Find the people in the youngest generation present in a bitset
+        :param bits: a bitset, as an integer
+        :return: a list of instances of Person, in index order
+        """
+        if bits == 0:
+            return []
+        generation = self.people[bits.bit_length() - 1].generation
+        start = self._gen_start[generation]
+        return self.people_in_bits((bits >> start) << start)
+
+    def common_ancestors(self, member1, member2):
+        """
+        Find the nearest common ancestors of two people in the index, with the same meaning as
+        Family.common_ancestors, but from the intersection of their ancestor bitsets
+        :param member1: an instance of Person in the index
+        :param member2: an instance of Person in the index
+        :return: a list of instances of Person, in index order
+        """
+        if member1.generation <= member2.generation:
+            older, younger = member1, member2
+        else:
+            older, younger = member2, member1
+
+        if older.generation != younger.generation and self.is_ancestor(older, younger):
+            return [older]
+        return self.nearest_in_bits(self.ancestor_bits(younger) & self.ancestor_bits(older))
+
+
+class RelationshipCache(object):
+    """
+    A least-recently-used cache of query results that depend on the relations of two people. Each entry is stored with
+    the version numbers the two people had when it was computed; if either version has changed since, the entry is
+    stale and is treated as a miss. This way a change to the family only invalidates the entries for the people it
+    actually affects.
+
+    Family learns of every change to the relations of its members, whichever of the two people it was made on (so
+    nonmember.remove_relation(member) is seen too). A relation added or removed between two people who are both not
+    members (for example, ancestors of members that were never added to the family) is not seen, and entries that
+    depend on it are not invalidated; call Family.clear_cache after such an edit.
+    """
+    def __init__(self, maxsize=1024):
+        """
+        Create an empty cache
+        :param maxsize: optional, the maximum number of entries to keep. Once full, the least recently used entry is
+        evicted to make room for a new one.
+        :return: none
+        """
+        if not isinstance(maxsize, int) or maxsize < 1:
+            raise ValueError("maxsize must be a positive integer")
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, versions):
+        """
+        Look up an entry
+        :param key: the key of the entry, any hashable value
+        :param versions: the current versions of the people the entry depends on, as a tuple
+        :return: a tuple (found, value); value is None if found is False
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        elif entry[0] != versions:
+            self.invalidations += 1
+            self.misses += 1
+            del self._entries[key]
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, versions, value):
+        """
+        Add or replace an entry
+        :param key: the key of the entry, any hashable value
+        :param versions: the current versions of the people the entry depends on, as a tuple
+        :param value: the value to store
+        :return: none
+        """
+        self._entries[key] = (versions, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries from the cache, without resetting the statistics
+        :return: none
+        """
+        self._entries.clear()
+
+    def stats(self):
+        """
+        Get statistics about the use of the cache
+        :return: a dictionary with keys "hits", "misses", "evictions", "invalidations", "size" and "maxsize"
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+class QueryInstrumentation(object):
+    """
+    Statistics about the queries made on a family, collected while instrumentation is turned on (see
+    Family.enable_instrumentation). For each instrumented method it records the number of calls and of calls that
+    raised an error, a histogram of their latencies, and the work they did: the number of people visited and the
+    number of generations walked. Work done by a nested call (such as the common_ancestors call made by
+    get_relationship) counts towards both calls.
+    """
+    methods = ("search_by_name", "ancestors_in_generation", "common_ancestors", "get_relationship")
+    # Upper bounds, in seconds, of the latency histogram buckets, from 1 microsecond to 10 seconds; the last bucket
+    # holds everything slower
+    latency_buckets = tuple(m * 10 ** e for e in range(-6, 1) for m in (1e0, 2e0, 5e0)) + (10.0,)
+
+    def __init__(self, callback=None):
+        """
+        Create an empty set of statistics
+        :param callback: optional, a function called after every instrumented call with a dictionary with the keys
+        "method", "seconds", "persons_visited", "generations_walked" and "error" (the exception raised, or None)
+        :return: none
+        """
+        self.callback = callback
+        self._work = [0, 0]
+        self._stats = dict()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all the statistics collected so far
+        :return: none
+        """
+        self._stats = dict((m, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                "histogram": [0] * (len(self.latency_buckets) + 1), "persons_visited": 0,
+                                "generations_walked": 0}) for m in self.methods)
+
+    def add_work(self, persons, generations):
+        """
+        Count work done by the query running now. Called by the query methods themselves.
+        :param persons: the number of people visited
+        :param generations: the number of generations walked
+        :return: none
+        """
+        self._work[0] += persons
+        self._work[1] += generations
+
+    def wrap(self, method, func):
+        """
+        Make an instrumented version of a function
+        :param method: the name of the method, one of QueryInstrumentation.methods
+        :param func: the function to wrap, usually a bound method
+        :return: the wrapped function
+        """
+        def instrumented(*args, **kwargs):
+            persons, generations = self._work
+            error = None
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                error = err
+                raise
+            finally:
+                self.record(method, time.perf_counter() - start, self._work[0] - persons,
+                            self._work[1] - generations, error)
+        instrumented.__name__ = method
+        instrumented.__doc__ = func.__doc__
+        return instrumented
+
+    def record(self, method, seconds, persons, generations, error=None):
+        """
+        Record one call of a method
+        :param method: the name of the method
+        :param seconds: how long the call took
+        :param persons: the number of people visited during the call
+        :param generations: the number of generations walked during the call
+        :param error: optional, the exception raised by the call, if any
+        :return: none
+        """
+        stats = self._stats[method]
+        stats["calls"] += 1
+        if error is not None:
+            stats["errors"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["histogram"][bisect_left(self.latency_buckets, seconds)] += 1
+        stats["persons_visited"] += persons
+        stats["generations_walked"] += generations
+        if self.callback is not None:
+            self.callback({"method": method, "seconds": seconds, "persons_visited": persons,
+                           "generations_walked": generations, "error": error})
+
+    def snapshot(self):
+        """
+        Get a copy of the statistics collected so far
+        :return: a dictionary mapping each method name to a dictionary with the keys "calls", "errors",
+        "total_seconds", "mean_seconds", "max_seconds", "histogram" (a list of (upper_bound, count) tuples, the last
+        upper bound being None), "persons_visited" and "generations_walked"
+        """
+        snap = dict()
+        for method, stats in self._stats.items():
+            copy = dict(stats)
+            copy["mean_seconds"] = stats["total_seconds"] / stats["calls"] if stats["calls"] > 0 else None
+            copy["histogram"] = list(zip(self.latency_buckets + (None,), stats["histogram"]))
+            snap[method] = copy
+        return snap
+
+
 class Family(object):
     """
     A Family object is a collection of Person objects; it contains methods to identify relationships between family
     members. However, it does so based on the properties of the Person instances added to it, it does not itself
     contain that information.
     """
-    def __init__(self):
+    def __init__(self, cache_size=1024):
         """
         Instantiates an empty Family object.
+        :param cache_size: optional, the number of results of common_ancestors and get_relationship to remember (see
+        RelationshipCache). Set to 0 to turn off caching.
         :return: none.
         """
-        self.members = []
+        self._members = dict()
+        self._member_order = dict()
+        self._next_member_order = 0
+        self._generations = dict()
+        self._name_index = NameIndex()
+        self.last_common_ancestor_stats = None
+        self.last_merge_stats = None
+        self._ancestry_index = None
+        self._ancestry_index_current = False
         self.oldest_generation = None
 
+        # The version of the family is increased every time its members or their relations change; the version of each
+        # person is increased whenever something their relationships depend on changes, i.e. their own ancestry.
+        self.version = 0
+        self._person_versions = dict()
+        self._relationship_cache = RelationshipCache(cache_size) if cache_size > 0 else None
+        self._instrumentation = None
+        # See enable_descendant_counts
+        self._descendant_counts = None
+        self._one_sided_links = set()
+        # The last parent/child link whose change was handled, and its state; see _relation_changed
+        self._last_link_state = None
+
+    def enable_instrumentation(self, callback=None):
+        """
+        Start collecting statistics about the queries made on this family (see QueryInstrumentation). The query
+        methods are replaced by instrumented versions on this instance only, so a family without instrumentation pays
+        nothing for it.
+        :param callback: optional, a function to call after each query, see QueryInstrumentation
+        :return: the QueryInstrumentation collecting the statistics
+        """
+        self.disable_instrumentation()
+        self._instrumentation = QueryInstrumentation(callback=callback)
+        for method in QueryInstrumentation.methods:
+            setattr(self, method, self._instrumentation.wrap(method, getattr(self, method)))
+        return self._instrumentation
+
+    def disable_instrumentation(self):
+        """
+        Stop collecting query statistics and go back to the uninstrumented query methods
+        :return: none
+        """
+        if self._instrumentation is None:
+            return
+        for method in QueryInstrumentation.methods:
+            delattr(self, method)
+        self._instrumentation = None
+
+    def query_stats(self):
+        """
+        Get the query statistics collected since instrumentation was enabled
+        :return: a dictionary (see QueryInstrumentation.snapshot), or None if instrumentation is not enabled
+        """
+        if self._instrumentation is None:
+            return None
+        return self._instrumentation.snapshot()
+
+    def _add_query_work(self, persons, generations):
+        """
+        Internal method that lets the instrumentation, if enabled, know how much work a query did
+        :param persons: the number of people visited
+        :param generations: the number of generations walked
+        :return: none
+        """
+        if self._instrumentation is not None:
+            self._instrumentation.add_work(persons, generations)
+
+    @property
+    def members(self):
+        """
+        The members of the family, in the order they were added. This is a new list each time it is accessed, so use
+        "person in family" rather than "person in family.members" for membership tests.
+        :return: a list of instances of Person
+        """
+        return list(self._members.values())
+
+    def __contains__(self, person):
+        """
+        Check if the given person is a member of this family. Membership is determined by the person's id, so this is
+        a constant-time check.
+        :param person: an instance of Person
+        :return: boolean
+        """
+        return isinstance(person, Person) and person.id in self._members
+
+    def __iter__(self):
+        """
+        Iterate over the members of the family in the order they were added.
+        :return: an iterator over instances of Person
+        """
+        return iter(self._members.values())
+
+    def __len__(self):
+        """
+        The number of members in the family
+        :return: an integer
+        """
+        return len(self._members)
+
+    def get_member(self, person_id):
+        """
+        Look up a member of the family by their id.
+        :param person_id: the id of the person, as an integer
+        :return: the instance of Person with that id, or None if no such person is a member of this family
+        """
+        return self._members.get(person_id)
+
     def add_member(self, person):
         """
         Add a member to the family. Adding a person to the family does not inherently indicate any relationships, those
@@ -39,12 +637,158 @@ class Family(object):
         :param person:
         :return: none.
         """
-        self.members.append(person)
-        if self.oldest_generation is None:
-            self.oldest_generation = person.generation
-        elif person.generation < self.oldest_generation:
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of Person")
+        elif person.id in self._members:
+            raise ValueError("{0} ({1}) is already a member".format(person.fullname(), person))
+
+        self._members[person.id] = person
+        self._member_order[person.id] = self._next_member_order
+        self._next_member_order += 1
+        self._add_to_generation(person)
+        self._name_index.add(person)
+        person._families.append(self)
+        self._ancestry_index_current = False
+        self._bump_versions([person])
+
+    def _add_to_generation(self, person):
+        """
+        Internal method that files a person under their generation in the generation index
+        :param person: the instance of Person to add
+        :return: none
+        """
+        if person.generation not in self._generations:
+            self._generations[person.generation] = dict()
+        self._generations[person.generation][person.id] = person
+
+        if self.oldest_generation is None or person.generation < self.oldest_generation:
             self.oldest_generation = person.generation
 
+    def _remove_from_generation(self, person):
+        """
+        Internal method that removes a person from the generation index, dropping their generation entirely if they
+        were its last member. If that was the oldest generation, the next generation that still has members becomes the
+        oldest; generations are walked upwards one at a time so this does not need to look at any individual members.
+        :param person: the instance of Person to remove
+        :return: none
+        """
+        gen_mems = self._generations[person.generation]
+        del gen_mems[person.id]
+        if len(gen_mems) > 0:
+            return
+
+        del self._generations[person.generation]
+        if person.generation != self.oldest_generation:
+            return
+        elif len(self._generations) == 0:
+            self.oldest_generation = None
+            return
+
+        gen = self.oldest_generation + 1
+        while gen not in self._generations:
+            gen += 1
+        self.oldest_generation = gen
+
+    def generation_size(self, generation):
+        """
+        Count the members of the family in the specified generation
+        :param generation: the generation number as an integer
+        :return: the number of members in that generation, as an integer
+        """
+        return len(self._generations.get(generation, ()))
+
+    @property
+    def generations(self):
+        """
+        The generations that have at least one member in this family
+        :return: a sorted list of generation numbers
+        """
+        return sorted(self._generations)
+
+    def bulk_load(self, records, edges=(), validate=True):
+        """
+        Create many people at once and add them to the family. This is much faster than creating each Person with its
+        relations and adding them one at a time, since every relation is linked directly in a single sweep rather than
+        going through Person.add_parent etc., which check for duplicates and link the reverse relation one edge at a
+        time.
+        :param records: an iterable of dictionaries, one per person. Each may have the keys "key" (any hashable value
+        used to refer to this person in edges; defaults to the position of the record), "gender" (an instance of
+        Gender, required), "first", "middle", "last", "unmarried_name" and "suffix" (strings) and "generation" (an
+        integer). If any record lacks a generation, the generations of those people are inferred from the edges (see
+        infer_generations).
+        :param edges: optional, an iterable of (key, relation, other_key) tuples, meaning that the person identified by
+        other_key is the relation ("parent", "child" or "spouse") of the person identified by key. Duplicate edges, in
+        either direction, are only linked once.
+        :param validate: optional, default True. If True, raise a GenError if any parent is not exactly one generation
+        before their child or any spouses are in different generations, as Person.add_parent etc. would. Set to False
+        to link them anyway, like force_add does.
+        :return: a dictionary mapping each record's key to the new instance of Person
+        """
+        name_keys = ("first", "middle", "last", "unmarried_name", "suffix")
+        details = OrderedDict()
+        generations = dict()
+        for i, rec in enumerate(records):
+            key = rec.get("key", i)
+            if key in details:
+                raise ValueError("Duplicate key {0} in records".format(key))
+            if not isinstance(rec["gender"], Gender):
+                raise TypeError("gender must be an instance of Gender")
+            names = tuple(rec.get(k, "") for k in name_keys)
+            for k, name in zip(name_keys, names):
+                if type(name) is not str:
+                    raise TypeError("{0} must be str, if given".format(k))
+            details[key] = (rec["gender"], names)
+            if rec.get("generation") is not None:
+                generations[key] = rec["generation"]
+
+        # Dictionaries rather than sets, so that relations are linked in the order they were given
+        parent_edges = OrderedDict()
+        spouse_edges = OrderedDict()
+        for key, relation, other_key in edges:
+            if key not in details or other_key not in details:
+                raise KeyError("Edge ({0}, {1}, {2}) refers to an unknown key".format(key, relation, other_key))
+            relation = relation.lower()
+            if relation == "parent":
+                parent_edges[(other_key, key)] = None
+            elif relation == "child":
+                parent_edges[(key, other_key)] = None
+            elif relation == "spouse":
+                if (other_key, key) not in spouse_edges:
+                    spouse_edges[(key, other_key)] = None
+            else:
+                raise ValueError("Relation {0} not recognized".format(relation))
+
+        if len(generations) < len(details):
+            generations = infer_generations(details.keys(), parent_edges, spouse_edges, known=generations,
+                                            strict=validate)
+        elif validate:
+            for parent_key, child_key in parent_edges:
+                if generations[child_key] != generations[parent_key] + 1:
+                    raise GenError("Generation of parent {0} is not one less than child {1}".format(parent_key,
+                                                                                                    child_key))
+            for key, other_key in spouse_edges:
+                if generations[key] != generations[other_key]:
+                    raise GenError("Generation of spouse {0} is not equal to {1}".format(other_key, key))
+
+        people = OrderedDict()
+        for key, (gender, names) in details.items():
+            people[key] = Person._from_details(gender, names, generations[key])
+
+        for parent_key, child_key in parent_edges:
+            parent = people[parent_key]
+            child = people[child_key]
+            parent.children.append(child)
+            child.parents.append(parent)
+        for key, other_key in spouse_edges:
+            person = people[key]
+            other = people[other_key]
+            person.spouses.append(other)
+            other.spouses.append(person)
+
+        for person in people.values():
+            self.add_member(person)
+        return people
+
     def remove_member(self, person):
         """
         Remove the specified member of the family. It will remove them from the list of family members and update the
@@ -52,35 +796,213 @@ class Family(object):
         :param person: the instance of Person to remove.
         :return: none.
         """
-        if person not in self.members:
+        if person not in self:
             raise ValueError("Could not find {0} ({1}) in members".format(person.fullname(), person))
         else:
-            self.members.remove(person)
-            if person.generation == self.oldest_generation:
-                # If the person belonged to the oldest generation, we need to update
-                # the generation just to be sure we didn't remove the only member
-                # of that generation
-                gens = [x.generation for x in self.members]
-                self.oldest_generation = min(gens)
+            del self._members[person.id]
+            del self._member_order[person.id]
+            self._remove_from_generation(person)
+            self._name_index.remove(person)
+            person._families.remove(self)
+            self._ancestry_index_current = False
+            self._bump_versions([person])
 
             #person.delete_me()
 
-    def search_by_name(self, first=None, middle=None, last=None, unmarried_name=None, suffix=None):
+    def search_by_name(self, first=None, middle=None, last=None, unmarried_name=None, suffix=None, any_name=None,
+                       mode="exact"):
         """
         Search the family for a family member whose name matches the name given. Each component of the name can be given
-        separately, components not given (i.e. left as None) will not be matched.
+        separately, components not given (i.e. left as None) will not be matched. Matching is case-insensitive and uses
+        the family's name index, so it does not need to look at every member.
         :param first: first name, as a string
         :param middle: middle name, as a string
         :param last: last name, as a string
         :param unmarried_name: unmarried name, as a string
         :param suffix: suffix, as a string
-        :return: a list of instances of Person that match the given names
+        :param any_name: a string that may match any one of the components of the name
+        :param mode: optional, how each component is matched: "exact" (the default) requires the whole component to
+        match, "prefix" requires it to start with the given string and "substring" requires it to contain it.
+        :return: a list of instances of Person that match the given names, in the order they were added to the family
         """
-        result = []
-        for p in self.members:
-            if p.name_eq(first=first, middle=middle, last=last, unmarried=unmarried_name, suffix=suffix):
-                result.append(p)
-        return result
+        criteria = dict()
+        for field, value in zip(NameIndex.fields, (first, middle, last, unmarried_name, suffix)):
+            if value is not None:
+                criteria[field] = value
+
+        if len(criteria) == 0 and any_name is None:
+            if mode not in NameIndex.modes:
+                raise ValueError("mode must be one of {0}".format(", ".join(NameIndex.modes)))
+            return self.members
+
+        name_index = self._get_name_index()
+        ids = name_index.search(criteria, mode=mode) if len(criteria) > 0 else None
+        if any_name is not None:
+            any_ids = set()
+            for field in NameIndex.fields:
+                any_ids.update(name_index.lookup(field, any_name, mode=mode))
+            ids = any_ids if ids is None else ids.intersection(any_ids)
+
+        self._add_query_work(len(ids), 0)
+        return self._members_by_ids(ids)
+
+    def _get_name_index(self):
+        """
+        Internal method that returns the name index used by search_by_name
+        :return: a NameIndex
+        """
+        return self._name_index
+
+    def _members_by_ids(self, ids):
+        """
+        Internal method that looks up members by id
+        :param ids: an iterable of person ids, all of which must belong to members of the family
+        :return: a list of instances of Person, in the order they were added to the family
+        """
+        return [self._members[i] for i in sorted(ids, key=self._member_order.__getitem__)]
+
+    def _relation_changed(self, person, other, relation):
+        """
+        Internal method called by a member of this family when one of their relations is added or removed, so that any
+        precomputed information about the family can be brought up to date.
+        :param person: the instance of Person whose relations changed. This may be someone who is not a member, when
+        the change was to the relations of a member.
+        :param other: the instance of Person added or removed as a relation
+        :param relation: the kind of relation, "parent", "child" or "spouse"
+        :return: none
+        """
+        if relation == "spouse":
+            return
+
+        # Each link between a parent and a child is reported by both people, but only the parent's report means their
+        # children (and so their descendants) changed, unless the parent is not a member and so cannot report it
+        if relation == "child":
+            parent, child = person, other
+        else:
+            parent, child = other, person
+        self._update_descendant_counts(parent, child, relation == "child")
+
+        self._ancestry_index_current = False
+        # A new link is recorded on both sides before either person reports it, so when both report it to this family,
+        # the second report finds the link just as the first did and there is nothing left to invalidate
+        link_state = (parent.id, child.id, child in parent.children, parent in child.parents)
+        if link_state == self._last_link_state:
+            return
+        self._last_link_state = link_state
+
+        if self._relationship_cache is None or len(self._relationship_cache) == 0:
+            self.version += 1
+            return
+
+        # Everyone descended from the child has a different ancestry now, and the parent and their ancestors have
+        # different descendants. Both walks go through people who are not members too, so members related only
+        # through them are still reached.
+        changed = dict()
+        for start, attr in ((child, "children"), (parent, "parents")):
+            to_visit = [start]
+            while len(to_visit) > 0:
+                p = to_visit.pop()
+                if p.id not in changed:
+                    changed[p.id] = p
+                    to_visit.extend(getattr(p, attr))
+        self._bump_versions(changed.values())
+
+    def _bump_versions(self, people):
+        """
+        Internal method that increases the version of the family and of each of the given people, so that cached
+        results involving them are no longer used.
+        :param people: an iterable of instances of Person
+        :return: none
+        """
+        self.version += 1
+        for p in people:
+            self._person_versions[p.id] = self._person_versions.get(p.id, 0) + 1
+
+    def _cache_versions(self, person1, person2):
+        """
+        Internal method that gets the current versions of two people, to check cache entries against
+        :param person1: an instance of Person
+        :param person2: an instance of Person
+        :return: a tuple of two integers
+        """
+        return self._person_versions.get(person1.id, 0), self._person_versions.get(person2.id, 0)
+
+    def cache_stats(self):
+        """
+        Get statistics about the cache of common_ancestors and get_relationship results
+        :return: a dictionary (see RelationshipCache.stats), or None if the family was created with caching turned off
+        """
+        if self._relationship_cache is None:
+            return None
+        return self._relationship_cache.stats()
+
+    def clear_cache(self):
+        """
+        Discard every cached common_ancestors and get_relationship result. This is only needed after changing the
+        relations of people who are not members of the family, which the family cannot see (see RelationshipCache).
+        :return: none
+        """
+        if self._relationship_cache is not None:
+            self._relationship_cache.clear()
+
+    def build_ancestry_index(self):
+        """
+        Precompute the ancestors of every member of the family as bitsets (see AncestryIndex), after which
+        common_ancestors, get_relationship and is_ancestor are answered from the index. The index is rebuilt
+        automatically the next time it is needed after members or parent/child relations change, including changes
+        made on a person who is not a member to their relation with a member. The index also holds ancestors who are
+        not members, and a relation added or removed between two such people (with neither being a member) is not seen:
+        it leaves the index out of date until it is rebuilt by calling this method again.
+        :return: the AncestryIndex
+        """
+        self._ancestry_index = AncestryIndex(self)
+        self._ancestry_index_current = True
+        return self._ancestry_index
+
+    def drop_ancestry_index(self):
+        """
+        Discard the ancestry index built by build_ancestry_index, going back to answering queries by walking the family
+        :return: none
+        """
+        self._ancestry_index = None
+        self._ancestry_index_current = False
+
+    def _current_ancestry_index(self):
+        """
+        Internal method that returns the ancestry index, rebuilding it first if it is out of date
+        :return: an AncestryIndex, or None if build_ancestry_index has not been called
+        """
+        if self._ancestry_index is not None and not self._ancestry_index_current:
+            self.build_ancestry_index()
+        return self._ancestry_index
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Check if one person is an ancestor of another. This is a single bit test if the family has an ancestry index.
+        :param ancestor: an instance of Person
+        :param descendant: an instance of Person
+        :return: boolean
+        """
+        index = self._current_ancestry_index()
+        if index is not None and descendant in index and ancestor in index:
+            return index.is_ancestor(ancestor, descendant)
+
+        for anc, dist in self.iter_ancestors(descendant):
+            if anc.id == ancestor.id:
+                return True
+        return False
+
+    def _name_changed(self, person, field, old_value, new_value):
+        """
+        Internal method called by a member of this family when one of their names changes, so that the name index can be
+        kept up to date.
+        :param person: the instance of Person that was renamed
+        :param field: which name changed, one of NameIndex.fields
+        :param old_value: the previous name
+        :param new_value: the new name
+        :return: none
+        """
+        self._name_index.update(person, field, old_value, new_value)
 
     def find_members_in_generation(self, generation):
         """
@@ -88,56 +1010,337 @@ class Family(object):
         :param generation: the generation number as an integer
         :return: a list of instances of Person
         """
-        gen_mems = []
-        for p in self.members:
-            if p.generation == generation:
-                gen_mems.append()
+        gen_mems = self._generations.get(generation)
+        if gen_mems is None:
+            return []
+        return list(gen_mems.values())
+
+    def iter_ancestors(self, person, count_paths=False):
+        """
+        Iterate over all the ancestors of the given person, nearest first. Each ancestor is yielded only once, even if
+        they can be reached through more than one line of descent (for example when cousins marry), so the cost is
+        linear in the number of distinct ancestors rather than in the number of lines of descent. The ancestors are
+        produced one generation of parents at a time, so stopping early avoids walking the rest of the ancestry.
+        :param person: the instance of Person whose ancestors to find
+        :param count_paths: optional, default False. If True, also count how many distinct lines of descent lead from
+        each ancestor to person (only lines with the shortest number of steps are counted; for a family whose
+        generations are consistent, every line from a given ancestor has the same number of steps).
+        :return: a generator of (ancestor, distance) tuples, where distance is the smallest number of parent steps from
+        person to that ancestor (1 for parents, 2 for grandparents, etc.). If count_paths is True, the tuples are
+        (ancestor, distance, number_of_paths).
+        """
+        return self._iter_lineage(person, "parents", count_paths)
+
+    def iter_descendants(self, person, count_paths=False):
+        """
+        Iterate over all the descendants of the given person, nearest first. This mirrors iter_ancestors: each
+        descendant is yielded only once, one generation of children at a time, so stopping early avoids walking the
+        rest of the descendants.
+        :param person: the instance of Person whose descendants to find
+        :param count_paths: optional, default False. If True, also count how many distinct lines of descent (with the
+        shortest number of steps) lead from person to each descendant.
+        :return: a generator of (descendant, distance) tuples, where distance is the smallest number of child steps from
+        person to that descendant (1 for children, 2 for grandchildren, etc.). If count_paths is True, the tuples are
+        (descendant, distance, number_of_paths).
+        """
+        return self._iter_lineage(person, "children", count_paths)
+
+    def _iter_lineage(self, person, attr, count_paths, stop_generation=None):
+        """
+        Internal method that does the work of iter_ancestors and iter_descendants
+        :param person: the instance of Person to start from
+        :param attr: the Person attribute to follow, "parents" or "children"
+        :param count_paths: whether to count the lines of descent to each person
+        :param stop_generation: optional, a generation number. People beyond that generation in the direction of the
+        walk are still produced, but their own parents or children are not walked. People in that generation are
+        walked, in case a forced relation repeats the generation number.
+        :return: a generator, see iter_ancestors
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+
+        seen = set([person.id])
+        curr_gen_people = [(person, 1)]
+        distance = 0
+        while len(curr_gen_people) > 0:
+            distance += 1
+            next_gen_people = dict()
+            for p, n_paths in curr_gen_people:
+                if _beyond_generation(p.generation, stop_generation, attr):
+                    continue
+                for rel in getattr(p, attr):
+                    if rel.id in next_gen_people:
+                        next_gen_people[rel.id][1] += n_paths
+                    elif rel.id not in seen:
+                        seen.add(rel.id)
+                        next_gen_people[rel.id] = [rel, n_paths]
+
+            curr_gen_people = next_gen_people.values()
+            for rel, n_paths in curr_gen_people:
+                if count_paths:
+                    yield rel, distance, n_paths
+                else:
+                    yield rel, distance
+
+    def iter_neighborhood(self, person, max_depth=2, max_count=None):
+        """
+        Iterate over everyone within a number of steps of a person, following parent, spouse and child links, so that
+        relatives by marriage are included. Relatives are produced breadth-first, nearest first, as soon as they are
+        reached, so stopping early avoids walking the rest of the neighborhood, and each relative is produced once.
+        :param person: the instance of Person to start from
+        :param max_depth: optional, the largest number of steps to follow, or None for no limit
+        :param max_count: optional, the largest number of relatives to produce, or None for no limit
+        :return: a generator of (relative, path, label) tuples. path is a tuple of (relation, person) steps leading from
+        person to relative along one of the shortest routes, where relation ("parent", "spouse" or "child") is what the
+        person at that step is to the person before it. label describes the relationship of relative to person, see
+        path_label.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        for name, bound in (("max_depth", max_depth), ("max_count", max_count)):
+            if bound is not None and (type(bound) is not int or bound < 0):
+                raise ValueError("{0} must be a non-negative integer or None".format(name))
+        if max_count == 0 or max_depth == 0:
+            return
+
+        # Each person reached points back to the step that reached them, so paths are only built for the people
+        # produced, and the links of each person are walked in place rather than copied into a combined list
+        steps = {person.id: None}
+        to_visit = deque([(person, 0)])
+        count = 0
+        while len(to_visit) > 0:
+            p, depth = to_visit.popleft()
+            for relation, attr in _neighbor_links:
+                for rel in getattr(p, attr):
+                    if rel.id in steps:
+                        continue
+                    steps[rel.id] = (p.id, relation, rel)
+
+                    path = []
+                    step = steps[rel.id]
+                    while step is not None:
+                        path.append(step[1:])
+                        step = steps[step[0]]
+                    path = tuple(reversed(path))
+                    yield rel, path, path_label(path)
+
+                    count += 1
+                    if max_count is not None and count >= max_count:
+                        return
+                    if max_depth is None or depth + 1 < max_depth:
+                        to_visit.append((rel, depth + 1))
 
     def ancestors_in_generation(self, person, generation):
         """
-        Finds all members of the family that are ancestors of the given person and in the given generation
+        Finds all members of the family that are ancestors of the given person and in the given generation. Each
+        ancestor is listed once, and ancestors in the requested generation are found even if some of the lines of
+        descent between them and the person skip or repeat generation numbers.
         :param person: the instance of Person that you wish to find ancestors of
         :param generation: the generation (as an integer) the ancestors must be in
         :return: a list of instances of Person
         """
+        return self.ancestors_in_generations(person, [generation])[generation]
+
+    def ancestors_in_generations(self, person, generations):
+        """
+        Finds the ancestors of the given person in each of several generations, with a single walk up the family tree
+        rather than one per generation; see ancestors_in_generation
+        :param person: the instance of Person that you wish to find ancestors of
+        :param generations: an iterable of generations (as integers)
+        :return: a dictionary mapping each of the generations to a list of instances of Person
+        """
+        generations = list(generations)
         if not isinstance(person, Person):
             raise TypeError("person must be an instance of pygenelib.Person")
-        elif not isinstance(generation, int):
+        elif not all(isinstance(g, int) for g in generations):
             raise TypeError("generation must be an integer")
-        elif person.generation <= generation:
+        elif any(person.generation <= g for g in generations):
             raise GenError("Cannot have ancestor in same or younger generation")
 
-        # Iterate backwards through generations, finding parents at each step
-        # May need to handle the possibility of mixed generations?
-        curr_gen_people = [person]
-        curr_gen = person.generation
-        while curr_gen > generation:
-            next_gen_people = []
-            for p in curr_gen_people:
-                next_gen_people += p.parents
-            next_gen = [x.generation for x in next_gen_people]
-            ng_test = [x != next_gen[0] for x in next_gen]
-            if any(ng_test):
-                raise GenError("Mixed generations found in ancestry for {0}".format(person))
+        ancestors = dict((g, []) for g in generations)
+        if len(generations) == 0:
+            return ancestors
+        n_visited = 0
+        max_dist = 0
+        # The ancestors of people older than the oldest generation asked for cannot be in it, so they are not walked
+        for anc, dist in self._iter_lineage(person, "parents", False, stop_generation=min(generations)):
+            n_visited += 1
+            max_dist = dist
+            if anc.generation in ancestors:
+                ancestors[anc.generation].append(anc)
+        self._add_query_work(n_visited, max_dist)
+        return ancestors
+
+    def descendants_in_generation(self, person, generation):
+        """
+        Finds all members of the family that are descendants of the given person and in the given generation; this
+        mirrors ancestors_in_generation.
+        :param person: the instance of Person that you wish to find descendants of
+        :param generation: the generation (as an integer) the descendants must be in
+        :return: a list of instances of Person
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        elif not isinstance(generation, int):
+            raise TypeError("generation must be an integer")
+        elif person.generation >= generation:
+            raise GenError("Cannot have descendant in same or older generation")
+
+        descendants = []
+        n_visited = 0
+        max_dist = 0
+        # The descendants of people younger than the generation asked for cannot be in it, so they are not walked
+        for desc, dist in self._iter_lineage(person, "children", False, stop_generation=generation):
+            n_visited += 1
+            max_dist = dist
+            if desc.generation == generation:
+                descendants.append(desc)
+        self._add_query_work(n_visited, max_dist)
+        return descendants
+
+    def enable_descendant_counts(self):
+        """
+        Start remembering the number of descendants of each person once descendant_count has counted them. The counts
+        are kept up to date as parents and children are added or removed with Person.add_parent, add_child and
+        remove_relation: only the people above the changed link are adjusted, by the number of people below it, and a
+        count is only walked again if it cannot be adjusted that way (for example when the people below the link could
+        already be reached from above it by another line of descent, or when the parent is not a member and so their
+        side of the change is never reported).
+        :return: none
+        """
+        if self._descendant_counts is None:
+            self._descendant_counts = dict()
+            self._one_sided_links = set((p.id, c.id) for p in self for c in p.children if p not in c.parents)
+            self._one_sided_links.update((p.id, c.id) for c in self for p in c.parents if c not in p.children)
 
-            curr_gen_people = next_gen_people
-            if len(curr_gen_people) == 0:
-                return curr_gen_people
+    def disable_descendant_counts(self):
+        """
+        Stop remembering descendant counts and forget those already counted
+        :return: none
+        """
+        self._descendant_counts = None
+        self._one_sided_links = set()
 
-            curr_gen = next_gen[0]
+    def descendant_count(self, person):
+        """
+        Count the distinct descendants of a person. If enable_descendant_counts has been called, the count is
+        remembered, so asking again costs nothing until it has to be walked again.
+        :param person: an instance of Person
+        :return: an integer
+        """
+        counts = self._descendant_counts
+        if counts is not None and person.id in counts:
+            return counts[person.id]
+        count = sum(1 for _ in self.iter_descendants(person))
+        if counts is not None:
+            counts[person.id] = count
+        return count
+
+    def _update_descendant_counts(self, parent, child, children_changed):
+        """
+        Internal method that adjusts the remembered descendant counts after the link between a parent and a child was
+        added or removed; see enable_descendant_counts
+        :param parent: the instance of Person on the parent's side of the link
+        :param child: the instance of Person on the child's side of the link
+        :param children_changed: whether the parent's children changed, rather than just the child's parents
+        :return: none
+        """
+        counts = self._descendant_counts
+        if counts is None:
+            return
+        # Descendants are found through children, but the people above a link are found through parents, so the
+        # counts can only be adjusted while every other link is recorded on both sides (remove_relation only removes
+        # one side, for example)
+        link = (parent.id, child.id)
+        added = child in parent.children
+        if added != (parent in child.parents):
+            self._one_sided_links.add(link)
+        else:
+            self._one_sided_links.discard(link)
+        if len(counts) == 0 or (not children_changed and parent in self):
+            return
+        elif len(self._one_sided_links) > 1 or (len(self._one_sided_links) == 1 and link not in self._one_sided_links):
+            counts.clear()
+            return
+        elif not children_changed:
+            # The parent is not a member, so a change to their children will never be reported; the counts above the
+            # link cannot be adjusted without knowing it, so they are walked again when next asked for
+            for p in [parent] + [anc for anc, _ in self.iter_ancestors(parent)]:
+                counts.pop(p.id, None)
+            return
 
-        return curr_gen_people
+        cached = [p for p in [parent] + [anc for anc, _ in self.iter_ancestors(parent)] if p.id in counts]
+        if len(cached) == 0:
+            return
+        below = dict([(child.id, child)])
+        below.update((desc.id, desc) for desc, _ in self.iter_descendants(child))
+
+        # Someone above the link who could already reach the people below it by another line of descent (pedigree
+        # collapse) must not count them twice. Such a line enters the people below through a parent outside them, so
+        # walk up from those parents, no further than the oldest generation among the counts being adjusted.
+        oldest = min(p.generation for p in cached)
+        to_visit = [q for p in below.values() for q in p.parents
+                    if q.id not in below and not (q is parent and p is child)]
+        reached = set()
+        collapsed = False
+        while len(to_visit) > 0 and not collapsed:
+            q = to_visit.pop()
+            if q.id in reached or q.generation < oldest:
+                continue
+            reached.add(q.id)
+            for pp in q.parents:
+                if pp.generation != q.generation - 1:
+                    # The generations are not consistent, so the walk cannot safely stop at the oldest generation
+                    collapsed = True
+                to_visit.append(pp)
+
+        for p in cached:
+            if collapsed or p.id in reached:
+                del counts[p.id]
+            else:
+                counts[p.id] += len(below) if added else -len(below)
 
     def common_ancestors(self, member1, member2):
         """
         Given two members of the family, finds the nearest common ancestors. For example, given two siblings, it will
         return their parents. Given two first cousins, it will return their common grandparents. If one is a direct
         ancestor of the other, a list containing only the older member will be returned.
+
+        Both ancestries are walked together, youngest generation first, and the search stops as soon as the first
+        generation containing a common ancestor has been completed, so only the part of each ancestry between the two
+        members and their nearest common ancestors is visited. The amount of work done by the most recent call is
+        recorded in the last_common_ancestor_stats attribute. If the family has an ancestry index (see
+        build_ancestry_index), the answer comes from the index instead. Results are cached until the ancestry of either
+        member changes. When the answer comes from the cache or the index, no walk is done and
+        last_common_ancestor_stats is None.
         :param member1: one member of the family, an instance of Person
         :param member2: the other member of the family, an instance of Person. It does not matter whether member2 is
         older or younger than member1
         :return: a list of instances of Person
         """
+        self.last_common_ancestor_stats = None
+        cache = self._relationship_cache
+        if cache is not None:
+            key = ("common_ancestors", member1.id, member2.id)
+            versions = self._cache_versions(member1, member2)
+            found, commons = cache.get(key, versions)
+            if not found:
+                commons = self._find_common_ancestors(member1, member2)
+                cache.put(key, versions, commons)
+            return list(commons)
+        return self._find_common_ancestors(member1, member2)
+
+    def _find_common_ancestors(self, member1, member2):
+        """
+        Internal method that does the work of common_ancestors, bypassing the cache
+        :param member1: one member of the family, an instance of Person
+        :param member2: the other member of the family, an instance of Person
+        :return: a list of instances of Person
+        """
+        index = self._current_ancestry_index()
+        if index is not None and member1 in index and member2 in index:
+            return index.common_ancestors(member1, member2)
+
         if member1.generation <= member2.generation:
             older = member1
             younger = member2
@@ -145,29 +1348,56 @@ class Family(object):
             older = member2
             younger = member1
 
-        if older.generation != younger.generation:
-            # Possible that the older one is a direct ancestor
-            ancestors = self.ancestors_in_generation(younger, older.generation)
-            if older in ancestors:
-                return [older]
-
-        for g in range(older.generation - 1, self.oldest_generation - 1, -1):
-            anc_of_younger = self.ancestors_in_generation(younger, g)
-            anc_of_older = self.ancestors_in_generation(older, g)
-
-            commons = []
-            for a in anc_of_younger:
-                if a in anc_of_older:
-                    commons.append(a)
-            if len(commons) > 0:
-                return commons
-
-        # No common ancestors found
-        return []
+        # The older member can only count as a common ancestor if they are in an older generation than the younger
+        # member (i.e. if they could be a direct ancestor); the younger member never can.
+        excluded = set([younger.id])
+        if older.generation == younger.generation:
+            excluded.add(older.id)
+
+        # Each side of the search records the distance (in parent steps) to every ancestor it has reached and the order
+        # in which it was reached. The heap holds (-generation, order, side, person, distance) so that the youngest
+        # generation is always expanded first, and within a generation people are expanded in the order they were found.
+        reached = ({}, {})
+        heap = [(-younger.generation, 0, 0, younger, 0), (-older.generation, 1, 1, older, 0)]
+        order = 2
+        stats = {"expanded": 0, "parents_scanned": 0, "duplicates_skipped": 0}
+
+        commons = []
+        common_gen = None
+        oldest_expanded = younger.generation
+        while len(heap) > 0:
+            neg_gen, p_order, side, p, dist = heapq.heappop(heap)
+            if common_gen is not None and -neg_gen < common_gen:
+                break
+            elif p.id in reached[side]:
+                stats["duplicates_skipped"] += 1
+                continue
+
+            reached[side][p.id] = (dist, p_order)
+            stats["expanded"] += 1
+            oldest_expanded = p.generation
+            if p.id in reached[1 - side] and p.id not in excluded:
+                commons.append(p)
+                common_gen = p.generation
+                continue
+
+            for parent in p.parents:
+                stats["parents_scanned"] += 1
+                if parent.id not in reached[side]:
+                    heapq.heappush(heap, (-parent.generation, order, side, parent, dist + 1))
+                    order += 1
+
+        self.last_common_ancestor_stats = stats
+        self._add_query_work(stats["expanded"], younger.generation - oldest_expanded)
+        # List the common ancestors in the order they were reached walking up from the younger member. If the older
+        # member is a direct ancestor, they will be the only one.
+        commons.sort(key=lambda a: reached[0][a.id][1])
+        return commons
 
     def get_relationship(self, base_person, other_person):
         """
-        Figure out the relationship of the other_person to the base_person
+        Figure out the relationship of the other_person to the base_person. Results are cached until the ancestry of
+        either person changes.
         :param base_person: an instance of Person within the family
         :param other_person: an instance of Person within the family, whose relationship to the base_person will be
         calculated
@@ -181,7 +1411,36 @@ class Family(object):
         if base_person == other_person:
             return "same person"
 
-        common_ancestors = self.common_ancestors(base_person, other_person)
+        cache = self._relationship_cache
+        if cache is None:
+            return self._find_relationship(base_person, other_person)
+
+        key = ("relationship", base_person.id, other_person.id)
+        versions = self._cache_versions(base_person, other_person)
+        found, relation = cache.get(key, versions)
+        if not found:
+            relation = self._find_relationship(base_person, other_person)
+            cache.put(key, versions, relation)
+        return relation
+
+    def _find_relationship(self, base_person, other_person):
+        """
+        Internal method that does the work of get_relationship, bypassing the cache
+        :param base_person: an instance of Person within the family
+        :param other_person: another instance of Person within the family
+        :return: a string describing the relationship between the two people
+        """
+        return self._relationship_from_common_ancestors(base_person, other_person,
+                                                        self.common_ancestors(base_person, other_person))
+
+    def _relationship_from_common_ancestors(self, base_person, other_person, common_ancestors):
+        """
+        Internal method that describes the relationship of two people given their nearest common ancestors
+        :param base_person: an instance of Person within the family
+        :param other_person: another instance of Person within the family
+        :param common_ancestors: the nearest common ancestors of the two, see common_ancestors
+        :return: a string describing the relationship between the two people
+        """
         if len(common_ancestors) == 0:
             return "unrelated"
 
@@ -191,61 +1450,786 @@ class Family(object):
             if anc.generation != ancestor_gen:
                 raise NotImplementedError("Not implemented: common ancestors have different generations")
 
-        # Okay, this is going to be a bit of a mess. We need to handle all the "special" cases first, i.e. parents,
-        # children, siblings, aunts, uncles, nieces, nephews. We'll start with direct relationships because those are
-        # reasonably straightforward
-        #pdb.set_trace()
-        if base_person in common_ancestors or other_person in common_ancestors:
+        direct = base_person in common_ancestors or other_person in common_ancestors
+        dist_to_anc = min(base_person.generation - ancestor_gen, other_person.generation - ancestor_gen)
+        return relationship_label(other_person.gender, gen_diff, dist_to_anc, direct)
 
-            if gen_diff > 0:
-                relation = other_person.gender.parent
+    def relationship_path(self, base_person, other_person, max_depth=None):
+        """
+        Find one of the shortest paths of parent, spouse and child links between two people, which connects people
+        related only by marriage as well as blood relatives. This searches outwards from both people at once, always
+        extending whichever search has fewer people at its edge, so it looks at far fewer people than a search from one
+        side when the family is large.
+        :param base_person: the instance of Person the path starts from
+        :param other_person: the instance of Person the path leads to
+        :param max_depth: optional, the largest number of steps to look for, or None for no limit
+        :return: a tuple of (relation, person) steps as in iter_neighborhood (empty if the two people are the same), or
+        None if they are not connected within max_depth steps
+        """
+        if not isinstance(base_person, Person):
+            raise TypeError("base_person must be an instance of Person")
+        if not isinstance(other_person, Person):
+            raise TypeError("other_person must be an instance of Person")
+        if max_depth is not None and (type(max_depth) is not int or max_depth < 0):
+            raise ValueError("max_depth must be a non-negative integer or None")
+        if base_person == other_person:
+            return ()
+
+        # Each side maps the people it has reached to the step linking them to the person before (on the base side)
+        # or after (on the other side) them on the path, and their distance from where that side started
+        forward = {base_person.id: (None, None, base_person, 0)}
+        backward = {other_person.id: (None, None, other_person, 0)}
+        forward_edge = [base_person]
+        backward_edge = [other_person]
+        depth = 0
+        while len(forward_edge) > 0 and len(backward_edge) > 0:
+            if max_depth is not None and depth >= max_depth:
+                return None
+            depth += 1
+            expand_forward = len(forward_edge) <= len(backward_edge)
+            reached, opposite = (forward, backward) if expand_forward else (backward, forward)
+            edge = forward_edge if expand_forward else backward_edge
+
+            next_edge = []
+            meeting = None
+            for p in edge:
+                p_depth = reached[p.id][3]
+                for relation, attr in _neighbor_links:
+                    for rel in getattr(p, attr):
+                        if rel.id in reached:
+                            continue
+                        if expand_forward:
+                            reached[rel.id] = (p.id, relation, rel, p_depth + 1)
+                        else:
+                            # Seen from the base person's side, p is rel's child if rel is p's parent, and so on
+                            reached[rel.id] = (p.id, _inverse_relations[relation], p, p_depth + 1)
+                        next_edge.append(rel)
+                        if rel.id in opposite and (meeting is None or opposite[rel.id][3] < opposite[meeting][3]):
+                            meeting = rel.id
+            if meeting is not None:
+                return self._join_paths(forward, backward, meeting)
+
+            if expand_forward:
+                forward_edge = next_edge
             else:
-                relation = other_person.gender.child
-                gen_diff = abs(gen_diff)
-
-            if gen_diff > 1:
-                relation = "grand" + relation
-            if gen_diff > 2:
-                relation = (gen_diff-2)*"great-" + relation
+                backward_edge = next_edge
+        return None
 
+    def _join_paths(self, forward, backward, meeting):
+        """
+        Internal method that builds the path found by relationship_path from the two searches
+        :param forward: the steps reached from the base person
+        :param backward: the steps reached from the other person
+        :param meeting: the id of a person reached by both
+        :return: a tuple of (relation, person) steps
+        """
+        path = []
+        pid = meeting
+        while forward[pid][0] is not None:
+            prev_id, relation, person, _ = forward[pid]
+            path.append((relation, person))
+            pid = prev_id
+        path.reverse()
+        pid = meeting
+        while backward[pid][0] is not None:
+            next_id, relation, person, _ = backward[pid]
+            path.append((relation, person))
+            pid = next_id
+        return tuple(path)
+
+    def get_extended_relationship(self, base_person, other_person, max_depth=None):
+        """
+        Figure out the relationship of the other_person to the base_person, like get_relationship, but also naming
+        relatives by marriage (in-laws, step relations and spouses) from the shortest path between them (see
+        relationship_path and path_label). Blood relationships are named by get_relationship, even if the two people
+        are also more closely connected by marriage.
+        :param base_person: an instance of Person within the family
+        :param other_person: an instance of Person within the family
+        :param max_depth: optional, the largest number of steps to look for a path by marriage, or None for no limit
+        :return: a string describing the relationship of other_person to base_person, or "unrelated" if they are not
+        connected at all
+        """
+        relation = self.get_relationship(base_person, other_person)
+        if relation != "unrelated":
             return relation
+        path = self.relationship_path(base_person, other_person, max_depth=max_depth)
+        return "unrelated" if path is None else path_label(path)
 
-        # Now it gets more complicated, because we're dealing with the pool of relationships that can be generically
-        # called "cousin" but which have some special cases
-        dist_to_anc = min(base_person.generation - ancestor_gen, other_person.generation - ancestor_gen)
-        #print("dist_to_anc = {}; gen_diff = {}".format(dist_to_anc, gen_diff))
-        if dist_to_anc == 1:
-            # If one of the people in question is only one generation away from the common ancestors, we're in the
-            # special cases
-            if gen_diff == 0:
-                # siblings
-                return other_person.gender.sibling
+    def relationship_matrix(self, people=None):
+        """
+        Compute the relationship of every person in a group to every other person in it at once. This uses the family's
+        ancestry index if it has one (see build_ancestry_index), otherwise a temporary one is built for the group, so
+        each pair costs a couple of bitset operations rather than a call to common_ancestors.
+        :param people: optional, an iterable of instances of Person. If not given, all members of the family are used.
+        :return: a RelationshipMatrix
+        """
+        people = self.members if people is None else list(people)
+        return RelationshipMatrix(people, self._index_for(people))
+
+    def _index_for(self, people):
+        """
+        Internal method that gets an ancestry index holding all of the given people: the family's own if it has one
+        that does, otherwise a temporary one built for them
+        :param people: a list of instances of Person
+        :return: an AncestryIndex
+        """
+        index = self._current_ancestry_index()
+        if index is None or not all(p in index for p in people):
+            index = AncestryIndex(people)
+        return index
+
+    def _pairs_answered_together(self, kind, pairs, answer):
+        """
+        Internal method that answers a query about each of many pairs of people, using cached answers where there are
+        any and one ancestry index for the people in all the other pairs
+        :param kind: the kind of query, as used in the cache keys ("common_ancestors" or "relationship")
+        :param pairs: a list of (person, person) tuples
+        :param answer: a function taking the index and a pair, and returning the answer for the pair
+        :return: a list of answers, one for each pair
+        """
+        for pair in pairs:
+            if not isinstance(pair[0], Person) or not isinstance(pair[1], Person):
+                raise TypeError("pairs must be of instances of Person")
+        cache = self._relationship_cache
+        results = [None] * len(pairs)
+        missing = []
+        for i, (a, b) in enumerate(pairs):
+            if cache is not None:
+                found, value = cache.get((kind, a.id, b.id), self._cache_versions(a, b))
+                if found:
+                    results[i] = value
+                    continue
+            missing.append(i)
+        if len(missing) == 0:
+            return results
+
+        people = dict()
+        for i in missing:
+            for p in pairs[i]:
+                people[p.id] = p
+        index = self._index_for(list(people.values()))
+        for i in missing:
+            a, b = pairs[i]
+            results[i] = answer(index, a, b)
+            if cache is not None:
+                cache.put((kind, a.id, b.id), self._cache_versions(a, b), results[i])
+        return results
+
+    def common_ancestors_of_pairs(self, pairs):
+        """
+        Find the nearest common ancestors of each of many pairs of members at once; see common_ancestors. The ancestries
+        of everyone in the pairs are indexed together (see AncestryIndex), so ancestors they share are only visited
+        once, however many pairs they are in.
+        :param pairs: an iterable of (member1, member2) tuples of instances of Person
+        :return: a list with a list of instances of Person for each pair
+        """
+        results = self._pairs_answered_together("common_ancestors", list(pairs),
+                                                lambda index, a, b: index.common_ancestors(a, b))
+        return [list(commons) for commons in results]
+
+    def get_relationships(self, pairs):
+        """
+        Figure out the relationship of each of many pairs of people at once; see get_relationship. As in
+        common_ancestors_of_pairs, one ancestry index is shared by all the pairs.
+        :param pairs: an iterable of (base_person, other_person) tuples of instances of Person
+        :return: a list of strings, one for each pair
+        """
+        def answer(index, base_person, other_person):
+            if base_person == other_person:
+                return "same person"
+            return self._relationship_from_common_ancestors(base_person, other_person,
+                                                            index.common_ancestors(base_person, other_person))
+        return self._pairs_answered_together("relationship", list(pairs), answer)
+
+    def merge(self, other, validate=True):
+        """
+        Merge the members of another family into this one. Each member of the other family is matched to a member of
+        this family who is the same person, if there is one: candidates are looked up in an index of this family by
+        gender, first name and either last or unmarried name (without conflicting middle names or suffixes), and the
+        candidate sharing the most relatives (by relation and name) wins. A candidate who shares no relatives is only
+        accepted if one of the two has no relatives recorded, and ties are left unmatched rather than guessed. The
+        relatives of matched people are then matched to the relatives of their matches with the same relation and name.
+
+        Generation numbers only mean something relative to the rest of a tree, so the two families may number the same
+        people differently. For each connected group of people in the other family, the difference between the
+        generations of matched people that occurs most often is taken as that group's offset; matches that disagree
+        with it are dropped, and the unmatched people of the group are added with their generations shifted by it.
+
+        Matched people keep their own names, except that names they lack are filled in from the other family, and get
+        any relations from the other family that they do not already have. The other family is not changed.
+        :param other: an instance of Family
+        :param validate: optional, default True. If True, raise a GenError before changing anything if a relation
+        would link people whose generations do not fit it; if False, link them anyway, like force_add does.
+        :return: a dictionary mapping the id of each member of the other family to the instance of Person in this
+        family they were matched to or copied as. Statistics about the merge are stored in the last_merge_stats
+        attribute: the number of people "matched" and "added", the number of candidate matches rejected because several
+        were equally good ("ambiguous") or because their generation disagreed with the rest of their group
+        ("generation_conflicts"), the number of groups whose generations were shifted ("rebased_groups"), the number
+        of relations added ("parent_edges_added", "spouse_edges_added") or already present ("duplicate_edges"), the
+        number of "names_filled" and the time taken in "seconds".
+        """
+        if not isinstance(other, Family):
+            raise TypeError("other must be an instance of Family")
+        elif other is self:
+            raise ValueError("Cannot merge a family into itself")
+
+        start = time.perf_counter()
+        stats = {"matched": 0, "added": 0, "ambiguous": 0, "generation_conflicts": 0, "rebased_groups": 0,
+                 "parent_edges_added": 0, "spouse_edges_added": 0, "duplicate_edges": 0, "names_filled": 0}
+
+        index = dict()
+        for person in self:
+            for key in _merge_keys(person):
+                index.setdefault(key, []).append(person)
+        signatures = dict()
+
+        def signature(person):
+            if person.id not in signatures:
+                signatures[person.id] = _relative_signature(person)
+            return signatures[person.id]
+
+        # Propose a match for each member of the other family
+        proposals = dict()
+        for person in other:
+            if self._members.get(person.id) is person:
+                proposals[person.id] = (person, float("inf"))
+                continue
+            candidates = set()
+            for key in _merge_keys(person):
+                candidates.update(c for c in index.get(key, ()) if _names_compatible(person, c))
+            if len(candidates) == 0:
+                continue
+            own = signature(person)
+            scored = sorted(((len(own & signature(c)), c) for c in candidates
+                             if len(own & signature(c)) > 0 or len(own) == 0 or len(signature(c)) == 0),
+                            key=lambda sc: -sc[0])
+            if len(scored) > 1 and scored[1][0] == scored[0][0]:
+                stats["ambiguous"] += 1
+            elif len(scored) > 0:
+                proposals[person.id] = (scored[0][1], scored[0][0])
+
+        # Work out the generation offset of each connected group of the other family from its proposed matches
+        offsets = dict()
+        for person in other:
+            if person.id in offsets:
+                continue
+            group = [person]
+            offsets[person.id] = None
+            k = 0
+            while k < len(group):
+                for rel in group[k].parents + group[k].spouses + group[k].children:
+                    if rel.id not in offsets and rel in other:
+                        offsets[rel.id] = None
+                        group.append(rel)
+                k += 1
+            votes = Counter(proposals[p.id][0].generation - p.generation for p in group if p.id in proposals)
+            offset = votes.most_common(1)[0][0] if len(votes) > 0 else 0
+            if offset != 0:
+                stats["rebased_groups"] += 1
+            for p in group:
+                offsets[p.id] = offset
+
+        # Each member of this family can only be matched once; the best supported proposal wins
+        targets = dict()
+        claimed = set()
+        for pid, (candidate, _) in sorted(proposals.items(), key=lambda item: -item[1][1]):
+            person = other.get_member(pid)
+            if candidate.generation != person.generation + offsets[pid]:
+                stats["generation_conflicts"] += 1
+            elif candidate.id in claimed:
+                stats["ambiguous"] += 1
             else:
-                if gen_diff > 0:
-                    # the other person is younger, will be some sort of niece or nephew
-                    relation = other_person.gender.auntuncle
-                else:
-                    relation = other_person.gender.niecenephew
+                targets[pid] = candidate
+                claimed.add(candidate.id)
+
+        # Relatives of matched people are matched to the relatives of their matches with the same relation and name,
+        # which finds people whose relatives were too different to match them directly
+        to_visit = list(targets)
+        while len(to_visit) > 0:
+            person = other.get_member(to_visit.pop())
+            target = targets[person.id]
+            for relation in ("parents", "spouses", "children"):
+                for rel in getattr(person, relation):
+                    if rel.id in targets or rel.id not in offsets:
+                        continue
+                    keys = set(_merge_keys(rel))
+                    candidates = [c for c in getattr(target, relation)
+                                  if c.id not in claimed and c.generation == rel.generation + offsets[rel.id]
+                                  and not keys.isdisjoint(_merge_keys(c)) and _names_compatible(rel, c)]
+                    if len(candidates) == 1:
+                        targets[rel.id] = candidates[0]
+                        claimed.add(candidates[0].id)
+                        to_visit.append(rel.id)
+        stats["matched"] = len(targets)
+
+        generations = dict((p.id, targets[p.id].generation if p.id in targets else p.generation + offsets[p.id])
+                           for p in other)
+        parent_edges = []
+        spouse_edges = []
+        for person in other:
+            for parent in person.parents:
+                if parent.id in generations:
+                    parent_edges.append((parent.id, person.id))
+            for spouse in person.spouses:
+                if spouse.id in generations and person.id < spouse.id:
+                    spouse_edges.append((person.id, spouse.id))
+        if validate:
+            for parent_id, child_id in parent_edges:
+                if generations[child_id] != generations[parent_id] + 1:
+                    raise GenError("Generation of parent {0} is not one less than child {1}".format(parent_id,
+                                                                                                    child_id))
+            for pid, spouse_id in spouse_edges:
+                if generations[pid] != generations[spouse_id]:
+                    raise GenError("Generation of spouse {0} is not equal to {1}".format(spouse_id, pid))
+
+        # Copy the unmatched people, then link every relation that is not already there
+        for person in other:
+            if person.id in targets:
+                target = targets[person.id]
+                for field in NameIndex.fields:
+                    if len(getattr(target, field)) == 0 and len(getattr(person, field)) > 0:
+                        setattr(target, field, getattr(person, field))
+                        stats["names_filled"] += 1
+            else:
+                target = Person._from_details(person.gender, tuple(getattr(person, f) for f in NameIndex.fields),
+                                              generations[person.id])
+                targets[person.id] = target
+                self.add_member(target)
+                stats["added"] += 1
+
+        for parent_id, child_id in parent_edges:
+            parent, child = targets[parent_id], targets[child_id]
+            if parent in child.parents:
+                stats["duplicate_edges"] += 1
+            else:
+                child.add_parent(parent, force_add=not validate)
+                stats["parent_edges_added"] += 1
+        for pid, spouse_id in spouse_edges:
+            person, spouse = targets[pid], targets[spouse_id]
+            if spouse in person.spouses:
+                stats["duplicate_edges"] += 1
+            else:
+                person.add_spouse(spouse, force_add=not validate)
+                stats["spouse_edges_added"] += 1
+
+        stats["seconds"] = time.perf_counter() - start
+        self.last_merge_stats = stats
+        return targets
+
+
+def infer_generations(keys, parent_edges, spouse_edges, known=None, strict=True):
+    """
+    Work out a generation number for every person in a group from how they are related, so that parents are one
+    generation before their children and spouses are in the same generation. Each group of connected people is numbered
+    starting from the generations already known for any of them, or otherwise so that its oldest generation is 0.
+    :param keys: an iterable of keys identifying the people
+    :param parent_edges: an iterable of (parent_key, child_key) tuples
+    :param spouse_edges: an iterable of (key, spouse_key) tuples
+    :param known: optional, a dictionary of generations that are already known, by key
+    :param strict: optional, default True. If True, raise a GenError if the relations cannot all be satisfied (for
+    example if someone married their cousin's child); if False, the first generation found for each person is kept.
+    :return: a dictionary mapping each key to a generation number
+    """
+    # Each neighbour is stored with the generation offset from the person to it
+    neighbours = dict((k, []) for k in keys)
+    for parent_key, child_key in parent_edges:
+        neighbours[parent_key].append((child_key, 1))
+        neighbours[child_key].append((parent_key, -1))
+    for key, other_key in spouse_edges:
+        neighbours[key].append((other_key, 0))
+        neighbours[other_key].append((key, 0))
+
+    known = dict() if known is None else known
+    generations = dict(known)
+    visited = set()
+    # Start from the people whose generations are known, so that they anchor the rest of their group
+    for start in list(known) + [k for k in neighbours if k not in known]:
+        if start in visited:
+            continue
+
+        anchored = start in known
+        if not anchored:
+            generations[start] = 0
+        visited.add(start)
+        group = [start]
+        to_visit = [start]
+        while len(to_visit) > 0:
+            key = to_visit.pop()
+            for other, offset in neighbours[key]:
+                gen = generations[key] + offset
+                if other not in visited:
+                    if other not in known:
+                        generations[other] = gen
+                    visited.add(other)
+                    group.append(other)
+                    to_visit.append(other)
+                if generations[other] != gen and strict:
+                    raise GenError("Inconsistent generations between {0} and {1}".format(key, other))
+
+        if not anchored:
+            oldest = min(generations[k] for k in group)
+            for k in group:
+                generations[k] -= oldest
+
+    return generations
+
+
+def _beyond_generation(generation, stop_generation, attr):
+    """
+    Internal function that checks whether a walk through "parents" or "children" has gone past stop_generation, see
+    Family._iter_lineage
+    :return: boolean; always False if stop_generation is None
+    """
+    if stop_generation is None:
+        return False
+    elif attr == "parents":
+        return generation < stop_generation
+    else:
+        return generation > stop_generation
 
-                if abs(gen_diff) > 1:
-                    relation = abs(gen_diff)*"great-" + relation
 
-                return relation
+def _merge_keys(person):
+    """
+    Internal function giving the keys under which Family.merge indexes a person: their gender and first name with each
+    of their last and unmarried names
+    :param person: an instance of Person
+    :return: a list of tuples
+    """
+    surnames = [n.casefold() for n in (person.last_name, person.unmarried_name) if len(n) > 0]
+    return [(person.gender.parent, person.first_name.casefold(), surname)
+            for surname in (surnames if len(surnames) > 0 else [""])]
+
+
+def _names_compatible(person, other):
+    """
+    Internal function that checks that two people with the same first and last names do not have different middle
+    names or suffixes. A name that is missing for either person does not count against them.
+    :param person: an instance of Person
+    :param other: an instance of Person
+    :return: boolean
+    """
+    for field in ("middle_name", "suffix"):
+        name, other_name = getattr(person, field), getattr(other, field)
+        if len(name) > 0 and len(other_name) > 0 and name.casefold() != other_name.casefold():
+            return False
+    return True
+
+
+def _relative_signature(person):
+    """
+    Internal function describing a person's relatives by relation and name, so that the same person can be recognized
+    in two families that do not share any instances of Person
+    :param person: an instance of Person
+    :return: a set of tuples
+    """
+    signature = set()
+    for relation, relatives in (("parent", person.parents), ("spouse", person.spouses), ("child", person.children)):
+        for rel in relatives:
+            for surname in (rel.last_name, rel.unmarried_name):
+                if len(surname) > 0:
+                    signature.add((relation, rel.first_name.casefold(), surname.casefold()))
+    return signature
+
+
+def relationship_label(other_gender, gen_diff, dist_to_anc, direct):
+    """
+    Name the blood relationship of one person to another from the shape of their family tree
+    :param other_gender: the instance of Gender of the person whose relationship is being named
+    :param gen_diff: the generation of the base person minus the generation of the other person
+    :param dist_to_anc: how many generations the nearest common ancestors are above whichever of the two people is
+    closer to them
+    :param direct: True if one of the two people is a direct ancestor of the other
+    :return: a string describing the relationship of the other person to the base person
+    """
+    # Okay, this is going to be a bit of a mess. We need to handle all the "special" cases first, i.e. parents,
+    # children, siblings, aunts, uncles, nieces, nephews. We'll start with direct relationships because those are
+    # reasonably straightforward
+    if direct:
+
+        if gen_diff > 0:
+            relation = other_gender.parent
+        else:
+            relation = other_gender.child
+            gen_diff = abs(gen_diff)
+
+        if gen_diff > 1:
+            relation = "grand" + relation
+        if gen_diff > 2:
+            relation = (gen_diff-2)*"great-" + relation
+
+        return relation
+
+    # Now it gets more complicated, because we're dealing with the pool of relationships that can be generically
+    # called "cousin" but which have some special cases
+    if dist_to_anc == 1:
+        # If one of the people in question is only one generation away from the common ancestors, we're in the
+        # special cases
+        if gen_diff == 0:
+            # siblings
+            return other_gender.sibling
         else:
-            # Now we're into the generic "cousin" territory. Remember, first cousins have grandparents in common, second
-            # cousins have great grandparents in common, etc. Cousins once removed are one generation apart, and the
-            # generation closer to the common ancestors is used to determine the degree.
-            relation = other_person.gender.cousin
-            relation = numtostr.ordinal_number(dist_to_anc) + " " + relation
-            if gen_diff != 0:
-                relation += " " + numtostr.repeat_number(abs(gen_diff)) + " removed"
+            if gen_diff > 0:
+                # the other person is younger, will be some sort of niece or nephew
+                relation = other_gender.auntuncle
+            else:
+                relation = other_gender.niecenephew
+
+            if abs(gen_diff) > 1:
+                relation = abs(gen_diff)*"great-" + relation
 
             return relation
+    else:
+        # Now we're into the generic "cousin" territory. Remember, first cousins have grandparents in common, second
+        # cousins have great grandparents in common, etc. Cousins once removed are one generation apart, and the
+        # generation closer to the common ancestors is used to determine the degree.
+        relation = other_gender.cousin
+        relation = numtostr.ordinal_number(dist_to_anc) + " " + relation
+        if gen_diff != 0:
+            relation += " " + numtostr.repeat_number(abs(gen_diff)) + " removed"
+
+        return relation
+
+
+def path_label(path):
+    """
+    Name the relationship of the last person on a path of relations to the person the path starts from. A path that
+    goes up through parents and then down through children is named as a blood relationship, the same way
+    get_relationship names it. A blood relationship of the first person's spouse, or the spouse of a blood relative,
+    is named as an in-law (e.g. "mother-in-law", "brother-in-law", "son-in-law") or step relation ("stepfather",
+    "stepdaughter"), using the titles of the last person's gender; the spouse of an aunt or uncle is an aunt or uncle.
+    For the path from Family.relationship_path, which is as short as possible, these are the usual meanings.
+    :param path: a sequence of (relation, person) steps as produced by Family.iter_neighborhood
+    :return: a string; "same person" for an empty path, and "relative by marriage" or "relative" for shapes that are not
+    named more specifically
+    """
+    if len(path) == 0:
+        return "same person"
+    relations = [relation for relation, _ in path]
+    gender = path[-1][1].gender
+    if relations == ["spouse"]:
+        return gender.spouse
+
+    label = _blood_path_label(relations, gender)
+    if label is not None:
+        return label
+
+    if relations[0] == "spouse":
+        ups, downs = _blood_path_shape(relations[1:])
+        if ups == 0:
+            return "step" + _blood_path_label(relations[1:], gender)
+        elif downs is not None:
+            return _blood_path_label(relations[1:], gender) + "-in-law"
+    if relations[-1] == "spouse":
+        ups, downs = _blood_path_shape(relations[:-1])
+        if downs == 0:
+            return "step" + _blood_path_label(relations[:-1], gender)
+        elif ups is not None and ups > downs == 1:
+            return _blood_path_label(relations[:-1], gender)
+        elif ups is not None:
+            return _blood_path_label(relations[:-1], gender) + "-in-law"
+    if relations[0] == relations[-1] == "spouse" and _blood_path_shape(relations[1:-1]) == (1, 1):
+        return gender.sibling + "-in-law"
+
+    if "spouse" in relations:
+        return "relative by marriage"
+    else:
+        return "relative"
+
+
+def _blood_path_shape(relations):
+    """
+    Internal function that checks whether a sequence of relations goes up through parents and then down through
+    children, as the path between blood relatives does
+    :param relations: a sequence of "parent", "spouse" and "child" strings
+    :return: a tuple (ups, downs) counting the parent and child steps, or (None, None) if the relations do not have that
+    shape or are empty
+    """
+    ups = 0
+    while ups < len(relations) and relations[ups] == "parent":
+        ups += 1
+    if len(relations) == 0 or any(relation != "child" for relation in relations[ups:]):
+        return None, None
+    return ups, len(relations) - ups
+
+
+def _blood_path_label(relations, gender):
+    """
+    Internal function that names the blood relationship along a sequence of relations, see path_label
+    :param relations: a sequence of "parent", "spouse" and "child" strings
+    :param gender: the instance of Gender of the last person on the path
+    :return: a string, or None if the relations are not the path between blood relatives
+    """
+    ups, downs = _blood_path_shape(relations)
+    if ups is None:
+        return None
+    return relationship_label(gender, ups - downs, min(ups, downs), ups == 0 or downs == 0)
+
+class RelationshipMatrix(object):
+    """
+    The relationships between every pair of people in a group, as computed by Family.relationship_matrix. The
+    relationships are stored as numeric codes in flat arrays, one entry per (base, other) pair; the string describing
+    each relationship is only built when asked for.
+    """
+    UNRELATED = 0
+    SAME = 1
+    DIRECT = 2
+    COLLATERAL = 3
+
+    def __init__(self, people, index):
+        """
+        Compute the relationship matrix. Use Family.relationship_matrix rather than calling this directly.
+        :param people: a list of instances of Person
+        :param index: an AncestryIndex containing all of those people
+        :return: none
+        """
+        self.people = people
+        self.index_of = dict((p.id, i) for i, p in enumerate(people))
+        n = len(people)
+        self.kinds = array("b", [self.UNRELATED]) * (n * n)
+        self.ancestor_generations = array("q", [0]) * (n * n)
+        self.generation_differences = array("q", [0]) * (n * n)
+        self._labels = dict()
+
+        generations = [p.generation for p in people]
+        bits = [index.ancestor_bits(p) for p in people]
+        dense = [index.index_of[p.id] for p in people]
+        for i in range(n):
+            self.kinds[i * n + i] = self.SAME
+            self.ancestor_generations[i * n + i] = generations[i]
+            for j in range(i + 1, n):
+                kind = self.UNRELATED
+                anc_gen = 0
+                if generations[i] < generations[j] and (bits[j] >> dense[i]) & 1:
+                    kind, anc_gen = self.DIRECT, generations[i]
+                elif generations[j] < generations[i] and (bits[i] >> dense[j]) & 1:
+                    kind, anc_gen = self.DIRECT, generations[j]
+                else:
+                    common = bits[i] & bits[j]
+                    if common:
+                        kind, anc_gen = self.COLLATERAL, index.people[common.bit_length() - 1].generation
+
+                diff = generations[i] - generations[j]
+                for k, d in ((i * n + j, diff), (j * n + i, -diff)):
+                    self.kinds[k] = kind
+                    self.ancestor_generations[k] = anc_gen
+                    self.generation_differences[k] = d
+
+    def __len__(self):
+        """
+        The number of people in the matrix
+        :return: an integer
+        """
+        return len(self.people)
+
+    def _position(self, base_person, other_person):
+        """
+        Internal method that finds where a pair of people is stored in the flat arrays
+        :param base_person: an instance of Person in the matrix
+        :param other_person: an instance of Person in the matrix
+        :return: an integer
+        """
+        return self.index_of[base_person.id] * len(self.people) + self.index_of[other_person.id]
+
+    def kind(self, base_person, other_person):
+        """
+        Get the kind of relationship between two people: RelationshipMatrix.UNRELATED, SAME, DIRECT (one is a direct
+        ancestor of the other) or COLLATERAL (they share common ancestors)
+        :param base_person: an instance of Person in the matrix
+        :param other_person: an instance of Person in the matrix
+        :return: an integer code
+        """
+        return self.kinds[self._position(base_person, other_person)]
+
+    def ancestor_generation(self, base_person, other_person):
+        """
+        Get the generation of the nearest common ancestors of two people
+        :param base_person: an instance of Person in the matrix
+        :param other_person: an instance of Person in the matrix
+        :return: the generation as an integer, or None if they are unrelated
+        """
+        k = self._position(base_person, other_person)
+        return None if self.kinds[k] == self.UNRELATED else self.ancestor_generations[k]
+
+    def generation_difference(self, base_person, other_person):
+        """
+        Get the generation of the base person minus that of the other person
+        :param base_person: an instance of Person in the matrix
+        :param other_person: an instance of Person in the matrix
+        :return: an integer
+        """
+        return self.generation_differences[self._position(base_person, other_person)]
+
+    def label(self, base_person, other_person):
+        """
+        Describe the relationship of the other person to the base person, as Family.get_relationship would
+        :param base_person: an instance of Person in the matrix
+        :param other_person: an instance of Person in the matrix
+        :return: a string
+        """
+        return self._label_at(self._position(base_person, other_person))
+
+    def __getitem__(self, pair):
+        """
+        Describe the relationship of the other person to the base person, i.e. matrix[base_person, other_person]
+        :param pair: a tuple of two instances of Person in the matrix, (base_person, other_person)
+        :return: a string
+        """
+        return self.label(*pair)
+
+    def _label_at(self, k):
+        """
+        Internal method that builds the description of the relationship stored at position k of the flat arrays. The
+        descriptions only depend on the numeric codes and the other person's gender, so they are cached on those.
+        :param k: the position in the arrays
+        :return: a string
+        """
+        kind = self.kinds[k]
+        if kind == self.UNRELATED:
+            return "unrelated"
+        elif kind == self.SAME:
+            return "same person"
+
+        n = len(self.people)
+        base_gen = self.people[k // n].generation
+        other = self.people[k % n]
+        gen_diff = self.generation_differences[k]
+        dist_to_anc = min(base_gen, other.generation) - self.ancestor_generations[k]
+        key = (id(other.gender), gen_diff, dist_to_anc, kind)
+        if key not in self._labels:
+            self._labels[key] = relationship_label(other.gender, gen_diff, dist_to_anc, kind == self.DIRECT)
+        return self._labels[key]
+
+    def row(self, base_person):
+        """
+        Describe the relationship of every person in the matrix to the base person
+        :param base_person: an instance of Person in the matrix
+        :return: a list of strings, in the same order as the people attribute
+        """
+        n = len(self.people)
+        start = self.index_of[base_person.id] * n
+        return [self._label_at(k) for k in range(start, start + n)]
+
+    def to_records(self):
+        """
+        Iterate over every pair in the matrix, in the manner of the rows of a table
+        :return: a generator of dictionaries with keys "base", "other", "ancestor_generation", "generation_difference"
+        and "relationship"
+        """
+        for base in self.people:
+            for other in self.people:
+                yield {"base": base, "other": other,
+                       "ancestor_generation": self.ancestor_generation(base, other),
+                       "generation_difference": self.generation_difference(base, other),
+                       "relationship": self.label(base, other)}
 
 
 class Person(object):
     curr_id = 0
 
+    # Families can hold millions of people, so avoid giving each one a __dict__
+    __slots__ = ("id", "gender", "_first_name", "_middle_name", "_last_name", "_unmarried_name", "_suffix",
+                 "generation", "parents", "spouses", "children", "_families", "__weakref__")
+
     def __init__(self, gender, first="", middle="", last="", unmarried_name="", suffix="",
                  parent=None, spouse=None, child=None):
         """
@@ -276,6 +2260,9 @@ class Person(object):
         self.id = Person.curr_id
         Person.curr_id += 1
 
+        # Families this person is a member of, which need to be told when names or relations change
+        self._families = []
+
         self.gender = gender
         self.first_name = first
         self.middle_name = middle
@@ -302,6 +2289,88 @@ class Person(object):
 
 
 
+    @classmethod
+    def _from_details(cls, gender, names, generation):
+        """
+        Internal method that creates a person with no relations without going through the checks in __init__. Used by
+        Family.bulk_load, which checks its input all at once.
+        :param gender: an instance of Gender
+        :param names: a tuple of (first, middle, last, unmarried_name, suffix) strings
+        :param generation: the generation, as an integer
+        :return: a new instance of Person
+        """
+        self = cls.__new__(cls)
+        self.id = Person.curr_id
+        Person.curr_id += 1
+        self._families = []
+        self.gender = gender
+        self._first_name, self._middle_name, self._last_name, self._unmarried_name, self._suffix = \
+            [sys.intern(n) for n in names]
+        self.generation = generation
+        self.parents = []
+        self.spouses = []
+        self.children = []
+        return self
+
+    @property
+    def first_name(self):
+        return self._first_name
+
+    @first_name.setter
+    def first_name(self, value):
+        self._set_name("first_name", value)
+
+    @property
+    def middle_name(self):
+        return self._middle_name
+
+    @middle_name.setter
+    def middle_name(self, value):
+        self._set_name("middle_name", value)
+
+    @property
+    def last_name(self):
+        return self._last_name
+
+    @last_name.setter
+    def last_name(self, value):
+        self._set_name("last_name", value)
+
+    @property
+    def unmarried_name(self):
+        return self._unmarried_name
+
+    @unmarried_name.setter
+    def unmarried_name(self, value):
+        self._set_name("unmarried_name", value)
+
+    @property
+    def suffix(self):
+        return self._suffix
+
+    @suffix.setter
+    def suffix(self, value):
+        self._set_name("suffix", value)
+
+    def _set_name(self, field, value):
+        """
+        Internal method that changes one of this person's names and lets any family they belong to know about it. Names
+        are interned, since the same surnames in particular are repeated many times in a family.
+        :param field: which name to change, one of NameIndex.fields
+        :param value: the new name, as a string
+        :return: none
+        """
+        if type(value) is not str:
+            raise TypeError("{0} must be str".format(field))
+        value = sys.intern(value)
+
+        attr = "_" + field
+        old_value = getattr(self, attr, None)
+        setattr(self, attr, value)
+        if old_value is not None and old_value != value:
+            for fam in self._families:
+                fam._name_changed(self, field, old_value, value)
+
     def __eq__(self, other):
         """
         Check if "other" is the same person as this one
@@ -313,6 +2382,14 @@ class Person(object):
         else:
             return self.id == other.id
 
+    def __hash__(self):
+        """
+        Hash this person by their id, consistent with __eq__, so that instances of Person can be used in sets and as
+        dictionary keys
+        :return: an integer
+        """
+        return hash(self.id)
+
     def __repr__(self):
         """
         String representation of this person
@@ -402,21 +2479,43 @@ class Person(object):
             if person.generation != target_gen:
                 raise GenError("Generation of {0} is not {1} mine".format(relation, error_str))
 
+        # If the other person did not have the relation yet, it is added to them too, and they let both people's
+        # families know about it
         if relation.lower() == "parent":
             self.parents.append(person)
-            if self not in person.children:
+            linked_back = self in person.children
+            if not linked_back:
                 person.add_child(self)
         elif relation.lower() == "child":
             self.children.append(person)
-            if self not in person.parents:
+            linked_back = self in person.parents
+            if not linked_back:
                 person.add_parent(self)
         elif relation.lower() == "spouse":
             self.spouses.append(person)
-            if self not in person.spouses:
+            linked_back = self in person.spouses
+            if not linked_back:
                 person.add_spouse(self)
         else:
             raise ValueError("Relation {0} not recognized".format(relation))
 
+        self._relation_changed(person, relation.lower(), notify_other=linked_back)
+
+    def _relation_changed(self, person, relation, notify_other=False):
+        """
+        Internal method that lets every family this person belongs to know that one of their relations changed
+        :param person: the instance of Person that was added or removed as a relation
+        :param relation: the kind of relation, "parent", "child" or "spouse"
+        :param notify_other: optional, default False. If True, the families the other person belongs to are told as
+        well, for a change that the other person does not report themselves (remove_relation only changes one side).
+        :return: none
+        """
+        families = list(self._families)
+        if notify_other:
+            families.extend(fam for fam in person._families if not any(fam is f for f in families))
+        for fam in families:
+            fam._relation_changed(self, person, relation)
+
     def add_parent(self, parent, force_add=False):
         """
         Add a parent to this person (links another instance of Person as the parent to this instance)
@@ -455,10 +2554,13 @@ class Person(object):
         """
         if person in self.parents:
             self.parents.remove(person)
+            self._relation_changed(person, "parent", notify_other=True)
         elif person in self.children:
             self.children.remove(person)
+            self._relation_changed(person, "child", notify_other=True)
         elif person in self.spouses:
             self.spouses.remove(person)
+            self._relation_changed(person, "spouse", notify_other=True)
 
     def delete_me(self):
         for rel in self.iterrels():
@@ -471,6 +2573,10 @@ class Gender(object):
     Class representing the gender of a person. Contains the proper titles for familial relations, even typically gender
     neutral relationships like "cousin" (just in case that also needs to become gender-specific)
     """
+    __slots__ = ("_parent", "_child", "_sibling", "_spouse", "_auntuncle", "_niecenephew", "_cousin")
+    # The names of the titles, in the order __init__ takes them; used to store and rebuild custom genders
+    title_names = ("parent", "child", "sibling", "spouse", "auntuncle", "niecenephew", "cousin")
+
     @property
     def parent(self):
         return self._parent
@@ -535,9 +2641,36 @@ class Gender(object):
         self._niecenephew = niecenephew_title
         self._cousin = cousin_title
 
+    def titles(self):
+        """
+        Get all the titles of this gender, in the order of title_names (which is also the order Gender takes them in)
+        :return: a tuple of strings
+        """
+        return tuple(getattr(self, t) for t in self.title_names)
+
 male = Gender("father", "son", "brother", "husband", "uncle", "nephew")
 female = Gender("mother", "daughter", "sister", "wife", "aunt", "niece")
 neuter = Gender("parent", "child", "sibling", "spouse", "pibling", "nibling")
+_builtin_genders = dict((g.titles(), g) for g in (male, female, neuter))
+
+
+def gender_from_titles(titles, known=None):
+    """
+    Get the gender with the given titles, for rebuilding a gender that was stored as its titles (see Gender.titles).
+    :param titles: a sequence of the seven titles, in the order of Gender.title_names
+    :param known: optional, a dictionary of the custom genders rebuilt so far, by their titles. A new Gender is only
+    created if the titles are not in it, and is then added to it, so everyone stored with the same titles shares one
+    Gender.
+    :return: male, female or neuter if the titles are theirs, otherwise an instance of Gender
+    """
+    titles = tuple(titles)
+    if titles in _builtin_genders:
+        return _builtin_genders[titles]
+    if known is None:
+        return Gender(*titles)
+    if titles not in known:
+        known[titles] = Gender(*titles)
+    return known[titles]
 
 def import_test():
     print("Successful import of {0}".format(__name__))
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+
+from .pygenelib import GenError, NameIndex
+
+"""
+A small asyncio HTTP server answering JSON queries about a family that is loaded once at startup. Requests are
+POSTed as JSON objects to one of the endpoints
+
+    /search             {"first": ..., "middle": ..., "last": ..., "unmarried_name": ..., "suffix": ...,
+                         "any_name": ..., "mode": "exact" | "prefix" | "substring"}
+    /ancestors          {"person": id, "generation": g}
+    /common_ancestors   {"person1": id, "person2": id}
+    /relationship       {"base": id, "other": id}
+
+and GET /health reports the size of the family. People in responses are given as {"id", "name", "generation"}.
+
+Queries arriving at about the same time are collected into batches, and each batch is answered by a single job on an
+executor, so the event loop only ever waits on I/O and stays responsive however many queries are in flight. The
+executor has one thread by default, since a Family is not safe to query from several threads at once. The queries in a
+batch share work: common ancestor and relationship queries are answered from one ancestry index of everyone in the
+batch, ancestor queries about the same person from one walk of their ancestry, and identical searches only once.
+
+Run it with, for example, "python -m PyGeneology.server --snapshot family.snap --port 8080".
+"""
+
+
+class QueryError(Exception):
+    """
+    Error raised for a query that cannot be answered, reported to the client with an HTTP status
+    """
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def person_json(person):
+    return {"id": person.id, "name": person.fullname(), "generation": person.generation}
+
+
+class QueryBatcher(object):
+    """
+    Collects queries of one kind and answers them in batches. The first query to arrive starts a short window; every
+    query that arrives before it closes (or until max_batch queries are waiting) is answered by the same executor job.
+    """
+    def __init__(self, handler, executor, window=0.002, max_batch=256):
+        """
+        Create a batcher
+        :param handler: a function taking a list of queries and returning a list of results (or exceptions to report
+        for individual queries) in the same order. It is run on the executor.
+        :param executor: the concurrent.futures executor to run the handler on
+        :param window: optional, how long in seconds to wait for more queries before answering a batch
+        :param max_batch: optional, the largest number of queries in one batch
+        :return: none
+        """
+        self.handler = handler
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._flush_handle = None
+        self.batches = 0
+        self.queries = 0
+
+    async def submit(self, query):
+        """
+        Queue a query and wait for its result
+        :param query: the query, in whatever form the handler takes
+        :return: the result
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(self._pending) == 0:
+            return
+        batch, self._pending = self._pending, []
+        self.batches += 1
+        self.queries += len(batch)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.handler, [q for q, _ in batch])
+        except Exception as err:
+            results = [err] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class FamilyServer(object):
+    """
+    Answers HTTP/JSON queries about one family; see the module documentation for the endpoints
+    """
+    def __init__(self, family, executor=None, window=0.002, max_batch=256, max_body=1 << 20):
+        """
+        Create a server for a family
+        :param family: the instance of Family to query
+        :param executor: optional, the executor to run queries on. By default a single worker thread.
+        :param window: optional, see QueryBatcher
+        :param max_batch: optional, see QueryBatcher
+        :param max_body: optional, the largest request body in bytes that is accepted; larger requests are answered
+        with status 413 and the connection is closed
+        :return: none
+        """
+        self.family = family
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(max_workers=1) if executor is None else executor
+        self.batchers = dict((path, QueryBatcher(handler, self.executor, window=window, max_batch=max_batch))
+                             for path, handler in (("/search", self._search_batch),
+                                                   ("/ancestors", self._ancestors_batch),
+                                                   ("/common_ancestors", self._common_ancestors_batch),
+                                                   ("/relationship", self._relationship_batch)))
+        self._server = None
+
+    # Batch handlers, run on the executor. Each returns one result (or QueryError) per query, in the same order.
+
+    def _answer_each(self, queries, answer):
+        # Errors are caught per query, so that one bad query does not fail the others in its batch
+        results = []
+        for q in queries:
+            try:
+                results.append(answer(q))
+            except QueryError as err:
+                results.append(err)
+            except (GenError, TypeError, ValueError, KeyError) as err:
+                results.append(QueryError(str(err)))
+            except Exception as err:
+                results.append(QueryError("{0}: {1}".format(type(err).__name__, err), status=500))
+        return results
+
+    def _member(self, query, key):
+        if key not in query:
+            raise QueryError("Missing {0}".format(key))
+        person = self.family.get_member(query[key])
+        if person is None:
+            raise QueryError("No member with id {0}".format(query[key]), status=404)
+        return person
+
+    def _answer_together(self, queries, prepare, answer_all, answer_one):
+        # Each query is checked on its own, then all the valid ones are answered by a single call so that they can share
+        # work. If that call fails, they are answered one at a time, so that only the queries causing the error fail.
+        prepared = self._answer_each(queries, prepare)
+        valid = [i for i, item in enumerate(prepared) if not isinstance(item, Exception)]
+        items = [prepared[i] for i in valid]
+        try:
+            answers = answer_all(items) if len(items) > 0 else []
+        except Exception:
+            answers = self._answer_each(items, answer_one)
+        for i, answer in zip(valid, answers):
+            prepared[i] = answer
+        return prepared
+
+    def _search_batch(self, queries):
+        def prepare(q):
+            names = dict((k, q[k]) for k in ("first", "middle", "last", "unmarried_name", "suffix", "any_name")
+                         if q.get(k) is not None)
+            for k, name in names.items():
+                if not isinstance(name, str):
+                    raise QueryError("{0} must be a string".format(k))
+            mode = q.get("mode", "exact")
+            if mode not in NameIndex.modes:
+                raise QueryError("mode must be one of {0}".format(", ".join(NameIndex.modes)))
+            return tuple(sorted(names.items())), mode
+
+        def answer_one(search):
+            names, mode = search
+            return [person_json(p) for p in self.family.search_by_name(mode=mode, **dict(names))]
+
+        def answer_all(searches):
+            # Identical searches in a batch are only made once
+            answers = dict()
+            for search in searches:
+                if search not in answers:
+                    answers[search] = answer_one(search)
+            return [answers[search] for search in searches]
+        return self._answer_together(queries, prepare, answer_all, answer_one)
+
+    def _ancestors_batch(self, queries):
+        def prepare(q):
+            person = self._member(q, "person")
+            if not isinstance(q.get("generation"), int):
+                raise QueryError("generation must be an integer")
+            if person.generation <= q["generation"]:
+                raise QueryError("Cannot have ancestor in same or younger generation")
+            return person, q["generation"]
+
+        def answer_one(query):
+            return [person_json(p) for p in self.family.ancestors_in_generation(*query)]
+
+        def answer_all(items):
+            # The ancestry of each person is walked once for all the generations asked about them
+            generations = dict()
+            for person, generation in items:
+                generations.setdefault(person.id, (person, set()))[1].add(generation)
+            found = dict((pid, self.family.ancestors_in_generations(person, gens))
+                         for pid, (person, gens) in generations.items())
+            return [[person_json(p) for p in found[person.id][generation]] for person, generation in items]
+        return self._answer_together(queries, prepare, answer_all, answer_one)
+
+    def _common_ancestors_batch(self, queries):
+        def prepare(q):
+            return self._member(q, "person1"), self._member(q, "person2")
+
+        def answer_all(pairs):
+            return [[person_json(p) for p in commons] for commons in self.family.common_ancestors_of_pairs(pairs)]
+        return self._answer_together(queries, prepare, answer_all,
+                                     lambda pair: [person_json(p) for p in self.family.common_ancestors(*pair)])
+
+    def _relationship_batch(self, queries):
+        def prepare(q):
+            return self._member(q, "base"), self._member(q, "other")
+        return self._answer_together(queries, prepare, self.family.get_relationships,
+                                     lambda pair: self.family.get_relationship(*pair))
+
+    # HTTP
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests made on one connection, keeping it open between requests unless the client asks otherwise
+        :param reader: the asyncio.StreamReader of the connection
+        :param writer: the asyncio.StreamWriter of the connection
+        :return: none
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self._respond(writer, 400, {"error": "Malformed request line"}, keep_alive=False)
+                    break
+                method, path, version = parts
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {"error": "Malformed Content-Length"}, keep_alive=False)
+                    break
+                elif length > self.max_body:
+                    await self._respond(writer, 413, {"error": "The body must be at most {0} bytes".format(
+                        self.max_body)}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" and (version == "HTTP/1.1" or connection == "keep-alive")
+                status, response = await self.dispatch(method, path, body)
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        """
+        Answer one request
+        :param method: the HTTP method, e.g. "POST"
+        :param path: the requested path
+        :param body: the body of the request, as bytes
+        :return: a tuple (status, response), where response is a value that can be written as JSON
+        """
+        path = path.split("?", 1)[0]
+        if path == "/health":
+            return 200, {"status": "ok", "members": len(self.family)}
+        batcher = self.batchers.get(path)
+        if batcher is None:
+            return 404, {"error": "Unknown endpoint {0}".format(path)}
+        if method != "POST":
+            return 405, {"error": "Use POST for {0}".format(path)}
+
+        try:
+            query = json.loads(body.decode("utf-8")) if len(body) > 0 else dict()
+        except ValueError:
+            return 400, {"error": "The body must be a JSON object"}
+        if not isinstance(query, dict):
+            return 400, {"error": "The body must be a JSON object"}
+
+        try:
+            return 200, {"result": await batcher.submit(query)}
+        except QueryError as err:
+            return err.status, {"error": str(err)}
+        except Exception as err:
+            return 500, {"error": "{0}: {1}".format(type(err).__name__, err)}
+
+    async def _respond(self, writer, status, response, keep_alive):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                   413: "Payload Too Large", 500: "Internal Server Error"}
+        body = json.dumps(response).encode("utf-8")
+        head = "HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: {3}\r\n\r\n" \
+            .format(status, reasons.get(status, ""), len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=8080):
+        """
+        Start listening for connections
+        :param host: optional, the address to listen on
+        :param port: optional, the port to listen on; 0 picks a free one
+        :return: the asyncio server. Its sockets give the address actually used.
+        """
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        return self._server
+
+    async def close(self):
+        """
+        Stop listening and shut down the executor
+        :return: none
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.executor.shutdown(wait=False)
+
+
+def load_family(args):
+    """
+    Load the family named by the command line arguments
+    :param args: the parsed arguments, see main
+    :return: an instance of Family
+    """
+    if args.snapshot is not None:
+        from .snapshot import open_snapshot
+        return open_snapshot(args.snapshot)
+    elif args.gedcom is not None:
+        from .gedcom import read_gedcom
+        return read_gedcom(args.gedcom)
+    elif args.jsonl is not None:
+        from .jsonl import read_jsonl
+        return read_jsonl(args.jsonl)
+    else:
+        from .synthetic import synthetic_family
+        return synthetic_family(args.synthetic, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve queries about a family over HTTP/JSON")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--snapshot", help="a snapshot file written by PyGeneology.snapshot.write_snapshot")
+    source.add_argument("--gedcom", help="a GEDCOM file")
+    source.add_argument("--jsonl", nargs="+", help="one or more JSON Lines files")
+    source.add_argument("--synthetic", type=int, help="serve a synthetic family of this many people")
+    parser.add_argument("--seed", type=int, default=0, help="seed for --synthetic")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--window", type=float, default=0.002, help="batching window in seconds")
+    args = parser.parse_args(argv)
+
+    family = load_family(args)
+
+    async def serve():
+        server = FamilyServer(family, window=args.window)
+        listener = await server.start(args.host, args.port)
+        print("Serving {0} people on {1}".format(len(family), ", ".join(
+            "{0}:{1}".format(*s.getsockname()[:2]) for s in listener.sockets)), file=sys.stderr)
+        try:
+            await listener.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+from array import array
+import mmap
+import struct
+import sys
+
+from .pygenelib import Gender, NameIndex, gender_from_titles
+from .columnar import ColumnStore, ColumnarFamily
+
+"""
+A binary snapshot format for families. A snapshot is a ColumnStore written to disk as a short header followed by each
+column as a raw little-endian array, including the name postings and generation order that searches use. Opening a
+snapshot memory-maps the file and wraps each section in a memoryview, so no matter how large the family is, loading it
+costs a few page faults rather than a parse, and pages are only read from disk as queries touch them.
+"""
+
+MAGIC = b"PYGNSNAP"
+VERSION = 1
+
+# Header: magic, format version, number of people, number of distinct strings, number of genders, number of sections.
+# It is followed by a table giving the (offset, length in bytes) of each section, in the order of _sections().
+_header = struct.Struct("<8sIqqqI")
+_section_entry = struct.Struct("<qq")
+_alignment = 8
+
+
+def _sections():
+    """
+    Internal function that lists the sections of a snapshot
+    :return: a list of (name, typecode) tuples
+    """
+    sections = [("ids", "q"), ("gender_codes", "H"), ("generations", "i")]
+    sections.extend(("name:" + f, "i") for f in NameIndex.fields)
+    for relation in ColumnStore.relations:
+        sections.extend([("links:{0}:offsets".format(relation), "q"), ("links:{0}:rows".format(relation), "i")])
+    sections.extend([("string_offsets", "q"), ("string_data", "B"), ("gender_titles", "i")])
+    for field in NameIndex.fields:
+        sections.extend([("postings:{0}:offsets".format(field), "q"), ("postings:{0}:rows".format(field), "i")])
+    sections.extend([("folded_order", "i"), ("generation_order", "i")])
+    return sections
+
+
+class SnapshotError(Exception):
+    """
+    Error raised when a file is not a snapshot this version of the library can read
+    """
+    pass
+
+
+class _StringTable(object):
+    """
+    The string table of an open snapshot. Strings are decoded from the mapped UTF-8 data the first time they are
+    requested and kept after that.
+    """
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+        self._decoded = dict()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("string index out of range")
+        try:
+            return self._decoded[i]
+        except KeyError:
+            value = sys.intern(str(self._data[self._offsets[i]:self._offsets[i + 1]], "utf-8"))
+            self._decoded[i] = value
+            return value
+
+
+class SnapshotStore(ColumnStore):
+    """
+    A ColumnStore whose columns are memoryviews of a memory-mapped snapshot file. Call close (or use the store, or the
+    family returned by open_snapshot, as a context manager) to unmap the file once it is no longer needed; the store
+    and any PersonView created from it cannot be used after that.
+    """
+    def __init__(self, mapping, views, **columns):
+        """
+        Create a store over a mapped snapshot. Use open_snapshot rather than calling this directly.
+        :param mapping: the mmap object
+        :param views: every memoryview of the mapping held by the columns, so they can be released on close
+        :param columns: the keyword arguments to ColumnStore
+        :return: none
+        """
+        ColumnStore.__init__(self, **columns)
+        self._mapping = mapping
+        self._views = views
+
+    def close(self):
+        """
+        Release the columns and unmap the file
+        :return: none
+        """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SnapshotFamily(ColumnarFamily):
+    """
+    The read-only family returned by open_snapshot
+    """
+    def close(self):
+        """
+        Unmap the snapshot file backing this family; see SnapshotStore.close
+        :return: none
+        """
+        self._store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _store_columns(store):
+    """
+    Internal function that collects the columns of a ColumnStore in the order of _sections()
+    :param store: a ColumnStore
+    :return: a list of sequences of numbers, one per section
+    """
+    # The gender titles are stored in the string table after the names
+    strings = list(store.strings)
+    string_pos = dict()
+    gender_titles = array("i")
+    for gender in store.genders:
+        for value in gender.titles():
+            if value not in string_pos:
+                string_pos[value] = len(strings)
+                strings.append(value)
+            gender_titles.append(string_pos[value])
+
+    string_offsets = array("q", [0])
+    string_data = bytearray()
+    for value in strings:
+        string_data.extend(value.encode("utf-8"))
+        string_offsets.append(len(string_data))
+
+    columns = [store.ids, store.gender_codes, store.generations]
+    columns.extend(store.names[f] for f in NameIndex.fields)
+    for relation in ColumnStore.relations:
+        columns.extend(store.links[relation])
+    columns.extend([string_offsets, string_data, gender_titles])
+    for field in NameIndex.fields:
+        offsets, rows = store.name_postings[field]
+        # Title strings have no rows in any field, so their postings are empty
+        offsets = array("q", offsets)
+        offsets.extend([offsets[-1]] * (len(strings) - len(store.strings)))
+        columns.extend([offsets, rows])
+    columns.extend([store.folded_order, store.generation_order])
+    return columns, len(strings)
+
+
+def write_snapshot(family, dest):
+    """
+    Write a family to a snapshot file that open_snapshot can map back in
+    :param family: an instance of Family. Relations to people who are not members of the family are left out.
+    :param dest: the path to write to, or a binary file object open for writing
+    :return: the number of bytes written
+    """
+    store = family._store if isinstance(family, ColumnarFamily) else ColumnStore.from_people(family)
+    columns, n_strings = _store_columns(store)
+    sections = _sections()
+
+    encoded = []
+    for (name, typecode), column in zip(sections, columns):
+        column = array(typecode, column)
+        if sys.byteorder != "little":
+            column.byteswap()
+        encoded.append(column.tobytes())
+
+    table = []
+    offset = _header.size + _section_entry.size * len(sections)
+    for data in encoded:
+        offset += -offset % _alignment
+        table.append((offset, len(data)))
+        offset += len(data)
+
+    if hasattr(dest, "write"):
+        return _write_sections(dest, store, n_strings, table, encoded)
+    with open(dest, "wb") as f:
+        return _write_sections(f, store, n_strings, table, encoded)
+
+
+def _write_sections(f, store, n_strings, table, encoded):
+    f.write(_header.pack(MAGIC, VERSION, len(store), n_strings, len(store.genders), len(table)))
+    for entry in table:
+        f.write(_section_entry.pack(*entry))
+    position = _header.size + _section_entry.size * len(table)
+    for (offset, length), data in zip(table, encoded):
+        f.write(b"\0" * (offset - position))
+        f.write(data)
+        position = offset + length
+    return position
+
+
+def open_snapshot(path, cache_size=1024):
+    """
+    Open a snapshot written by write_snapshot. The file is memory-mapped read-only, and the returned family reads its
+    columns directly from the mapping.
+    :param path: the path to the snapshot file
+    :param cache_size: optional, see Family
+    :return: a SnapshotFamily. Close it when done to unmap the file.
+    """
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    views = []
+    try:
+        store = _map_store(mapping, views)
+    except Exception:
+        for view in reversed(views):
+            view.release()
+        mapping.close()
+        raise
+    return SnapshotFamily(store, cache_size=cache_size)
+
+
+def _map_store(mapping, views):
+    """
+    Internal function that checks the header of a mapped snapshot and builds a SnapshotStore over its sections
+    :param mapping: the mmap object
+    :param views: a list that every memoryview created is appended to
+    :return: a SnapshotStore
+    """
+    if len(mapping) < _header.size:
+        raise SnapshotError("File is too short to be a snapshot")
+    magic, version, n_people, n_strings, n_genders, n_sections = _header.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise SnapshotError("File is not a snapshot")
+    if version != VERSION:
+        raise SnapshotError("Snapshot format version {0} is not supported (expected {1})".format(version, VERSION))
+    sections = _sections()
+    if n_sections != len(sections):
+        raise SnapshotError("Snapshot has {0} sections, expected {1}".format(n_sections, len(sections)))
+
+    whole = memoryview(mapping)
+    views.append(whole)
+    columns = dict()
+    for i, (name, typecode) in enumerate(sections):
+        offset, length = _section_entry.unpack_from(mapping, _header.size + i * _section_entry.size)
+        if offset < 0 or length < 0 or offset + length > len(mapping):
+            raise SnapshotError("Section {0} extends past the end of the file".format(name))
+        raw = whole[offset:offset + length]
+        views.append(raw)
+        if sys.byteorder != "little":
+            # The file is little-endian, so on big-endian machines the columns are copied and swapped instead
+            column = array(typecode, raw.tobytes())
+            column.byteswap()
+        else:
+            column = raw.cast(typecode)
+            views.append(column)
+        columns[name] = column
+
+    strings = _StringTable(columns["string_offsets"], columns["string_data"])
+    titles = columns["gender_titles"]
+    n_titles = len(Gender.title_names)
+    genders = [gender_from_titles(strings[titles[g * n_titles + t]] for t in range(n_titles)) for g in range(n_genders)]
+
+    names = dict((f, columns["name:" + f]) for f in NameIndex.fields)
+    links = dict((r, (columns["links:{0}:offsets".format(r)], columns["links:{0}:rows".format(r)]))
+                 for r in ColumnStore.relations)
+    postings = dict((f, (columns["postings:{0}:offsets".format(f)], columns["postings:{0}:rows".format(f)]))
+                    for f in NameIndex.fields)
+    return SnapshotStore(mapping, views, ids=columns["ids"], gender_codes=columns["gender_codes"], genders=genders,
+                         generations=columns["generations"], strings=strings, names=names, links=links,
+                         name_postings=postings, folded_order=columns["folded_order"],
+                         generation_order=columns["generation_order"])
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+import sqlite3
+import weakref
+
+from .pygenelib import Family, Gender, NameIndex, Person, GenError, gender_from_titles, male, female, neuter
+
+"""
+A Family whose members are kept in a SQLite database rather than as Python objects. Names are stored alongside their
+case-folded forms in indexed columns, so search_by_name is answered by the database, and ancestry queries walk the
+parent/child edge table with recursive common table expressions. Person objects are only created for the people a
+query actually returns, and an identity map makes sure each id gives the same object for as long as it is in use.
+"""
+
+# The largest code point, so that every string starting with a prefix sorts before prefix + _max_char
+_max_char = "\U0010ffff"
+# Ids are passed to IN (...) queries in batches no larger than SQLite's default limit on the number of parameters
+_batch_size = 500
+
+_schema = """
+CREATE TABLE IF NOT EXISTS genders (
+    code INTEGER PRIMARY KEY, parent TEXT, child TEXT, sibling TEXT, spouse TEXT, auntuncle TEXT, niecenephew TEXT,
+    cousin TEXT
+);
+CREATE TABLE IF NOT EXISTS people (
+    id INTEGER PRIMARY KEY, gender INTEGER NOT NULL REFERENCES genders(code), generation INTEGER NOT NULL,
+    first_name TEXT NOT NULL, middle_name TEXT NOT NULL, last_name TEXT NOT NULL, unmarried_name TEXT NOT NULL,
+    suffix TEXT NOT NULL, first_name_folded TEXT NOT NULL, middle_name_folded TEXT NOT NULL,
+    last_name_folded TEXT NOT NULL, unmarried_name_folded TEXT NOT NULL, suffix_folded TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS people_generation ON people (generation);
+CREATE INDEX IF NOT EXISTS people_first_name ON people (first_name_folded);
+CREATE INDEX IF NOT EXISTS people_middle_name ON people (middle_name_folded);
+CREATE INDEX IF NOT EXISTS people_last_name ON people (last_name_folded);
+CREATE INDEX IF NOT EXISTS people_unmarried_name ON people (unmarried_name_folded);
+CREATE INDEX IF NOT EXISTS people_suffix ON people (suffix_folded);
+CREATE TABLE IF NOT EXISTS parents (
+    child_id INTEGER NOT NULL REFERENCES people(id) ON DELETE CASCADE,
+    parent_id INTEGER NOT NULL REFERENCES people(id) ON DELETE CASCADE,
+    UNIQUE (child_id, parent_id)
+);
+CREATE INDEX IF NOT EXISTS parents_parent ON parents (parent_id);
+CREATE TABLE IF NOT EXISTS spouses (
+    person_id INTEGER NOT NULL REFERENCES people(id) ON DELETE CASCADE,
+    spouse_id INTEGER NOT NULL REFERENCES people(id) ON DELETE CASCADE,
+    UNIQUE (person_id, spouse_id)
+);
+"""
+
+_person_columns = "id, gender, generation, " + ", ".join(NameIndex.fields)
+
+# A person and all their ancestors, with the number of parent steps to each; the steps are capped at the number of
+# people so that the query ends even if relations were forced into a loop
+_ancestors_cte = """
+WITH RECURSIVE up(id, dist) AS (
+    SELECT ?, 0
+    UNION
+    SELECT parents.parent_id, up.dist + 1 FROM parents JOIN up ON parents.child_id = up.id
+    WHERE up.dist < (SELECT COUNT(*) FROM people)
+)
+"""
+
+# A person and all their descendants, the mirror image of _ancestors_cte
+_descendants_cte = """
+WITH RECURSIVE down(id, dist) AS (
+    SELECT ?, 0
+    UNION
+    SELECT parents.child_id, down.dist + 1 FROM parents JOIN down ON parents.parent_id = down.id
+    WHERE down.dist < (SELECT COUNT(*) FROM people)
+)
+"""
+
+# Inserts a relation only if both people are members
+_insert_if_members = "INSERT OR IGNORE INTO {0} SELECT ?1, ?2 WHERE EXISTS (SELECT 1 FROM people WHERE id = ?1) " \
+                     "AND EXISTS (SELECT 1 FROM people WHERE id = ?2)"
+
+
+class StoredPerson(Person):
+    """
+    A read-only Person loaded from a SqliteFamily. Its names, gender and generation are read when it is created; its
+    relations are looked up in the database each time they are asked for.
+    """
+    __slots__ = ("_family",)
+
+    def __init__(self, family, row):
+        """
+        Create a person from a row of the people table. Use SqliteFamily.get_member rather than calling this directly.
+        :param family: the SqliteFamily the person belongs to
+        :param row: a tuple of the columns in _person_columns
+        :return: none
+        """
+        self._family = family
+        self.id, gender_code, self.generation = row[:3]
+        self.gender = family._genders[gender_code]
+        self._first_name, self._middle_name, self._last_name, self._unmarried_name, self._suffix = row[3:]
+
+    @property
+    def parents(self):
+        return self._family._relatives("SELECT parent_id FROM parents WHERE child_id = ? ORDER BY rowid", self.id)
+
+    @property
+    def children(self):
+        return self._family._relatives("SELECT child_id FROM parents WHERE parent_id = ? ORDER BY rowid", self.id)
+
+    @property
+    def spouses(self):
+        return self._family._relatives("SELECT spouse_id FROM spouses WHERE person_id = ? ORDER BY rowid", self.id)
+
+    @property
+    def _families(self):
+        # Stored people cannot change, so there is never a family to notify
+        return ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("{0} is a read-only member of a SQLite family and cannot be modified".format(self))
+
+    first_name = property(Person.first_name.fget, _read_only)
+    middle_name = property(Person.middle_name.fget, _read_only)
+    last_name = property(Person.last_name.fget, _read_only)
+    unmarried_name = property(Person.unmarried_name.fget, _read_only)
+    suffix = property(Person.suffix.fget, _read_only)
+    add_parent = _read_only
+    add_child = _read_only
+    add_spouse = _read_only
+    remove_relation = _read_only
+    delete_me = _read_only
+
+
+class SqliteNameIndex(NameIndex):
+    """
+    A NameIndex that answers lookups with queries on the indexed case-folded name columns of a SqliteFamily
+    """
+    def __init__(self, family):
+        """
+        Create a name index for a family
+        :param family: a SqliteFamily
+        :return: none
+        """
+        self._family = family
+
+    def add(self, person):
+        raise TypeError("The name index of a SqliteFamily is kept by the database")
+
+    remove = add
+    update = add
+
+    def lookup(self, field, value, mode="exact"):
+        return self.search({field: value}, mode=mode)
+
+    def search(self, criteria, mode="exact"):
+        if mode not in self.modes:
+            raise ValueError("mode must be one of {0}".format(", ".join(self.modes)))
+        if len(criteria) == 0:
+            return set()
+
+        conditions = []
+        params = []
+        for field, value in criteria.items():
+            if field not in self.fields:
+                raise ValueError("{0} is not a name field".format(field))
+            column = field + "_folded"
+            key = value.casefold()
+            if mode == "exact":
+                conditions.append("{0} = ?".format(column))
+                params.append(key)
+            elif mode == "prefix":
+                # A range rather than LIKE, so that the index on the column can be used
+                conditions.append("{0} >= ? AND {0} < ?".format(column))
+                params.extend([key, key + _max_char])
+            else:
+                conditions.append("instr({0}, ?) > 0".format(column))
+                params.append(key)
+
+        query = "SELECT id FROM people WHERE " + " AND ".join(conditions)
+        return set(row[0] for row in self._family._conn.execute(query, params))
+
+
+class SqliteFamily(Family):
+    """
+    A family stored in a SQLite database. Members are added with add_member (or all at once with add_members or
+    SqliteFamily.from_family), which records each person together with their relations to people already in the
+    database, and are returned as StoredPerson instances, which are read-only. Members are listed in order of id.
+    """
+    def __init__(self, path=":memory:", cache_size=1024):
+        """
+        Open (creating it if necessary) a family database
+        :param path: optional, the path to the database file. The default keeps the database in memory.
+        :param cache_size: optional, see Family
+        :return: none
+        """
+        Family.__init__(self, cache_size=cache_size)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_schema)
+        self._name_index = SqliteNameIndex(self)
+        self._identity_map = weakref.WeakValueDictionary()
+
+        self._genders = dict()
+        self._gender_codes = dict()
+        rows = self._conn.execute("SELECT code, {0} FROM genders ORDER BY code".format(", ".join(Gender.title_names)))
+        for row in rows.fetchall():
+            self._register_gender(row[0], gender_from_titles(row[1:]))
+        with self._conn:
+            for gender in (male, female, neuter):
+                self._gender_code(gender)
+
+        # New people created in this process must not be given the id of someone already in the database
+        max_id = self._conn.execute("SELECT MAX(id) FROM people").fetchone()[0]
+        if max_id is not None and Person.curr_id <= max_id:
+            Person.curr_id = max_id + 1
+        self._update_oldest_generation()
+
+    @classmethod
+    def from_family(cls, family, path=":memory:", cache_size=1024):
+        """
+        Copy a family into a new database. Relations to people who are not members of the family are left out.
+        :param family: an instance of Family
+        :param path: optional, the path to the database file
+        :param cache_size: optional, see Family
+        :return: a SqliteFamily
+        """
+        fam = cls(path, cache_size=cache_size)
+        fam.add_members(family)
+        return fam
+
+    def close(self):
+        """
+        Close the database connection. The family and its members cannot be used after that.
+        :return: none
+        """
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _register_gender(self, code, gender):
+        self._genders[code] = gender
+        self._gender_codes[id(gender)] = code
+
+    def _gender_code(self, gender):
+        """
+        Internal method that gets the code a gender is stored under, storing it first if it is new. Must be called
+        inside a transaction.
+        :param gender: an instance of Gender
+        :return: an integer
+        """
+        code = self._gender_codes.get(id(gender))
+        if code is None:
+            cursor = self._conn.execute("INSERT INTO genders ({0}) VALUES (?, ?, ?, ?, ?, ?, ?)".format(
+                ", ".join(Gender.title_names)), gender.titles())
+            code = cursor.lastrowid
+            self._register_gender(code, gender)
+        return code
+
+    def _update_oldest_generation(self):
+        self.oldest_generation = self._conn.execute("SELECT MIN(generation) FROM people").fetchone()[0]
+
+    def _changed(self):
+        """
+        Internal method called after people are added or removed. Since that can change the ancestry of anyone
+        descended from them, all cached results are dropped.
+        :return: none
+        """
+        self.version += 1
+        self._ancestry_index_current = False
+        if self._relationship_cache is not None:
+            self._relationship_cache.clear()
+        if self._descendant_counts is not None:
+            self._descendant_counts.clear()
+        self._update_oldest_generation()
+
+    # Materializing people
+
+    def _materialize(self, ids):
+        """
+        Internal method that gets the StoredPerson for each of the given ids, loading those not already in use from the
+        database in batches
+        :param ids: a list of ids of members of the family
+        :return: a list of instances of StoredPerson, in the same order as ids
+        """
+        identity_map = self._identity_map
+        people = dict()
+        missing = []
+        for i in ids:
+            p = identity_map.get(i)
+            if p is None:
+                missing.append(i)
+            else:
+                people[i] = p
+
+        for start in range(0, len(missing), _batch_size):
+            batch = missing[start:start + _batch_size]
+            rows = self._conn.execute("SELECT {0} FROM people WHERE id IN ({1})".format(
+                _person_columns, ", ".join("?" * len(batch))), batch)
+            for row in rows:
+                p = StoredPerson(self, row)
+                identity_map[p.id] = p
+                people[p.id] = p
+        return [people[i] for i in ids]
+
+    def _relatives(self, query, person_id):
+        return self._materialize([row[0] for row in self._conn.execute(query, (person_id,))])
+
+    def _query_people(self, query, params=()):
+        """
+        Internal method that runs a query selecting ids and materializes the people
+        :param query: an SQL query whose first column is a person id
+        :param params: optional, the parameters of the query
+        :return: a list of instances of StoredPerson
+        """
+        return self._materialize([row[0] for row in self._conn.execute(query, params)])
+
+    # Membership
+
+    @property
+    def members(self):
+        return self._query_people("SELECT id FROM people ORDER BY id")
+
+    def __contains__(self, person):
+        return isinstance(person, Person) and \
+            self._conn.execute("SELECT 1 FROM people WHERE id = ?", (person.id,)).fetchone() is not None
+
+    def __iter__(self):
+        # Fetch the people in pages rather than all at once, so iterating over a large family stays cheap on memory
+        last_id = None
+        while True:
+            if last_id is None:
+                page = self._query_people("SELECT id FROM people ORDER BY id LIMIT ?", (_batch_size,))
+            else:
+                page = self._query_people("SELECT id FROM people WHERE id > ? ORDER BY id LIMIT ?",
+                                          (last_id, _batch_size))
+            if len(page) == 0:
+                return
+            for p in page:
+                yield p
+            last_id = page[-1].id
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM people").fetchone()[0]
+
+    def get_member(self, person_id):
+        person = self._identity_map.get(person_id)
+        if person is None:
+            row = self._conn.execute("SELECT {0} FROM people WHERE id = ?".format(_person_columns),
+                                     (person_id,)).fetchone()
+            if row is not None:
+                person = StoredPerson(self, row)
+                self._identity_map[person_id] = person
+        return person
+
+    def add_member(self, person):
+        """
+        Add a person to the database, along with their relations to people already in it. Relations to people who are
+        added later are recorded when those people are added, as long as they still list this person as a relative.
+        Later changes to the instance of Person itself are not seen by the family; use get_member to get the stored
+        version.
+        :param person: an instance of Person
+        :return: none
+        """
+        self.add_members([person])
+
+    def add_members(self, people):
+        """
+        Add many people to the database in a single transaction; see add_member
+        :param people: an iterable of instances of Person
+        :return: none
+        """
+        people = list(people)
+        for person in people:
+            if not isinstance(person, Person):
+                raise TypeError("person must be an instance of Person")
+
+        with self._conn:
+            rows = []
+            for person in people:
+                names = [getattr(person, f) for f in NameIndex.fields]
+                rows.append([person.id, self._gender_code(person.gender), person.generation] + names +
+                            [n.casefold() for n in names])
+            try:
+                self._conn.executemany("INSERT INTO people VALUES ({0})".format(", ".join("?" * 13)), rows)
+            except sqlite3.IntegrityError:
+                raise ValueError("One of the people is already a member")
+
+            # Only link relatives that are in the database, now that everyone in this batch is
+            parent_rows = []
+            spouse_rows = []
+            for person in people:
+                parent_rows.extend((person.id, p.id) for p in person.parents)
+                parent_rows.extend((c.id, person.id) for c in person.children)
+                spouse_rows.extend((person.id, s.id) for s in person.spouses)
+                spouse_rows.extend((s.id, person.id) for s in person.spouses)
+            self._conn.executemany(_insert_if_members.format("parents"), parent_rows)
+            self._conn.executemany(_insert_if_members.format("spouses"), spouse_rows)
+        self._changed()
+
+    def remove_member(self, person):
+        """
+        Remove a person and all their relations from the database
+        :param person: an instance of Person
+        :return: none
+        """
+        if person not in self:
+            raise ValueError("Could not find {0} ({1}) in members".format(person.fullname(), person))
+        with self._conn:
+            self._conn.execute("DELETE FROM people WHERE id = ?", (person.id,))
+        self._identity_map.pop(person.id, None)
+        self._changed()
+
+    def bulk_load(self, records, edges=(), validate=True):
+        """
+        Create many people at once and add them to the database; see Family.bulk_load
+        """
+        staging = Family(cache_size=0)
+        people = staging.bulk_load(records, edges, validate=validate)
+        self.add_members(people.values())
+        return people
+
+    # Generations
+
+    def find_members_in_generation(self, generation):
+        return self._query_people("SELECT id FROM people WHERE generation = ? ORDER BY id", (generation,))
+
+    def generation_size(self, generation):
+        return self._conn.execute("SELECT COUNT(*) FROM people WHERE generation = ?", (generation,)).fetchone()[0]
+
+    @property
+    def generations(self):
+        return [row[0] for row in self._conn.execute("SELECT DISTINCT generation FROM people ORDER BY generation")]
+
+    # Search and ancestry
+
+    def _members_by_ids(self, ids):
+        return self._materialize(sorted(ids))
+
+    def iter_ancestors(self, person, count_paths=False):
+        """
+        Iterate over all the ancestors of the given person, nearest first (and then in order of id); see
+        Family.iter_ancestors. The ancestors are found by a single recursive query, unless count_paths is True.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        if count_paths:
+            for item in Family.iter_ancestors(self, person, count_paths=True):
+                yield item
+            return
+
+        rows = self._conn.execute(_ancestors_cte + "SELECT id, MIN(dist) AS d FROM up WHERE dist > 0 GROUP BY id "
+                                                   "ORDER BY d, id", (person.id,)).fetchall()
+        for p, (_, dist) in zip(self._materialize([r[0] for r in rows]), rows):
+            yield p, dist
+
+    def ancestors_in_generation(self, person, generation):
+        """
+        Finds all members of the family that are ancestors of the given person and in the given generation, in order of
+        id; see Family.ancestors_in_generation. The walk up the family tree stops at the requested generation.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        elif not isinstance(generation, int):
+            raise TypeError("generation must be an integer")
+        elif person.generation <= generation:
+            raise GenError("Cannot have ancestor in same or younger generation")
+
+        ancestors = self._query_people("""
+            WITH RECURSIVE up(id, generation) AS (
+                SELECT ?, ?
+                UNION
+                SELECT people.id, people.generation FROM up
+                JOIN parents ON parents.child_id = up.id JOIN people ON people.id = parents.parent_id
+                WHERE up.generation > ?
+            )
+            SELECT id FROM up WHERE generation = ? AND id != ? ORDER BY id
+            """, (person.id, person.generation, generation, generation, person.id))
+        self._add_query_work(len(ancestors), person.generation - generation)
+        return ancestors
+
+    def ancestors_in_generations(self, person, generations):
+        """
+        Finds the ancestors of the given person in each of several generations, with one query per generation; see
+        Family.ancestors_in_generations
+        """
+        return dict((g, self.ancestors_in_generation(person, g)) for g in generations)
+
+    def iter_descendants(self, person, count_paths=False):
+        """
+        Iterate over all the descendants of the given person, nearest first (and then in order of id); see
+        Family.iter_descendants. The descendants are found by a single recursive query, unless count_paths is True.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        if count_paths:
+            for item in Family.iter_descendants(self, person, count_paths=True):
+                yield item
+            return
+
+        rows = self._conn.execute(_descendants_cte + "SELECT id, MIN(dist) AS d FROM down WHERE dist > 0 GROUP BY id "
+                                                     "ORDER BY d, id", (person.id,)).fetchall()
+        for p, (_, dist) in zip(self._materialize([r[0] for r in rows]), rows):
+            yield p, dist
+
+    def descendants_in_generation(self, person, generation):
+        """
+        Finds all members of the family that are descendants of the given person and in the given generation, in order
+        of id; see Family.descendants_in_generation. The walk down the family tree stops at the requested generation.
+        """
+        if not isinstance(person, Person):
+            raise TypeError("person must be an instance of pygenelib.Person")
+        elif not isinstance(generation, int):
+            raise TypeError("generation must be an integer")
+        elif person.generation >= generation:
+            raise GenError("Cannot have descendant in same or older generation")
+
+        descendants = self._query_people("""
+            WITH RECURSIVE down(id, generation) AS (
+                SELECT ?, ?
+                UNION
+                SELECT people.id, people.generation FROM down
+                JOIN parents ON parents.parent_id = down.id JOIN people ON people.id = parents.child_id
+                WHERE down.generation < ?
+            )
+            SELECT id FROM down WHERE generation = ? AND id != ? ORDER BY id
+            """, (person.id, person.generation, generation, generation, person.id))
+        self._add_query_work(len(descendants), generation - person.generation)
+        return descendants
+
+    def _find_common_ancestors(self, member1, member2):
+        """
+        Internal method that does the work of common_ancestors, bypassing the cache. Both ancestries are found by
+        recursive queries and intersected in the database; the nearest common ancestors are returned in order of id.
+        """
+        index = self._current_ancestry_index()
+        if index is not None and member1 in index and member2 in index:
+            return index.common_ancestors(member1, member2)
+
+        if member1.generation <= member2.generation:
+            older, younger = member1, member2
+        else:
+            older, younger = member2, member1
+        # As in Family.common_ancestors, the older member only counts if they could be a direct ancestor
+        excluded_older = older.id if older.generation == younger.generation else None
+
+        rows = self._conn.execute("""
+            WITH RECURSIVE
+            up1(id) AS (SELECT ? UNION SELECT parents.parent_id FROM parents JOIN up1 ON parents.child_id = up1.id),
+            up2(id) AS (SELECT ? UNION SELECT parents.parent_id FROM parents JOIN up2 ON parents.child_id = up2.id)
+            SELECT people.id, people.generation FROM up1 JOIN up2 ON up1.id = up2.id JOIN people ON people.id = up1.id
+            WHERE people.id != ? AND people.id IS NOT ?
+            ORDER BY people.generation DESC, people.id
+            """, (younger.id, older.id, younger.id, excluded_older)).fetchall()
+
+        self.last_common_ancestor_stats = {"rows": len(rows)}
+        if len(rows) == 0:
+            self._add_query_work(len(rows), 0)
+            return []
+        nearest = rows[0][1]
+        self._add_query_work(len(rows), younger.generation - nearest)
+        return self._materialize([r[0] for r in rows if r[1] == nearest])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import math
+import random
+
+from .pygenelib import Family, male, female
+
+"""
+Generation of synthetic family trees for testing and benchmarking. Trees are grown one generation at a time from a set
+of founders: people marry someone of the opposite gender (either from outside the family or, at a configurable rate, a
+cousin, which gives pedigree collapse), and each couple has a random number of children. The same seed and parameters
+always give the same tree, so results measured on one can be compared across runs.
+"""
+
+first_names = {male: ["Arthur", "Bill", "Charlie", "Percy", "Fred", "George", "Ronald", "Harry", "James", "Albus",
+                      "Hugo", "Louis", "Teddy", "Neville", "Dean", "Seamus", "Oliver", "Cedric", "Remus", "Sirius"],
+               female: ["Molly", "Ginny", "Lily", "Rose", "Hermione", "Fleur", "Audrey", "Angelina", "Victoire",
+                        "Dominique", "Lucy", "Roxanne", "Luna", "Hannah", "Cho", "Katie", "Alicia", "Susan",
+                        "Padma", "Parvati"]}
+last_names = ["Weasley", "Potter", "Granger", "Lupin", "Longbottom", "Lovegood", "Thomas", "Finnigan", "Wood",
+              "Diggory", "Black", "Abbott", "Chang", "Bell", "Spinnet", "Bones", "Patil", "Brown", "Macmillan", "Boot",
+              "Corner", "Jordan", "Johnson", "Creevey", "Vane", "Hooper", "Jones", "Smith", "Edgecombe", "Fawcett"]
+
+
+def _poisson(rng, mean):
+    """
+    Internal function that draws a number from a Poisson distribution (Knuth's method, fine for small means)
+    :param rng: an instance of random.Random
+    :param mean: the mean of the distribution
+    :return: a non-negative integer
+    """
+    limit = math.exp(-mean)
+    k = 0
+    p = rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+def synthetic_records(size, depth=None, founders=None, fertility=2.5, marriage_rate=0.8, cousin_marriage_rate=0.02,
+                      seed=0):
+    """
+    Generate the people and relations of a synthetic family tree, in the form taken by Family.bulk_load
+    :param size: the maximum number of people to generate. Growth stops as soon as this is reached.
+    :param depth: optional, the maximum number of generations. By default there is no limit other than size.
+    :param founders: optional, the number of people in the first generation; by default about 1% of size (at least 2)
+    :param fertility: optional, the mean number of children per couple
+    :param marriage_rate: optional, the chance that each person marries, between 0 and 1
+    :param cousin_marriage_rate: optional, the chance that someone who marries marries a cousin (someone sharing a
+    grandparent with them, but not a parent) rather than someone from outside the family, if they have an unmarried
+    cousin available. Each such marriage makes the ancestries of their descendants overlap.
+    :param seed: optional, the seed for the random number generator
+    :return: a tuple (records, edges) of lists; records are dictionaries with the keys "key" (an integer), "gender",
+    "first", "last" and "generation", and edges are (key, relation, other_key) tuples
+    """
+    if size < 1:
+        raise ValueError("size must be at least 1")
+    for name, rate in (("marriage_rate", marriage_rate), ("cousin_marriage_rate", cousin_marriage_rate)):
+        if not 0 <= rate <= 1:
+            raise ValueError("{0} must be between 0 and 1".format(name))
+
+    rng = random.Random(seed)
+    founders = max(2, size // 100) if founders is None else founders
+    records = []
+    edges = []
+    # For each person generated: their parents' keys, and their grandparents' keys
+    parents_of = []
+    grandparents_of = []
+
+    def new_person(generation, last=None, gender=None):
+        if gender is None:
+            gender = male if rng.random() < 0.5 else female
+        key = len(records)
+        records.append({"key": key, "gender": gender, "first": rng.choice(first_names[gender]),
+                        "last": last if last is not None else rng.choice(last_names), "generation": generation})
+        parents_of.append(())
+        grandparents_of.append(())
+        return key
+
+    current = [new_person(0) for _ in range(min(founders, size))]
+    generation = 0
+    while len(current) > 0 and len(records) < size and (depth is None or generation + 1 < depth):
+        # Group this generation by grandparent, so a cousin can be picked without looking at everyone
+        by_grandparent = dict()
+        for key in current:
+            for g in grandparents_of[key]:
+                by_grandparent.setdefault(g, []).append(key)
+
+        married = set()
+        couples = []
+        for key in current:
+            if key in married or rng.random() >= marriage_rate:
+                continue
+            # Every couple may have children, so spouses are always of opposite genders
+            spouse = None
+            spouse_gender = female if records[key]["gender"] == male else male
+            if rng.random() < cousin_marriage_rate and len(grandparents_of[key]) > 0:
+                candidates = by_grandparent[rng.choice(grandparents_of[key])]
+                for _ in range(4):
+                    other = rng.choice(candidates)
+                    if other != key and other not in married and records[other]["gender"] == spouse_gender and \
+                            len(set(parents_of[other]).intersection(parents_of[key])) == 0:
+                        spouse = other
+                        break
+            if spouse is None:
+                if len(records) >= size:
+                    continue
+                spouse = new_person(generation, gender=spouse_gender)
+            married.add(key)
+            married.add(spouse)
+            edges.append((key, "spouse", spouse))
+            couples.append((key, spouse))
+
+        next_generation = []
+        for couple in couples:
+            family_name = records[couple[0]]["last"]
+            # The grandparents of the children are the parents of the couple
+            grandparents = tuple(set(parents_of[couple[0]] + parents_of[couple[1]]))
+            for _ in range(_poisson(rng, fertility)):
+                if len(records) >= size:
+                    break
+                child = new_person(generation + 1, last=family_name)
+                parents_of[child] = couple
+                grandparents_of[child] = grandparents
+                edges.append((child, "parent", couple[0]))
+                edges.append((child, "parent", couple[1]))
+                next_generation.append(child)
+
+        current = next_generation
+        generation += 1
+
+    return records, edges
+
+
+def synthetic_family(size, depth=None, founders=None, fertility=2.5, marriage_rate=0.8, cousin_marriage_rate=0.02,
+                     seed=0, family=None):
+    """
+    Generate a synthetic family tree and load it into a family; see synthetic_records for the parameters
+    :param family: optional, an instance of Family to add the people to. If not given, a new one is created.
+    :return: the instance of Family
+    """
+    records, edges = synthetic_records(size, depth=depth, founders=founders, fertility=fertility,
+                                       marriage_rate=marriage_rate, cousin_marriage_rate=cousin_marriage_rate,
+                                       seed=seed)
+    family = Family() if family is None else family
+    family.bulk_load(records, edges)
+    return family
@@ -2,6 +2,9 @@
 
 from .context import PyGeneology
 from PyGeneology import pygenelib as pglib
+from PyGeneology.columnar import ColumnarFamily
+from PyGeneology import dedup, kinship
+from PyGeneology.synthetic import synthetic_family, synthetic_records
 from .example_families import *
 import pdb
 
@@ -47,6 +50,42 @@ def search_test(fam):
     for r in result:
         print_person(r)
 
+def flexible_search_test(fam):
+    print("Searching for last names starting with 'granger'")
+    result = fam.search_by_name(last="granger", mode="prefix")
+    for r in result:
+        print_person(r)
+
+    print("Searching for first names containing 'ly' with last name containing 'pot'")
+    result = fam.search_by_name(first="ly", last="pot", mode="substring")
+    for r in result:
+        print_person(r)
+
+    print("Searching for 'Evans' in any name")
+    result = fam.search_by_name(any_name="Evans")
+    for r in result:
+        print_person(r)
+
+    print("Renaming Fleur Delcour to Fleur Weasley, then searching for last name 'Delcour' (should yield nothing)")
+    fleur.last_name = "Weasley"
+    result = fam.search_by_name(last="Delcour")
+    for r in result:
+        print_person(r)
+    fleur.last_name = "Delcour"
+
+def membership_test(fam):
+    print("Family has {0} members; checking membership by id:".format(len(fam)))
+    print("  Albus in family: {0} (should be True)".format(albus in fam))
+    print("  Lookup of Albus's id: {0}".format(fam.get_member(albus.id)))
+    print("  Albus usable in a set: {0} (should be 1)".format(len({albus, fam.get_member(albus.id)})))
+
+def generation_test(fam):
+    for g in fam.generations:
+        print("Generation {0} has {1} members:".format(g, fam.generation_size(g)))
+        for p in fam.find_members_in_generation(g):
+            print_person(p)
+    print("Oldest generation: {0}".format(fam.oldest_generation))
+
 def ancestor_test(fam):
     print("Albus's immediate ancestors:")
     anc = fam.ancestors_in_generation(albus, albus.generation-1)
@@ -58,6 +97,21 @@ def ancestor_test(fam):
     for a in anc:
         print_person(a)
 
+def pedigree_collapse_test():
+    # A child of first cousins Rose and Louis: Arthur and Molly are reached along two lines of descent
+    fam = pglib.Family()
+    child = pglib.Person(pglib.female, first="Pedigree", last="Collapse", parent=rose)
+    child.add_parent(louis)
+    fam.add_member(child)
+    print("Ancestors of a child of first cousins (distance, number of lines of descent):")
+    for anc, dist, n_paths in fam.iter_ancestors(child, count_paths=True):
+        print("  {0}: {1} ({2}, {3})".format(anc, anc.fullname(), dist, n_paths))
+    print("Great-grandparents (each listed once):")
+    for anc in fam.ancestors_in_generation(child, child.generation - 3):
+        print_person(anc)
+    for p in child.parents:
+        p.remove_relation(child)
+
 def common_ancestor_test(fam):
     for pair in relation_pairs:
         a = pair['people'][0]
@@ -66,6 +120,9 @@ def common_ancestor_test(fam):
         commons = fam.common_ancestors(a, b)
         for p in commons:
             print_person(p)
+        print("  (work done: {0})".format(fam.last_common_ancestor_stats))
+    fam.common_ancestors(albus, hugo)
+    print("Work done when answering from the cache: {0} (should be None)".format(fam.last_common_ancestor_stats))
 
 def relation_test(fam):
     for pair in relation_pairs:
@@ -76,16 +133,368 @@ def relation_test(fam):
             pair['reln'][0], pair['reln'][1]
         ))
 
+def ancestry_index_test(fam):
+    fam.build_ancestry_index()
+    print("Is Arthur an ancestor of Albus? {0} (should be True)".format(fam.is_ancestor(arthur, albus)))
+    print("Is Albus an ancestor of Arthur? {0} (should be False)".format(fam.is_ancestor(albus, arthur)))
+    print("Is Remus an ancestor of Victoire? {0} (should be False)".format(fam.is_ancestor(remus, victoire)))
+    print("Relationships answered from the ancestry index:")
+    relation_test(fam)
+    fam.drop_ancestry_index()
+
+    # A parent who is not a member unlinking themselves from a member must still reach the index
+    family = pglib.Family()
+    grandfather = pglib.Person(pglib.male, first="Septimus", last="Weasley")
+    father = pglib.Person(pglib.male, first="Arthur", last="Weasley", parent=grandfather)
+    son = pglib.Person(pglib.male, first="Ronald", last="Weasley", parent=father)
+    family.add_member(grandfather)
+    family.add_member(son)
+    family.build_ancestry_index()
+    father.remove_relation(grandfather)
+    print("Is Septimus an ancestor of Ronald after their link is removed? {0} (should be False)".format(
+        family.is_ancestor(grandfather, son)))
+
+def relationship_matrix_test(fam):
+    people = [albus, ron, hugo, lily, teddy]
+    matrix = fam.relationship_matrix(people)
+    for base in people:
+        print("Relationships to {0}:".format(base.fullname()))
+        for other, reln in zip(people, matrix.row(base)):
+            print("  {0}: {1} (should be {2})".format(other.fullname(), reln, fam.get_relationship(base, other)))
+
+def relationship_cache_test(fam):
+    print("Teddy is Victoire's {0} (should be unrelated)".format(fam.get_relationship(victoire, teddy)))
+    print("Hugo is Albus's {0}".format(fam.get_relationship(albus, hugo)))
+    print("Making Nymphadora a daughter of Arthur, which should only invalidate the cached results of her"
+          " descendants and of Arthur and his ancestors")
+    dora.add_parent(arthur)
+    print("Teddy is Victoire's {0} (should no longer be unrelated)".format(fam.get_relationship(victoire, teddy)))
+    print("Hugo is Albus's {0}".format(fam.get_relationship(albus, hugo)))
+    dora.remove_relation(arthur)
+    arthur.remove_relation(dora)
+    print("Cache statistics: {0}".format(fam.cache_stats()))
+
+    # Changes made on a person who is not a member, or on one side of a link only, must still reach the cache
+    family = pglib.Family()
+    grandfather = pglib.Person(pglib.male, first="Septimus", last="Weasley")
+    father = pglib.Person(pglib.male, first="Arthur", last="Weasley", parent=grandfather)
+    son = pglib.Person(pglib.male, first="Ronald", last="Weasley", parent=father)
+    brother = pglib.Person(pglib.male, first="Percy", last="Weasley", parent=father)
+    for p in (grandfather, father, son, brother):
+        family.add_member(p)
+    print("Ronald is Septimus's {0}".format(family.get_relationship(grandfather, son)))
+    son.remove_relation(father)
+    son.add_parent(father)
+    print("Percy is Ronald's {0} after unlinking and relinking one side (should be brother)".format(
+        family.get_relationship(son, brother)))
+    family.remove_member(father)
+    father.remove_relation(grandfather)
+    print("Ronald is Septimus's {0} after a non-member unlinks them (should be unrelated)".format(
+        family.get_relationship(grandfather, son)))
+
+def columnar_test(fam):
+    col = ColumnarFamily.from_family(fam)
+    print("Columnar family has {0} members".format(len(col)))
+    search_test(col)
+    print("Relationships in the columnar family:")
+    relation_test(col)
+
+def bulk_load_test():
+    fam = pglib.Family()
+    records = [{"key": "arthur", "gender": pglib.male, "first": "Arthur", "last": "Weasley"},
+               {"key": "molly", "gender": pglib.female, "first": "Molly", "last": "Weasley",
+                "unmarried_name": "Prewett"},
+               {"key": "ron", "gender": pglib.male, "first": "Ronald", "last": "Weasley"},
+               {"key": "ginny", "gender": pglib.female, "first": "Ginny", "last": "Weasley"},
+               {"key": "hermione", "gender": pglib.female, "first": "Hermione", "last": "Granger-Weasley"},
+               {"key": "rose", "gender": pglib.female, "first": "Rose", "last": "Granger-Weasley"}]
+    edges = [("arthur", "spouse", "molly"), ("arthur", "child", "ron"), ("molly", "child", "ron"),
+             ("ginny", "parent", "arthur"), ("ginny", "parent", "molly"), ("ron", "spouse", "hermione"),
+             ("rose", "parent", "ron"), ("rose", "parent", "hermione"), ("ron", "child", "rose")]
+    people = fam.bulk_load(records, edges)
+    for key, p in people.items():
+        print("  {0}: generation {1}, parents {2}".format(p.fullname(), p.generation,
+                                                         [q.first_name for q in p.parents]))
+    print("Ginny is Rose's {0} (should be aunt)".format(fam.get_relationship(people["rose"], people["ginny"])))
+
+
+def synthetic_test():
+    fam = synthetic_family(2000, cousin_marriage_rate=0.1, seed=42)
+    print("Generated {0} people in generations {1}".format(len(fam), fam.generations))
+    print("Generating again with the same seed gives the same tree: {0} (should be True)".format(
+        synthetic_records(2000, cousin_marriage_rate=0.1, seed=42) == synthetic_records(2000, cousin_marriage_rate=0.1,
+                                                                                        seed=42)))
+    collapsed = 0
+    for p in fam.find_members_in_generation(fam.generations[-1]):
+        for anc, dist, n_paths in fam.iter_ancestors(p, count_paths=True):
+            if n_paths > 1:
+                collapsed += 1
+                break
+    print("People in the youngest generation with pedigree collapse: {0}".format(collapsed))
+    same_gender = sum(1 for p in fam for s in p.spouses if s.gender == p.gender)
+    print("Couples of the same gender: {0} (should be 0)".format(same_gender))
+
+def instrumentation_test(fam):
+    # Without a cache, so that get_relationship always has to call common_ancestors
+    fam = ColumnarFamily.from_family(fam, cache_size=0)
+    events = []
+    fam.enable_instrumentation(callback=events.append)
+    fam.search_by_name(last="Weasley")
+    fam.ancestors_in_generation(fam.get_member(albus.id), -1)
+    fam.get_relationship(fam.get_member(albus.id), fam.get_member(hugo.id))
+    stats = fam.query_stats()
+    fam.disable_instrumentation()
+    for method in pglib.QueryInstrumentation.methods:
+        print("  {0}: {1} call(s), {2} person(s) visited, {3} generation(s) walked".format(
+            method, stats[method]["calls"], stats[method]["persons_visited"], stats[method]["generations_walked"]))
+    print("The callback saw {0} calls (should be 4, including the common_ancestors call made by get_relationship)"
+          .format(len(events)))
+    print("Statistics after disabling: {0} (should be None)".format(fam.query_stats()))
+
+def kinship_test(fam):
+    for base, other, expected in [(harry, lily, 0.25), (albus, lp2, 0.25), (albus, hugo, 0.0625), (albus, ron, 0.125),
+                                  (albus, hermione, 0.0), (albus, albus, 0.5)]:
+        print("  Kinship of {0} and {1}: {2} (should be {3})".format(base.fullname(), other.fullname(),
+                                                                   kinship.kinship(fam, base, other), expected))
+    inbred = sum(1 for f in kinship.inbreeding_coefficients(fam).values() if f > 0)
+    print("Inbred members: {0} (should be 0)".format(inbred))
+
+    # A child of first cousins has an inbreeding coefficient of 1/16
+    cousins = pglib.Family()
+    people = cousins.bulk_load([{"key": k, "gender": g} for k, g in [("gp1", pglib.male), ("gp2", pglib.female),
+                                                                     ("a", pglib.male), ("b", pglib.female),
+                                                                     ("sa", pglib.female), ("sb", pglib.male),
+                                                                     ("c1", pglib.male), ("c2", pglib.female),
+                                                                     ("child", pglib.male)]],
+                               [("a", "parent", "gp1"), ("a", "parent", "gp2"), ("b", "parent", "gp1"),
+                                ("b", "parent", "gp2"), ("c1", "parent", "a"), ("c1", "parent", "sa"),
+                                ("c2", "parent", "b"), ("c2", "parent", "sb"), ("child", "parent", "c1"),
+                                ("child", "parent", "c2")])
+    print("Inbreeding of a child of first cousins: {0} (should be 0.0625)".format(
+        kinship.inbreeding_coefficients(cousins, [people["child"]])[people["child"].id]))
+
+    # A link removed from only one side is ignored, and a third parent is rejected
+    people["c1"].remove_relation(people["child"])
+    print("Inbreeding once c1 no longer lists the child: {0} (should be 0.0625)".format(
+        kinship.inbreeding_coefficients(cousins, [people["child"]])[people["child"].id]))
+    people["child"].remove_relation(people["c1"])
+    print("Inbreeding once the child no longer lists c1 either: {0} (should be 0.0)".format(
+        kinship.inbreeding_coefficients(cousins, [people["child"]])[people["child"].id]))
+    people["child"].add_parent(people["c1"])
+    cousins.add_member(pglib.Person(pglib.female, first="Third", child=people["child"]))
+    try:
+        kinship.inbreeding_coefficients(cousins)
+        print("A third parent was not rejected")
+    except pglib.GenError as err:
+        print("A third parent is rejected: {0}".format(err))
+
+def dedup_test():
+    for name, expected in [("Robert", "R163"), ("Rupert", "R163"), ("Tymczak", "T522"), ("Ashcraft", "A261")]:
+        print("  Soundex of {0}: {1} (should be {2})".format(name, dedup.soundex(name), expected))
+    for name, expected in [("Weasley", "WSL"), ("Wesley", "WSL"), ("Knight", "NT"), ("Catherine", "K0RN")]:
+        print("  Metaphone of {0}: {1} (should be {2})".format(name, dedup.metaphone(name), expected))
+
+    # Enter some people of a synthetic family a second time, with their first names misspelled
+    fam = synthetic_family(3000, seed=7)
+    originals = [p for p in fam.members if len(p.parents) == 2][::100]
+    for p in originals:
+        copy = pglib.Person(p.gender, first=p.first_name + p.first_name[-1], last=p.last_name,
+                            parent=p.parents[0])
+        copy.add_parent(p.parents[1])
+        fam.add_member(copy)
+    finder = dedup.DuplicateFinder(fam)
+    candidates = finder.find()
+    found = set((a.id, b.id) for a, b, _ in candidates) | set((b.id, a.id) for a, b, _ in candidates)
+    print("Planted duplicates found: {0} of {1} (should be all)".format(
+        sum(1 for p in originals if any((p.id, c.id) in found for c in p.parents[0].children if c is not p)),
+        len(originals)))
+    print("Compared {0} pairs in {1} blocks instead of all {2} pairs; {3} candidates".format(
+        finder.stats["pairs_compared"], finder.stats["blocks"], len(fam) * (len(fam) - 1) // 2,
+        finder.stats["candidates"]))
+
+    # The same household entered twice, with the child under another surname, shares only the key on parents' names
+    households = []
+    for surname in ("Weasley", "Prewett"):
+        mother = pglib.Person(pglib.female, first="Molly", last=surname)
+        father = pglib.Person(pglib.male, first="Arthur", last=surname)
+        child = pglib.Person(pglib.male, first="Ronald", last=surname, parent=mother)
+        child.add_parent(father)
+        households.append(child)
+    shared = dedup.blocking_keys(households[0]) & dedup.blocking_keys(households[1])
+    print("Keys shared by the two entries of Ronald: {0} (should be ['parents'])".format(sorted(k[0] for k in shared)))
+
+def merge_test():
+    # Two overlapping parts of one tree, numbered differently: the younger part starts its generations at 10
+    records, edges = synthetic_records(2000, seed=3)
+    overlap = set(r["key"] for r in records if r["generation"] in (2, 3))
+    parts = []
+    for keys, shift in [(set(r["key"] for r in records if r["generation"] <= 3), 0),
+                        (set(r["key"] for r in records if r["generation"] >= 2), 8)]:
+        part = pglib.Family()
+        people = part.bulk_load([dict(r, generation=r["generation"] + shift) for r in records if r["key"] in keys],
+                                [e for e in edges if e[0] in keys and e[2] in keys])
+        parts.append((part, people))
+    (older, older_people), (younger, younger_people) = parts
+    merged = older.merge(younger)
+    stats = older.last_merge_stats
+    print("Merged families have {0} people (the whole tree has {1}); {2} matched, {3} added, {4} relations added, "
+          "{5} already present".format(len(older), len(records), stats["matched"], stats["added"],
+                                       stats["parent_edges_added"] + stats["spouse_edges_added"],
+                                       stats["duplicate_edges"]))
+    correct = sum(1 for k in overlap if merged[younger_people[k].id] is older_people[k])
+    wrong = sum(1 for k, p in younger_people.items() if k not in overlap and merged[p.id] in older_people.values())
+    print("People in both parts matched correctly: {0} of {1}; people matched to the wrong person: {2} (should be 0)"
+          .format(correct, len(overlap), wrong))
+    youngest = merged[younger_people[len(records) - 1].id]
+    print("Generation of the youngest person after rebasing: {0} (should be {1})".format(
+        youngest.generation, records[-1]["generation"]))
+    print("Duplicate relations: {0} (should be 0)".format(
+        sum(len(p.parents) - len(set(p.parents)) + len(p.spouses) - len(set(p.spouses)) for p in older)))
+
+def neighborhood_test(fam):
+    neighbors = list(fam.iter_neighborhood(albus, max_depth=4))
+    labels = dict((rel.id, label) for rel, path, label in neighbors)
+    for other, expected in [(harry, "father"), (lp2, "sister"), (molly, "grandmother"), (ron, "uncle"),
+                            (hugo, fam.get_relationship(albus, hugo)), (hermione, "aunt")]:
+        print("  {0} is Albus's {1} (should be {2})".format(other.fullname(), labels.get(other.id), expected))
+    for rel, path, label in neighbors:
+        if rel is hermione:
+            print("Path to Hermione: {0} (should be parent, parent, child, spouse)".format(
+                ", ".join(relation for relation, _ in path)))
+    print("Relatives within 4 steps are each produced once: {0} (should be True)".format(
+        len(neighbors) == len(set(rel.id for rel, _, _ in neighbors))))
+    print("Relatives produced with max_count=5: {0} (should be 5)".format(
+        len(list(fam.iter_neighborhood(albus, max_depth=None, max_count=5)))))
+
+def relationship_path_test(fam):
+    for base, other, expected in [(harry, molly, "mother-in-law"), (harry, ron, "brother-in-law"),
+                                  (molly, harry, "son-in-law"), (albus, hermione, "aunt"),
+                                  (fleur, hermione, "sister-in-law"), (albus, ron, "uncle")]:
+        print("  {0} is {1}'s {2} (should be {3})".format(other.fullname(), base.fullname(),
+                                                         fam.get_extended_relationship(base, other), expected))
+    print("Path from Harry to Ron: {0} (should be spouse, parent, child)".format(
+        ", ".join(relation for relation, _ in fam.relationship_path(harry, ron))))
+    print("Path within 2 steps from Harry to Ron: {0} (should be None)".format(
+        fam.relationship_path(harry, ron, max_depth=2)))
+
+    blended = pglib.Family()
+    people = blended.bulk_load([{"key": k, "gender": g} for k, g in [("mum", pglib.female), ("dad", pglib.male),
+                                                                     ("child", pglib.female),
+                                                                     ("stepdad", pglib.male)]],
+                               [("child", "parent", "mum"), ("child", "parent", "dad"), ("mum", "spouse", "stepdad")])
+    print("Mum's new husband is the child's {0} (should be stepfather)".format(
+        blended.get_extended_relationship(people["child"], people["stepdad"])))
+    print("The child is his {0} (should be stepdaughter)".format(
+        blended.get_extended_relationship(people["stepdad"], people["child"])))
+    print("Dad and the stepfather are {0} (should be relative by marriage)".format(
+        blended.get_extended_relationship(people["dad"], people["stepdad"])))
+
+def descendant_test(fam):
+    print("Arthur's grandchildren:")
+    for p in fam.descendants_in_generation(arthur, arthur.generation + 2):
+        print_person(p)
+    print("Arthur has {0} descendants, nearest first: {1}".format(
+        fam.descendant_count(arthur), ", ".join(d.first_name for d, _ in fam.iter_descendants(arthur))))
+    columnar = ColumnarFamily.from_family(fam)
+    print("The columnar family finds the same descendants: {0} (should be True)".format(
+        [(d.id, k) for d, k in fam.iter_descendants(molly)] ==
+        [(d.id, k) for d, k in columnar.iter_descendants(columnar.get_member(molly.id))]))
+
+    # Counts remembered by a family are adjusted as relations change
+    family = synthetic_family(2000, cousin_marriage_rate=0.1, seed=11)
+    family.enable_descendant_counts()
+    for p in family:
+        family.descendant_count(p)
+    founder = family.find_members_in_generation(family.oldest_generation)[0]
+    child = founder.children[0]
+    before = family.descendant_count(founder)
+    child.remove_relation(founder)
+    founder.remove_relation(child)
+    print("Founder's descendants after removing a child: {0} (walking them again gives {1})".format(
+        family.descendant_count(founder), sum(1 for _ in family.iter_descendants(founder))))
+    founder.add_child(child)
+    print("And after adding the child back: {0} (should be {1})".format(family.descendant_count(founder), before))
+    counted = sum(1 for p in family if p.id in family._descendant_counts)
+    print("Counts still remembered: {0} of {1}".format(counted, len(family)))
+    wrong = sum(1 for p in family if family.descendant_count(p) != sum(1 for _ in family.iter_descendants(p)))
+    print("Remembered counts that are wrong: {0} (should be 0)".format(wrong))
+
+    # A link to a parent who is not a member is only ever reported by the child
+    family = pglib.Family()
+    grandparent = pglib.Person(pglib.male, first="Septimus", last="Weasley")
+    parent = pglib.Person(pglib.male, first="Arthur", last="Weasley", parent=grandparent)
+    child = pglib.Person(pglib.male, first="Ronald", last="Weasley", parent=parent)
+    family.add_member(grandparent)
+    family.add_member(child)
+    family.enable_descendant_counts()
+    family.descendant_count(grandparent)
+    child.remove_relation(parent)
+    print("Descendants after unlinking from a parent who is not a member: {0} (walking them gives {1})".format(
+        family.descendant_count(grandparent), sum(1 for _ in family.iter_descendants(grandparent))))
+    child.add_parent(parent)
+    print("And after linking them again: {0} (walking them gives {1})".format(
+        family.descendant_count(grandparent), sum(1 for _ in family.iter_descendants(grandparent))))
 
 if __name__ == "__main__":
     print_test_head("search test")
     search_test(weasleys)
 
+    print_test_head("flexible search test")
+    flexible_search_test(weasleys)
+
+    print_test_head("membership test")
+    membership_test(weasleys)
+
+    print_test_head("generation test")
+    generation_test(weasleys)
+
     print_test_head("ancestor list test")
     ancestor_test(weasleys)
 
+    print_test_head("pedigree collapse test")
+    pedigree_collapse_test()
+
     print_test_head("common ancestor test")
     common_ancestor_test(weasleys)
 
     print_test_head("relationship test")
     relation_test(weasleys)
+
+    print_test_head("ancestry index test")
+    ancestry_index_test(weasleys)
+
+    print_test_head("relationship matrix test")
+    relationship_matrix_test(weasleys)
+
+    print_test_head("relationship cache test")
+    relationship_cache_test(weasleys)
+
+    print_test_head("columnar family test")
+    columnar_test(weasleys)
+
+    print_test_head("bulk load test")
+    bulk_load_test()
+
+    print_test_head("synthetic family test")
+    synthetic_test()
+
+    print_test_head("instrumentation test")
+    instrumentation_test(weasleys)
+
+    print_test_head("kinship test")
+    kinship_test(weasleys)
+
+    print_test_head("duplicate detection test")
+    dedup_test()
+
+    print_test_head("merge test")
+    merge_test()
+
+    print_test_head("neighborhood test")
+    neighborhood_test(weasleys)
+
+    print_test_head("relationship path test")
+    relationship_path_test(weasleys)
+
+    print_test_head("descendant test")
+    descendant_test(weasleys)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the main Family operations on synthetic trees of several sizes. Run from the repository root with
+
+    python -m tests.benchmarks [--sizes 1000,10000,100000] [--output results.json]
+
+Results are printed as a table and, with --output, also written as JSON so that runs from different commits can be
+compared.
+"""
+
+from .context import PyGeneology
+from PyGeneology import pygenelib as pglib
+from PyGeneology.synthetic import synthetic_records
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_calls(func, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_size(size, n_queries, seed, cousin_marriage_rate):
+    records, edges = synthetic_records(size, cousin_marriage_rate=cousin_marriage_rate, seed=seed)
+    rng = random.Random(seed)
+    results = []
+
+    def record(operation, seconds, calls):
+        results.append({"size": size, "operation": operation, "calls": calls, "seconds": seconds,
+                        "microseconds_per_call": 1e6 * seconds / calls if calls > 0 else None})
+
+    fam = pglib.Family(cache_size=0)
+    start = time.perf_counter()
+    fam.bulk_load(records, edges)
+    record("bulk_load", time.perf_counter() - start, 1)
+    members = fam.members
+
+    # Caching is turned off above so that repeated queries measure the work, not the cache
+    extra = [pglib.Person(pglib.male, first="Extra", last="Person{0}".format(i)) for i in range(n_queries)]
+    record("add_member", time_calls(fam.add_member, [(p,) for p in extra]), len(extra))
+    record("remove_member", time_calls(fam.remove_member, [(p,) for p in extra]), len(extra))
+
+    sample = [rng.choice(members) for _ in range(n_queries)]
+    record("search_by_name exact", time_calls(
+        lambda p: fam.search_by_name(first=p.first_name, last=p.last_name), [(p,) for p in sample]), len(sample))
+    record("search_by_name prefix", time_calls(
+        lambda p: fam.search_by_name(last=p.last_name[:3], mode="prefix"), [(p,) for p in sample]), len(sample))
+
+    descendants = [p for p in members if p.generation > fam.oldest_generation]
+    sample = [rng.choice(descendants) for _ in range(n_queries)] if len(descendants) > 0 else []
+    record("ancestors_in_generation", time_calls(
+        fam.ancestors_in_generation, [(p, fam.oldest_generation) for p in sample]), len(sample))
+
+    youngest = fam.generations[-1]
+    young = fam.find_members_in_generation(youngest)
+    pairs = [(rng.choice(young), rng.choice(young)) for _ in range(n_queries)]
+    record("common_ancestors", time_calls(fam.common_ancestors, pairs), len(pairs))
+    record("get_relationship", time_calls(fam.get_relationship, pairs), len(pairs))
+
+    fam.build_ancestry_index()
+    record("get_relationship indexed", time_calls(fam.get_relationship, pairs), len(pairs))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Family operations on synthetic trees")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated numbers of people to generate (default %(default)s)")
+    parser.add_argument("--queries", type=int, default=200, help="number of calls to time per operation")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generator and for picking queries")
+    parser.add_argument("--cousin-marriage-rate", type=float, default=0.02)
+    parser.add_argument("--output", help="also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results.extend(benchmark_size(size, args.queries, args.seed, args.cousin_marriage_rate))
+
+    print("{0:>10}  {1:<26}{2:>8}{3:>16}".format("size", "operation", "calls", "us per call"))
+    for r in results:
+        print("{0:>10}  {1:<26}{2:>8}{3:>16.1f}".format(r["size"], r["operation"], r["calls"],
+                                                      r["microseconds_per_call"] or 0.0))
+
+    if args.output is not None:
+        report = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                  "seed": args.seed, "queries": args.queries, "cousin_marriage_rate": args.cousin_marriage_rate,
+                  "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to {0}".format(args.output), file=sys.stderr)
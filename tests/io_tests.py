@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+from .context import PyGeneology
+from PyGeneology import gedcom, jsonl, parallel, snapshot
+from PyGeneology.server import FamilyServer, person_json
+from PyGeneology.sqlite_family import SqliteFamily
+import asyncio
+import json
+from .example_families import *
+from .basic_tests import print_test_head, print_person, relation_test
+import io
+import os
+import tempfile
+
+sample_gedcom = """0 HEAD
+1 CHAR UTF-8
+0 @I1@ INDI
+1 NAME Arthur /Weasley/
+1 SEX M
+1 FAMS @F1@
+0 @I2@ INDI
+1 NAME Molly /Prewett/
+1 NAME Molly /Weasley/
+2 TYPE married
+1 SEX F
+1 FAMS @F1@
+0 @I3@ INDI
+1 NAME Ronald Bilius /Weasley/
+1 SEX M
+1 FAMC @F1@
+0 @I4@ INDI
+1 NAME Ginevra Molly /Weasley/
+1 SEX F
+1 FAMC @F1@
+0 @F1@ FAM
+1 HUSB @I1@
+1 WIFE @I2@
+1 MARR
+1 CHIL @I3@
+1 CHIL @I4@
+0 TRLR
+"""
+
+def gedcom_import_test():
+    reader = gedcom.GedcomReader(io.StringIO(sample_gedcom))
+    fam = reader.read()
+    print("Imported {0} people:".format(len(fam)))
+    for p in fam:
+        print("  {0}: {1} (unmarried name '{2}'), generation {3}".format(p, p.fullname(), p.unmarried_name,
+                                                                         p.generation))
+    ron, ginny = fam.search_by_name(first="Ronald")[0], fam.search_by_name(first="Ginevra")[0]
+    print("Ginevra is Ronald's {0} (should be sister)".format(fam.get_relationship(ron, ginny)))
+    print("Import statistics: {0}".format(reader.stats))
+
+    broken = sample_gedcom.replace("1 SEX M\n", "1 SEX M\n1 _GEN two\n", 1).replace("0 TRLR", "X TRLR")
+    reader = gedcom.GedcomReader(io.StringIO(broken))
+    fam = reader.read()
+    print("Imported {0} people from a file with {1} malformed lines (should be 4 and 2)".format(
+        len(fam), reader.stats["malformed_lines"]))
+
+def gedcom_round_trip_test(fam):
+    buf = io.StringIO()
+    n_lines = gedcom.write_gedcom(fam, buf)
+    print("Wrote {0} lines of GEDCOM for {1} people".format(n_lines, len(fam)))
+    copy = gedcom.read_gedcom(io.StringIO(buf.getvalue()))
+    originals = dict((p.id, c) for p, c in zip(fam, copy))
+    print("Relationships after reading the GEDCOM back in:")
+    for base, other in [(albus, hugo), (rose, ginny), (lp2, james), (teddy, victoire)]:
+        print("  {0} is {1}'s {2} (should be {3})".format(
+            other.fullname(), base.fullname(), copy.get_relationship(originals[base.id], originals[other.id]),
+            fam.get_relationship(base, other)))
+
+    couple = pglib.Family()
+    charlie = pglib.Person(pglib.male, first="Charlie", last="Weasley")
+    couple.add_member(charlie)
+    couple.add_member(pglib.Person(pglib.male, first="Norbert", spouse=charlie))
+    tags = [line.split()[1] for line in gedcom.iter_gedcom_lines(couple) if line.split()[1] in ("HUSB", "WIFE")]
+    print("Spouse tags of a same-sex couple: {0} (should be ['HUSB', 'WIFE'])".format(tags))
+
+    parents = pglib.Family()
+    mother = pglib.Person(pglib.female, first="Andromeda", last="Black")
+    father = pglib.Person(pglib.male, first="Ted", last="Tonks")
+    daughter = pglib.Person(pglib.female, first="Nymphadora", last="Tonks", parent=mother)
+    daughter.add_parent(father)
+    for p in (mother, father, daughter):
+        parents.add_member(p)
+    buf = io.StringIO()
+    gedcom.write_gedcom(parents, buf)
+    copy = gedcom.read_gedcom(io.StringIO(buf.getvalue()))
+    copied = dict((p.first_name, p) for p in copy)
+    print("Unmarried parents after a round trip: {0} parents, {1} spouses (should be 2 and 0)".format(
+        len(copied["Nymphadora"].parents), len(copied["Andromeda"].spouses)))
+
+def snapshot_test(fam):
+    fd, path = tempfile.mkstemp(suffix=".snap")
+    os.close(fd)
+    try:
+        n_bytes = snapshot.write_snapshot(fam, path)
+        print("Wrote a {0} byte snapshot of {1} people".format(n_bytes, len(fam)))
+        with snapshot.open_snapshot(path) as copy:
+            print("Opened a snapshot with {0} people in generations {1}".format(len(copy), copy.generations))
+            print("Searching the snapshot for last names starting with 'granger':")
+            for p in copy.search_by_name(last="granger", mode="prefix"):
+                print_person(p)
+            print("Relationships in the snapshot:")
+            for base, other in [(albus, hugo), (rose, ginny), (lp2, james), (teddy, victoire)]:
+                print("  {0} is {1}'s {2} (should be {3})".format(
+                    other.fullname(), base.fullname(),
+                    copy.get_relationship(copy.get_member(base.id), copy.get_member(other.id)),
+                    fam.get_relationship(base, other)))
+    finally:
+        os.remove(path)
+
+def jsonl_round_trip_test(fam):
+    buf = io.StringIO()
+    n_lines = jsonl.write_jsonl(fam, buf)
+    print("Wrote {0} lines of JSON for {1} people".format(n_lines, len(fam)))
+    # Reversing the lines means every parent is read after their children, so all those references are forward ones
+    lines = buf.getvalue().splitlines(True)
+    reader = jsonl.JsonLinesReader(io.StringIO("".join(reversed(lines))))
+    copy = reader.read()
+    originals = dict((p.id, c) for p, c in zip(reversed(list(fam)), copy))
+    print("Relationships after reading the lines back in reverse order:")
+    for base, other in [(albus, hugo), (rose, ginny), (lp2, james), (teddy, victoire)]:
+        print("  {0} is {1}'s {2} (should be {3})".format(
+            other.fullname(), base.fullname(), copy.get_relationship(originals[base.id], originals[other.id]),
+            fam.get_relationship(base, other)))
+    print("Unresolved references: {0} (should be 0)".format(reader.stats["unresolved_references"]))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = jsonl.write_jsonl_chunks(fam, os.path.join(tmpdir, "chunk-{0}.jsonl"), 10)
+        print("Wrote {0} chunks; reading them back gives {1} people".format(len(paths), len(jsonl.read_jsonl(paths))))
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+def sqlite_test(fam):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        SqliteFamily.from_family(fam, path).close()
+        with SqliteFamily(path) as stored:
+            print("Reopened a database with {0} people in generations {1}".format(len(stored), stored.generations))
+            print("Searching the database for first names starting with 'l':")
+            for p in stored.search_by_name(first="l", mode="prefix"):
+                print_person(p)
+            print("Albus's ancestors two generations back:")
+            for p in stored.ancestors_in_generation(stored.get_member(albus.id), -1):
+                print_person(p)
+            print("Relationships in the database:")
+            for base, other in [(albus, hugo), (rose, ginny), (lp2, james), (teddy, victoire)]:
+                print("  {0} is {1}'s {2} (should be {3})".format(
+                    other.fullname(), base.fullname(),
+                    stored.get_relationship(stored.get_member(base.id), stored.get_member(other.id)),
+                    fam.get_relationship(base, other)))
+            print("Looking up the same id twice gives the same object: {0} (should be True)".format(
+                stored.get_member(albus.id) is stored.get_member(albus.id)))
+            grandchildren = stored.descendants_in_generation(stored.get_member(molly.id), molly.generation + 2)
+            print("Molly's grandchildren in the database: {0} (should be {1})".format(
+                sorted(p.id for p in grandchildren),
+                sorted(p.id for p in fam.descendants_in_generation(molly, molly.generation + 2))))
+    finally:
+        os.remove(path)
+
+def parallel_test(fam):
+    pairs = [(base, other) for base in fam for other in fam]
+    progress = []
+    labels = parallel.batch_relationships(fam, pairs, processes=2, chunk_size=100,
+                                          progress=lambda done, total: progress.append((done, total)))
+    print("Computed {0} relationships in {1} chunks".format(len(labels), len(progress)))
+    mismatches = sum(1 for (base, other), label in zip(pairs, labels) if fam.get_relationship(base, other) != label)
+    print("Relationships that differ from get_relationship: {0} (should be 0)".format(mismatches))
+    print("Last progress report: {0} (should be ({1}, {1}))".format(progress[-1], len(pairs)))
+
+def server_test(fam):
+    async def run():
+        server = FamilyServer(fam)
+        queries = [("/relationship", {"base": albus.id, "other": hugo.id}),
+                   ("/relationship", {"base": rose.id, "other": ginny.id}),
+                   ("/common_ancestors", {"person1": albus.id, "person2": hugo.id}),
+                   ("/search", {"first": "lily"}),
+                   ("/search", {"first": 5}),
+                   ("/ancestors", {"person": albus.id, "generation": 5})]
+        # Sent all at once, so they are answered in batches
+        responses = await asyncio.gather(*[server.dispatch("POST", path, json.dumps(q).encode("utf-8"))
+                                           for path, q in queries])
+        await server.close()
+        for (path, q), (status, response) in zip(queries, responses):
+            print("  {0} {1} -> {2} {3}".format(path, q, status, response))
+        print("Batches run: {0} for {1} queries".format(sum(b.batches for b in server.batchers.values()),
+                                                        len(queries)))
+        print("Statuses of the two searches batched together: {0} (should be [200, 400])".format(
+            [status for (path, _), (status, _) in zip(queries, responses) if path == "/search"]))
+
+        # A batch of pair queries is answered from one ancestry index, and each gets the same answer as alone
+        server = FamilyServer(fam)
+        pairs = [(albus, hugo), (rose, ginny), (albus, rose), (hugo, ginny)]
+        responses = await asyncio.gather(*[server.dispatch("POST", "/relationship", json.dumps(
+            {"base": p1.id, "other": p2.id}).encode("utf-8")) for p1, p2 in pairs])
+        responses += await asyncio.gather(
+            server.dispatch("POST", "/ancestors", json.dumps({"person": albus.id, "generation": 0}).encode("utf-8")),
+            server.dispatch("POST", "/ancestors", json.dumps({"person": albus.id, "generation": -1}).encode("utf-8")),
+            server.dispatch("POST", "/ancestors", json.dumps({"person": albus.id, "generation": 1}).encode("utf-8")))
+        await server.close()
+        print("Batched answers match single answers: {0} (should be True)".format(
+            [r["result"] for _, r in responses[:len(pairs)]] == [fam.get_relationship(p1, p2) for p1, p2 in pairs] and
+            [r["result"] for _, r in responses[len(pairs):-1]] == [
+                [person_json(p) for p in fam.ancestors_in_generation(albus, g)] for g in (0, -1)]))
+        print("Statuses of batched ancestor queries: {0} (should be [200, 200, 400])".format(
+            [status for status, _ in responses[len(pairs):]]))
+
+        # A request with a body larger than the limit is refused without reading it
+        server = FamilyServer(fam, max_body=16)
+        host, port = (await server.start(port=0)).sockets[0].getsockname()[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        body = json.dumps({"first": "a" * 64}).encode("utf-8")
+        writer.write("POST /search HTTP/1.1\r\nContent-Length: {0}\r\n\r\n".format(len(body)).encode("ascii") + body)
+        await writer.drain()
+        status_line = await reader.readline()
+        writer.close()
+        await server.close()
+        print("Response to a body over the limit: {0} (should be HTTP/1.1 413 Payload Too Large)".format(
+            status_line.decode("ascii").strip()))
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print_test_head("gedcom import test")
+    gedcom_import_test()
+
+    print_test_head("gedcom round trip test")
+    gedcom_round_trip_test(weasleys)
+
+    print_test_head("jsonl round trip test")
+    jsonl_round_trip_test(weasleys)
+
+    print_test_head("snapshot test")
+    snapshot_test(weasleys)
+
+    print_test_head("sqlite test")
+    sqlite_test(weasleys)
+
+    print_test_head("parallel test")
+    parallel_test(weasleys)
+
+    print_test_head("server test")
+    server_test(weasleys)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Load test for PyGeneology.server. By default it starts a server in this process on a synthetic tree and queries it
+over real sockets; with --port it queries a server that is already running instead. Run from the repository root with
+
+    python -m tests.server_load [--size 10000] [--requests 5000] [--concurrency 50]
+"""
+
+from .context import PyGeneology
+from PyGeneology.server import FamilyServer
+from PyGeneology.synthetic import synthetic_family
+import argparse
+import asyncio
+import json
+import random
+import time
+
+
+async def request(reader, writer, path, query):
+    body = json.dumps(query).encode("utf-8")
+    writer.write("POST {0} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {1}\r\n\r\n"
+                 .format(path, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads((await reader.readexactly(length)).decode("utf-8"))
+
+
+def make_queries(family, n, seed):
+    rng = random.Random(seed)
+    members = family.members
+    older = [p for p in members if p.generation > family.oldest_generation]
+    queries = []
+    for _ in range(n):
+        kind = rng.random()
+        a, b = rng.choice(members), rng.choice(members)
+        if kind < 0.4:
+            queries.append(("/relationship", {"base": a.id, "other": b.id}))
+        elif kind < 0.7:
+            queries.append(("/common_ancestors", {"person1": a.id, "person2": b.id}))
+        elif kind < 0.85 and len(older) > 0:
+            queries.append(("/ancestors", {"person": rng.choice(older).id, "generation": family.oldest_generation}))
+        else:
+            queries.append(("/search", {"last": a.last_name[:3], "mode": "prefix"}))
+    return queries
+
+
+async def run_load(host, port, queries, concurrency):
+    latencies = []
+    statuses = dict()
+    queue = asyncio.Queue()
+    for q in queries:
+        queue.put_nowait(q)
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while not queue.empty():
+                path, query = queue.get_nowait()
+                start = time.perf_counter()
+                status, _ = await request(reader, writer, path, query)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - start, sorted(latencies), statuses
+
+
+async def main(args):
+    family = synthetic_family(args.size, seed=args.seed)
+    queries = make_queries(family, args.requests, args.seed)
+
+    server = None
+    host, port = args.host, args.port
+    if port is None:
+        server = FamilyServer(family, window=args.window)
+        listener = await server.start(host, 0)
+        port = listener.sockets[0].getsockname()[1]
+
+    try:
+        seconds, latencies, statuses = await run_load(host, port, queries, args.concurrency)
+    finally:
+        if server is not None:
+            await server.close()
+
+    def percentile(p):
+        return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    print("{0} requests from {1} connections in {2:.2f} s: {3:.0f} requests/s".format(
+        len(latencies), args.concurrency, seconds, len(latencies) / seconds))
+    print("Latency (ms): p50 {0:.2f}, p95 {1:.2f}, p99 {2:.2f}, max {3:.2f}".format(
+        percentile(0.5), percentile(0.95), percentile(0.99), 1000 * latencies[-1]))
+    print("Responses by status: {0}".format(statuses))
+    if server is not None:
+        for path, batcher in sorted(server.batchers.items()):
+            if batcher.batches > 0:
+                print("  {0}: {1} queries in {2} batches ({3:.1f} per batch)".format(
+                    path, batcher.queries, batcher.batches, batcher.queries / batcher.batches))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the PyGeneology query server")
+    parser.add_argument("--size", type=int, default=10000, help="number of people in the synthetic tree")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--window", type=float, default=0.002, help="batching window of the in-process server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="query a server already running on this port, started with "
+                                                 "--synthetic SIZE --seed SEED so that the ids match")
+    asyncio.run(main(parser.parse_args()))